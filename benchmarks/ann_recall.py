@@ -0,0 +1,68 @@
+import argparse
+import time
+
+import numpy as np
+
+from benchmarks.synthetic import make_gallery
+from data.ann_backends import create_backend
+from similarity_models.cosine_similarity import cosine_similarity
+
+
+def exact_neighbours(gallery, queries, k):
+    neighbours = []
+    for query in queries:
+        rates = cosine_similarity(query, gallery)
+        neighbours.append(np.argsort(-rates)[:k])
+    return np.array(neighbours)
+
+
+def recall_at_k(found, expected):
+    hits = sum(len(np.intersect1d(row_found, row_expected)) for row_found, row_expected in zip(found, expected))
+    return hits / expected.size
+
+
+def measure(backend, queries, k):
+    latencies = []
+    found = []
+    for query in queries:
+        start = time.perf_counter()
+        indices, _ = backend.search(query, k)
+        latencies.append(time.perf_counter() - start)
+        found.append(indices[0])
+    latencies = np.array(latencies) * 1000
+    return np.array(found), np.percentile(latencies, 50), np.percentile(latencies, 99)
+
+
+def configurations(args):
+    yield 'exact', {}, {}
+    for ef_search in args.ef_search:
+        yield 'hnsw', {'M': 16, 'ef_construction': 200}, {'ef_search': ef_search}
+    for nprobe in args.nprobe:
+        yield 'ivf', {}, {'nprobe': nprobe}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recall@k and latency of the ANN backends against exact cosine.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--ef-search', type=int, nargs='+', default=[16, 64, 256])
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 8, 32])
+    args = parser.parse_args()
+
+    print(f"{'size':>8} {'backend':>8} {'params':>18} {'recall@' + str(args.k):>10} {'p50 ms':>8} {'p99 ms':>8}")
+    for size in args.sizes:
+        gallery, _, queries, _ = make_gallery(size, dim=args.dim, n_queries=args.queries)
+        expected = exact_neighbours(gallery, queries, args.k)
+        built = {}
+        for name, build_params, search_params in configurations(args):
+            # Build once per backend, then only the search-time parameter changes
+            if name not in built:
+                built[name] = create_backend(name, **build_params).build(gallery)
+            backend = built[name]
+            for key, value in search_params.items():
+                setattr(backend, key, value)
+            found, p50, p99 = measure(backend, queries, args.k)
+            params = ' '.join(f'{key}={value}' for key, value in search_params.items()) or '-'
+            print(f"{size:>8} {name:>8} {params:>18} {recall_at_k(found, expected):>10.3f} {p50:>8.3f} {p99:>8.3f}")
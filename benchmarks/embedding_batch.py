@@ -0,0 +1,60 @@
+import argparse
+import os
+import time
+
+from data.data_reader import DataReader
+
+
+def benchmark_batch_sizes(data_reader, images, batch_sizes, repeats=3):
+    """
+    Measure embedding throughput for several batch sizes.
+
+    Parameters:
+    data_reader (DataReader): Reader holding the embedding function.
+    images (list): Preprocessed uint8 images to embed.
+    batch_sizes (list): Batch sizes to try.
+    repeats (int): Runs per batch size, the best one is kept.
+
+    Returns:
+    dict: Images per second for each batch size, with 'single' for the per-image loop.
+    """
+    results = {}
+
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for image in images:
+            data_reader.get_single_image_embedding(image)
+        best = min(best, time.perf_counter() - start)
+    results['single'] = len(images) / best
+
+    for batch_size in batch_sizes:
+        best = float('inf')
+        for _ in range(repeats):
+            start = time.perf_counter()
+            data_reader.get_batch_embeddings(images, batch_size=batch_size)
+            best = min(best, time.perf_counter() - start)
+        results[batch_size] = len(images) / best
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Images/sec of the CLIP embedding path versus batch size.')
+    parser.add_argument('--num-images', type=int, default=128)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4, 8, 16, 32, 64])
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    data_reader = DataReader(root='processed', num_threads=args.threads)
+    train_files_path = data_reader.get_files_path(path=os.path.join(data_reader.root, 'train'))
+    images = [data_reader.read_image_from_path(path, (224, 224)) for path in train_files_path[:args.num_images]]
+    images = [image for image in images if image is not None]
+
+    # Warm up so the first timed run does not pay for lazy initialisation
+    data_reader.get_batch_embeddings(images[:2])
+
+    results = benchmark_batch_sizes(data_reader, images, args.batch_sizes, args.repeats)
+    print(f"{'batch size':>12} {'images/sec':>12}")
+    for batch_size, throughput in results.items():
+        print(f"{batch_size:>12} {throughput:>12.1f}")
@@ -0,0 +1,41 @@
+import argparse
+import time
+
+from benchmarks.ann_recall import exact_neighbours, recall_at_k
+from benchmarks.synthetic import make_gallery
+from data.quantization import CODECS, QuantizedStore, bytes_per_vector
+
+
+def make_codec(storage, n_subspaces):
+    return CODECS[storage](n_subspaces=n_subspaces) if storage == 'pq' else CODECS[storage]()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Memory per vector and recall loss of each embedding storage format.')
+    parser.add_argument('--size', type=int, default=100000)
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--rerank', type=int, default=100)
+    parser.add_argument('--n-subspaces', type=int, default=64)
+    args = parser.parse_args()
+
+    gallery, _, queries, _ = make_gallery(args.size, dim=args.dim, n_queries=args.queries)
+    expected = exact_neighbours(gallery, queries, args.k)
+
+    print(f"{'format':>8} {'bytes/vector':>13} {'recall@' + str(args.k):>10} "
+          f"{'+rerank':>8} {'ms/query':>9}")
+    for storage in CODECS:
+        store = QuantizedStore(make_codec(storage, args.n_subspaces)).build(gallery)
+        store.full_precision = gallery
+
+        store.rerank = 0
+        start = time.perf_counter()
+        found, _ = store.search(queries, args.k)
+        elapsed = (time.perf_counter() - start) * 1000 / len(queries)
+
+        store.rerank = args.rerank
+        reranked, _ = store.search(queries, args.k)
+
+        print(f"{storage:>8} {bytes_per_vector(store.data):>13.1f} {recall_at_k(found, expected):>10.3f} "
+              f"{recall_at_k(reranked, expected):>8.3f} {elapsed:>9.3f}")
@@ -0,0 +1,327 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from benchmarks.ann_recall import recall_at_k
+from benchmarks.synthetic import make_gallery
+from data.ann_backends import create_backend, save_backend
+from data.embedding_index import EmbeddingIndex
+from similarity_models.absolute_difference import absolute_difference
+from similarity_models.correlation_coefficient import correlation_coefficient
+from similarity_models.cosine_similarity import cosine_similarity
+from similarity_models.mean_square_difference import mean_square_difference
+
+# The original per-query scoring functions are the ground truth every optimized path is checked against
+REFERENCES = {
+    'cosine': (cosine_similarity, True),
+    'pearson': (correlation_coefficient, True),
+    'l2': (mean_square_difference, False),
+    'l1': (absolute_difference, False),
+}
+
+
+def reference_neighbours(metric, gallery, queries, k):
+    function, higher_is_better = REFERENCES[metric]
+    neighbours = []
+    for query in queries:
+        scores = function(query, gallery)
+        neighbours.append(np.argsort(-scores if higher_is_better else scores, kind='stable')[:k])
+    return np.array(neighbours)
+
+
+def latency_summary(seconds, items_per_call=1):
+    milliseconds = np.asarray(seconds) * 1000
+    return {
+        'calls': len(milliseconds),
+        'p50_ms': float(np.percentile(milliseconds, 50)),
+        'p95_ms': float(np.percentile(milliseconds, 95)),
+        'p99_ms': float(np.percentile(milliseconds, 99)),
+        'mean_ms': float(milliseconds.mean()),
+        'queries_per_second': float(items_per_call * len(milliseconds) / (milliseconds.sum() / 1000)),
+    }
+
+
+def directory_size(directory):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(directory) for name in names)
+
+
+def timed_and_traced(function):
+    """
+    Run function twice: once timed, once under tracemalloc, whose hooks would skew the timing.
+
+    Returns:
+    tuple: (result of the timed run, seconds, peak bytes allocated during the traced run).
+    """
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+def measure_queries(index, queries, k, metric, batch_size, expected):
+    """Single-query and batched latency of index.search_batch, plus recall@k on the reference queries."""
+    single = []
+    found = []
+    for query in queries:
+        start = time.perf_counter()
+        results = index.search_batch(query[None, :], k, metric)
+        single.append(time.perf_counter() - start)
+        found.append(results[0])
+
+    batched = []
+    for start_row in range(0, len(queries) - batch_size + 1, batch_size):
+        start = time.perf_counter()
+        index.search_batch(queries[start_row:start_row + batch_size], k, metric)
+        batched.append(time.perf_counter() - start)
+
+    rows = {path: row for row, path in enumerate(index.paths)}
+    found = np.array([[rows[path] for path, _ in result] + [-1] * (k - len(result))
+                      for result in found[:len(expected)]])
+    return {
+        'single': latency_summary(single),
+        'batch': latency_summary(batched, batch_size) if batched else None,
+        f'recall@{k}': recall_at_k(found, expected),
+    }
+
+
+class StubReader:
+    """
+    Stands in for DataReader in EmbeddingIndex.sync: nothing is decoded or run through a model, each "image" is
+    the row of its file and its embedding is that row of the synthetic gallery.
+    """
+
+    def __init__(self, gallery, files_path):
+        self.gallery = gallery
+        self.rows = {path: row for row, path in enumerate(files_path)}
+
+    def iter_image_batches(self, files_path, size=(224, 224), batch_size=64, num_workers=4, prefetch=2):
+        for start in range(0, len(files_path), batch_size):
+            paths = np.array(files_path[start:start + batch_size])
+            yield paths, np.array([self.rows[path] for path in paths])
+
+    def get_batch_embeddings(self, images, batch_size=32):
+        return self.gallery[images]
+
+
+def write_files(gallery, directory, classes=10):
+    """One small file per gallery row, so sync stats and hashes real files."""
+    files_path = []
+    for row in range(len(gallery)):
+        path = os.path.join(directory, f'class_{row % classes}', f'{row}.jpg')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(row.to_bytes(8, 'little') * 64)
+        files_path.append(path)
+    return files_path
+
+
+def bench_build(gallery, workdir, upsert_batch=1000):
+    """
+    Index maintenance with the model taken out: a full sync (stat, hash and stack every file), a rescan
+    with nothing changed, an ingest-style upsert in upsert_batch chunks, save and load.
+    """
+    files_path = write_files(gallery, os.path.join(workdir, 'gallery'))
+    reader = StubReader(gallery, files_path)
+
+    def sync():
+        index = EmbeddingIndex.empty()
+        index.sync(reader, files_path)
+        return index
+
+    index, sync_seconds, peak = timed_and_traced(sync)
+    start = time.perf_counter()
+    index.sync(reader, files_path)
+    rescan_seconds = time.perf_counter() - start
+
+    records = [dict(index.manifest[path]) for path in files_path]
+    upserted = EmbeddingIndex.empty()
+    start = time.perf_counter()
+    for chunk in range(0, len(gallery), upsert_batch):
+        upserted.upsert(files_path[chunk:chunk + upsert_batch], gallery[chunk:chunk + upsert_batch],
+                        records[chunk:chunk + upsert_batch])
+    upsert_seconds = time.perf_counter() - start
+
+    index_dir = os.path.join(workdir, 'index')
+    start = time.perf_counter()
+    index.save(index_dir)
+    save_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    loaded = EmbeddingIndex.load(index_dir)
+    # Touch the mapped tables a request would, so the first query does not pay for them
+    loaded.file_info(files_path[-1])
+    load_seconds = time.perf_counter() - start
+    return loaded, {
+        'sync_seconds': sync_seconds,
+        'rescan_seconds': rescan_seconds,
+        'upsert_seconds': upsert_seconds,
+        'save_seconds': save_seconds,
+        'load_seconds': load_seconds,
+        # A first build: sync then save
+        'vectors_per_second': len(gallery) / (sync_seconds + save_seconds),
+        'rescan_files_per_second': len(gallery) / rescan_seconds if rescan_seconds else None,
+        'upsert_vectors_per_second': len(gallery) / upsert_seconds if upsert_seconds else None,
+        'peak_build_bytes': peak,
+        'disk_bytes': directory_size(index_dir),
+        'bytes_per_vector': directory_size(index_dir) / len(gallery),
+    }
+
+
+def backend_configurations(args):
+    yield 'exact', {}
+    yield 'ivf', {'nprobe': args.nprobe}
+    yield 'sharded', {'nprobe': args.nprobe}
+    yield 'hnsw', {'ef_search': args.ef_search}
+    for storage in args.storage:
+        params = {'storage': storage, 'rerank': args.rerank}
+        if storage == 'pq':
+            # Product quantization splits every vector into equal pieces, so the count must divide --dim
+            params['n_subspaces'] = max(n for n in range(1, min(args.n_subspaces, args.dim) + 1) if args.dim % n == 0)
+        yield 'quantized', params
+
+
+def run(args):
+    results = []
+    for size in args.sizes:
+        gallery, _, queries, _ = make_gallery(size, dim=args.dim, n_queries=args.queries, seed=args.seed)
+        reference_queries = queries[:args.reference_queries]
+        print(f"Gallery of {size} vectors", file=sys.stderr)
+
+        with tempfile.TemporaryDirectory() as workdir:
+            index, build = bench_build(gallery, workdir, args.upsert_batch)
+            results.append({'size': size, 'kind': 'build', 'name': 'embedding_index', 'params': {}, **build})
+
+            expected = {}
+            for metric in args.metrics:
+                expected[metric] = reference_neighbours(metric, gallery, reference_queries, args.k)
+                # Warm the engine's cached matrices so the first timed query is not an outlier
+                index.search_batch(queries[:1], args.k, metric)
+                measured = measure_queries(index, queries, args.k, metric, args.batch_size, expected[metric])
+                results.append({'size': size, 'kind': 'metric', 'name': metric, 'params': {}, **measured})
+
+            for name, params in backend_configurations(args):
+                try:
+                    backend, seconds, peak = timed_and_traced(
+                        lambda: create_backend(name, **params).build(index.embeddings))
+                except (ImportError, ValueError) as e:
+                    # A missing optional library, or parameters the gallery does not allow
+                    results.append({'size': size, 'kind': 'backend', 'name': name, 'params': params,
+                                    'skipped': str(e)})
+                    continue
+                backend_dir = os.path.join(workdir, 'ann', f'{name}_{len(results)}')
+                save_backend(backend, backend_dir)
+                index.backend = backend
+                measured = measure_queries(index, queries, args.k, 'cosine', args.batch_size, expected['cosine'])
+                index.backend = None
+                results.append({'size': size, 'kind': 'backend', 'name': name, 'params': params,
+                                'build_seconds': seconds, 'vectors_per_second': size / seconds if seconds else None,
+                                'peak_build_bytes': peak, 'disk_bytes': directory_size(backend_dir), **measured})
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+
+def result_key(result):
+    return result['size'], result['kind'], result['name'], json.dumps(result['params'], sort_keys=True)
+
+
+# Build, rescan and upsert rates of the index, and build rate of each backend
+THROUGHPUTS = ('vectors_per_second', 'rescan_files_per_second', 'upsert_vectors_per_second')
+
+
+def compare(results, baseline, k, tolerance, recall_tolerance):
+    """
+    Regressions against a baseline run: p50 latency or one of THROUGHPUTS worse by more than tolerance
+    (a fraction), or recall@k lower by more than recall_tolerance.
+    """
+    previous = {result_key(result): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        old = previous.get(result_key(result))
+        if old is None or 'skipped' in result or 'skipped' in old:
+            continue
+        label = '/'.join(str(part) for part in result_key(result))
+        for mode in ('single', 'batch'):
+            if result.get(mode) and old.get(mode) and result[mode]['p50_ms'] > old[mode]['p50_ms'] * (1 + tolerance):
+                regressions.append(f"{label}: {mode} p50 {old[mode]['p50_ms']:.3f} -> {result[mode]['p50_ms']:.3f} ms")
+        recall = f'recall@{k}'
+        if recall in result and recall in old and result[recall] < old[recall] - recall_tolerance:
+            regressions.append(f"{label}: {recall} {old[recall]:.3f} -> {result[recall]:.3f}")
+        for key in THROUGHPUTS:
+            if result.get(key) and old.get(key) and result[key] < old[key] / (1 + tolerance):
+                regressions.append(f"{label}: {key} {old[key]:.0f} -> {result[key]:.0f}")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Latency, throughput, memory and recall of every scoring '
+                                                 'metric and index backend on synthetic galleries.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--dim', type=int, default=512)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--reference-queries', type=int, default=50,
+                        help='Queries scored with the original per-query functions for recall')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--upsert-batch', type=int, default=1000, help='Vectors per upsert call')
+    parser.add_argument('--metrics', nargs='+', default=sorted(REFERENCES), choices=sorted(REFERENCES))
+    parser.add_argument('--nprobe', type=int, default=8)
+    parser.add_argument('--ef-search', type=int, default=64)
+    parser.add_argument('--storage', nargs='+', default=['float16', 'int8', 'pq'])
+    parser.add_argument('--rerank', type=int, default=100)
+    parser.add_argument('--n-subspaces', type=int, default=64,
+                        help='Product quantization subspaces, lowered to the nearest divisor of --dim')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='Write the JSON results here instead of stdout')
+    parser.add_argument('--compare', default=None, help='Baseline JSON from an earlier run')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--recall-tolerance', type=float, default=0.01)
+    args = parser.parse_args()
+    if 'cosine' not in args.metrics:
+        # The backends are all scored against exact cosine
+        args.metrics.append('cosine')
+
+    results = run(args)
+    report = {'environment': environment(), 'args': vars(args), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            regressions = compare(results, json.load(file), args.k, args.tolerance, args.recall_tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,29 @@
+import numpy as np
+
+
+def make_gallery(n_images, dim=512, n_classes=60, n_queries=100, noise=0.6, seed=0):
+    """
+    Clustered unit vectors that stand in for CLIP embeddings, so no images or model are needed.
+
+    Parameters:
+    n_images (int): Number of gallery vectors.
+    dim (int): Embedding dimension.
+    n_classes (int): Number of clusters, like the class folders of data/processed.
+    n_queries (int): Number of query vectors drawn from the same clusters.
+    noise (float): Spread of each cluster around its centre.
+    seed (int): Random seed.
+
+    Returns:
+    tuple: (gallery (n_images, dim), gallery labels, queries (n_queries, dim), query labels), float32.
+    """
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(n_classes, dim)).astype(np.float32)
+
+    def sample(n):
+        labels = rng.integers(0, n_classes, size=n)
+        vectors = centres[labels] + noise * rng.normal(size=(n, dim)).astype(np.float32)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True), labels
+
+    gallery, gallery_labels = sample(n_images)
+    queries, query_labels = sample(n_queries)
+    return gallery, gallery_labels, queries, query_labels
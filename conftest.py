@@ -0,0 +1 @@
+# Lets `pytest` import the project packages from the repository root
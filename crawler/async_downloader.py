@@ -0,0 +1,206 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import tempfile
+from urllib.parse import urlparse
+
+import aiohttp
+
+from crawler.utils import HostRateLimiter, content_path, publish
+
+MANIFEST_FILE = 'manifest.jsonl'
+
+
+class AsyncImageDownloader:
+    def __init__(self, json_file, download_dir='data/raw', max_connections=64, max_per_host=8,
+                 min_interval=0.2, retries=3, backoff=0.5, timeout=30, chunk_size=1 << 16, dedup=None):
+        """
+        Parameters:
+        json_file (str): JSON written by UrlScraper.save_to_file, {category: {term: [urls]}}.
+        download_dir (str): Destination, relative to the project root.
+        max_connections (int): Concurrent downloads and size of the connection pool.
+        max_per_host (int): Open connections per host; connections are kept alive and reused.
+        min_interval (float): Minimum seconds between two requests to the same host.
+        retries (int): Extra attempts after a connection error, timeout, 429 or 5xx.
+        backoff (float): Base of the exponential backoff between attempts, in seconds.
+        timeout (float): Total timeout of one attempt, in seconds.
+        chunk_size (int): Bytes written to disk per chunk while streaming.
+        dedup (DuplicateDetector): Optional data.dedup.DuplicateDetector; downloads duplicating an image
+            already on disk are deleted and recorded in the manifest as duplicate_of that image.
+        """
+        current_file_directory = os.path.dirname(os.path.abspath(__file__))
+        project_root = os.path.abspath(os.path.join(current_file_directory, '..'))
+        self.json_file = json_file
+        self.download_dir = os.path.join(project_root, download_dir)
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.rate_limiter = HostRateLimiter(min_interval)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.dedup = dedup
+        self.manifest_path = os.path.join(self.download_dir, MANIFEST_FILE)
+        self.filename = set()
+        os.makedirs(self.download_dir, exist_ok=True)
+
+    def read_json(self):
+        with open(self.json_file, 'r') as file:
+            return json.load(file)
+
+    def read_manifest(self):
+        """
+        Read the URLs already downloaded by earlier runs.
+
+        Returns:
+        dict: url -> manifest record, for records whose file (or the file it duplicates) still exists.
+        """
+        completed = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A crash can leave a truncated last line
+                        continue
+                    if os.path.exists(record.get('duplicate_of', record['path'])):
+                        completed[record['url']] = record
+        return completed
+
+    def target_dir(self, category, term):
+        return os.path.join(self.download_dir, category, term)
+
+    async def fetch(self, session, url, directory):
+        """
+        Download url into directory with one request, retrying transient failures.
+
+        The body is streamed to a private temporary file and then stored under its content hash, so
+        concurrent downloads of URLs sharing a basename never write to or replace each other's file.
+
+        Returns:
+        dict: Manifest record of the file, or None if the URL is not a downloadable image. When the same
+        bytes were already stored, the record has duplicate_of set to that file.
+        """
+        host = urlparse(url).netloc
+        for attempt in range(self.retries + 1):
+            await self.rate_limiter.wait(host)
+            tmp_path = None
+            try:
+                async with session.get(url) as response:
+                    if response.status == 429 or response.status >= 500:
+                        raise aiohttp.ClientResponseError(response.request_info, response.history,
+                                                          status=response.status)
+                    if response.status != 200 or not response.content_type.startswith('image'):
+                        return None
+                    os.makedirs(directory, exist_ok=True)
+                    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+                    digest = hashlib.sha256()
+                    size = 0
+                    with os.fdopen(fd, 'wb') as file:
+                        async for chunk in response.content.iter_chunked(self.chunk_size):
+                            file.write(chunk)
+                            digest.update(chunk)
+                            size += len(chunk)
+                path = content_path(directory, digest.hexdigest(), url)
+                record = {'url': url, 'path': path, 'size': size, 'sha256': digest.hexdigest()}
+                if not publish(tmp_path, path):
+                    record['duplicate_of'] = path
+                return record
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(self.backoff * 2 ** attempt * (1 + random.random()))
+            finally:
+                if tmp_path is not None and os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    async def check_duplicate(self, record):
+        # The file was just created under its content hash, so no other URL owns it and it can be removed.
+        # Hashing decodes the image, so it runs off the event loop
+        duplicate_of, digest, phash = await asyncio.get_running_loop().run_in_executor(
+            None, self.dedup.claim_file, record['path'])
+        record.update(sha256=digest, phash=phash)
+        if duplicate_of is not None:
+            os.remove(record['path'])
+            record['duplicate_of'] = duplicate_of
+        return record
+
+    async def _worker(self, session, tasks, manifest, counts, pbar):
+        while True:
+            try:
+                url, category, term = tasks.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                record = await self.fetch(session, url, self.target_dir(category, term))
+                if record is not None and self.dedup is not None and 'duplicate_of' not in record:
+                    record = await self.check_duplicate(record)
+            except Exception as e:
+                record = None
+                print(f"Failed to download {url}: {e}")
+                counts['failed'] += 1
+            else:
+                counts['invalid' if record is None else 'duplicate' if 'duplicate_of' in record else 'downloaded'] += 1
+            if record is not None:
+                if 'duplicate_of' not in record:
+                    self.filename.add(record['path'])
+                manifest.write(json.dumps(record) + '\n')
+                manifest.flush()
+            pbar.update(1)
+
+    async def download_images(self):
+        """
+        Download every URL of the JSON file that is not in the manifest yet.
+
+        Returns:
+        dict: Number of 'downloaded', 'skipped', 'duplicate', 'invalid' and 'failed' URLs.
+        """
+        from tqdm import tqdm
+
+        data = self.read_json()
+        completed = self.read_manifest()
+        self.filename.update(record['path'] for record in completed.values() if 'duplicate_of' not in record)
+        if self.dedup is not None:
+            from data.dedup import backfill_hashes
+            from data.embedding_index import file_sha256
+
+            # Files from runs without dedup are hashed now, so new downloads are checked against them too
+            stored = [record for record in completed.values() if 'duplicate_of' not in record]
+            for record in stored:
+                if 'sha256' not in record:
+                    record['sha256'] = file_sha256(record['path'])
+            if self.dedup.max_distance is not None:
+                backfill_hashes(stored)
+            for record in stored:
+                self.dedup.add(record['path'], record['sha256'], record.get('phash'))
+
+        tasks = asyncio.Queue()
+        counts = {'downloaded': 0, 'skipped': 0, 'duplicate': 0, 'invalid': 0, 'failed': 0}
+        for category, terms in data.items():
+            for term, urls in terms.items():
+                for url in urls:
+                    if url in completed:
+                        counts['skipped'] += 1
+                    else:
+                        tasks.put_nowait((url, category, term))
+
+        connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.max_per_host)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        with open(self.manifest_path, 'a') as manifest, tqdm(total=tasks.qsize(), desc="Downloading images") as pbar:
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+                await asyncio.gather(*(self._worker(session, tasks, manifest, counts, pbar)
+                                       for _ in range(self.max_connections)))
+
+        self.export_filename()
+        return counts
+
+    def run(self):
+        return asyncio.run(self.download_images())
+
+    def export_filename(self):
+        with open('filename.txt', 'w') as file:
+            for filename in sorted(self.filename):
+                file.write(f"{filename}\n")
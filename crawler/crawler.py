@@ -1,24 +1,125 @@
 import concurrent.futures
+import contextlib
 import json
 import os
-import time
+import queue
+import threading
 from urllib.parse import urljoin
 
-from bs4 import BeautifulSoup
 from tqdm import tqdm
 
 from selenium import webdriver
+from selenium.common.exceptions import TimeoutException, WebDriverException
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
+
+# The <img> nodes whose src has not been read yet. The marker holds the src it was read at, so a node is read
+# again once lazy loading swaps its placeholder (a data: URI or a spacer gif, which are never returned) for the
+# real image, and is otherwise read once however long the page gets.
+UNREAD_IMAGES = """Array.from(document.querySelectorAll('img[src]')).filter(image => {
+    const src = image.getAttribute('src');
+    return src && !/^data:/i.test(src) && !/(^|\\/)(spacer|blank|pixel|transparent)\\.gif$/i.test(src)
+        && image.getAttribute('data-scraped') !== src;
+})"""
+# Returns the src of every unread <img> and marks it as read at that src
+NEW_IMAGES_SCRIPT = f"""
+const images = {UNREAD_IMAGES};
+images.forEach(image => image.setAttribute('data-scraped', image.getAttribute('src')));
+return images.map(image => image.getAttribute('src'));
+"""
+PENDING_IMAGES_SCRIPT = f"return {UNREAD_IMAGES}.length;"
+PAGE_HEIGHT_SCRIPT = "return document.body.scrollHeight;"
+
+SKIPPED_URLS = {"https://combo.staticflickr.com/ap/build/images/getty/IStock_corporate_logo.svg"}
+
+
+class DriverPool:
+    """
+    Headless Chrome instances shared between threads. A driver is started on first demand, handed back
+    after each use and reused for the next search term; a driver that failed is quit and replaced.
+    """
+
+    def __init__(self, size=4):
+        self.size = size
+        self._idle = queue.Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _create(self):
+        options = webdriver.ChromeOptions()
+        options.add_argument('--headless')
+        options.add_argument('--no-sandbox')
+        options.add_argument('--disable-dev-shm-usage')
+        return webdriver.Chrome(options=options)
+
+    def _acquire(self):
+        while True:
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            if create:
+                try:
+                    return self._create()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            try:
+                return self._idle.get(timeout=1)
+            except queue.Empty:
+                # A driver may have been discarded meanwhile, leaving room to start a new one
+                continue
+
+    def _discard(self, driver):
+        with self._lock:
+            self._created -= 1
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+    @contextlib.contextmanager
+    def driver(self):
+        driver = self._acquire()
+        healthy = True
+        try:
+            yield driver
+        except WebDriverException:
+            # The browser may be in a bad state, so it is not given to the next term
+            healthy = False
+            raise
+        finally:
+            if healthy:
+                self._idle.put(driver)
+            else:
+                self._discard(driver)
+
+    def close(self):
+        while True:
+            try:
+                driver = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(driver)
 
 
 class UrlScraper:
     # Constructor
-    def __init__(self, url_template, max_images=50, max_workers=4):
+    def __init__(self, url_template, max_images=50, max_workers=4,
+                 load_more_xpath="//button[contains(translate(., 'MORE', 'more'), 'more')]",
+                 load_timeout=10, poll_frequency=0.2):
         self.url_template = url_template  # Link crawl
         self.max_images = max_images  # Max images
         self.max_workers = max_workers  # Thread
+        self.load_more_xpath = load_more_xpath  # "Load more" button clicked when present, otherwise the page is scrolled
+        self.load_timeout = load_timeout  # Longest wait for new images after a click or scroll
+        self.poll_frequency = poll_frequency  # How often the page is checked while waiting
+        self.driver_pool = DriverPool(max_workers)  # One browser per thread, reused across terms
         self.setup_environment()  # Call for set up environment
 
     # Set up environment for selenium
@@ -26,6 +127,34 @@ class UrlScraper:
         os.environ['PATH'] += ':/usr/lib/chromium-browser/'
         os.environ['PATH'] += ':/usr/lib/chromium-browser/chromedriver/'
 
+    @staticmethod
+    def normalize_url(url, src):
+        img_path = urljoin(url, src)
+        return img_path.replace("_m.jpg", "_b.jpg").replace("_n.jpg", "_b.jpg").replace("_w.jpg", "_b.jpg")
+
+    def load_more(self, driver):
+        """
+        Ask the page for more images and wait until some arrive.
+
+        Returns:
+        bool: False when nothing new appeared within load_timeout seconds.
+        """
+        height = driver.execute_script(PAGE_HEIGHT_SCRIPT)
+        buttons = [button for button in driver.find_elements(By.XPATH, self.load_more_xpath) if button.is_displayed()]
+        try:
+            buttons[0].click()
+        except (IndexError, WebDriverException):
+            # No button, or it is covered or went stale: fall back to scrolling
+            driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
+        try:
+            # Returns as soon as new images or more page show up instead of sleeping a fixed time
+            WebDriverWait(driver, self.load_timeout, poll_frequency=self.poll_frequency).until(
+                lambda d: d.execute_script(PENDING_IMAGES_SCRIPT) > 0 or d.execute_script(PAGE_HEIGHT_SCRIPT) > height
+            )
+            return True
+        except TimeoutException:
+            return False
+
     def get_url_images(self, term):
         """
         Crawl the urls of images by term
@@ -36,58 +165,27 @@ class UrlScraper:
         Returns:
         urls (list): List of urls of images
         """
-
-        # Initialize Chrome driver
-        options = webdriver.ChromeOptions()
-        options.add_argument('--headless')
-        options.add_argument('--no-sandbox')
-        options.add_argument('--disable-dev-shm-usage')
-        driver = webdriver.Chrome(options=options)
-
         url = self.url_template.format(search_term=term)
-        driver.get(url)
-
-        # Start crawl urls of image like brute force - the same mechanism with this but add some feature
         urls = []
-        more_content_available = True
-
-        pbar = tqdm(total=self.max_images, desc=f"Fetching images for {term}")  # Set up for visualize progress
-
-        while len(urls) < self.max_images and more_content_available:
-            soup = BeautifulSoup(driver.page_source, "html.parser")
-            img_tags = soup.find_all("img")
-
-            for img in img_tags:
-                if len(urls) >= self.max_images:
-                    break
-                if 'src' in img.attrs:
-                    href = img.attrs['src']
-                    img_path = urljoin(url, href)
-                    img_path = img_path.replace("_m.jpg", "_b.jpg").replace("_n.jpg", "_b.jpg").replace("_w.jpg",
-                                                                                                        "_b.jpg")
-                    if img_path == "https://combo.staticflickr.com/ap/build/images/getty/IStock_corporate_logo.svg":
+        seen = set(SKIPPED_URLS)
+
+        with self.driver_pool.driver() as driver, \
+                tqdm(total=self.max_images, desc=f"Fetching images for {term}") as pbar:
+            driver.get(url)
+            more_content_available = True
+            while len(urls) < self.max_images and more_content_available:
+                # Only the <img> nodes added since the last round are read
+                for src in driver.execute_script(NEW_IMAGES_SCRIPT):
+                    img_path = self.normalize_url(url, src)
+                    if img_path in seen:
                         continue
+                    seen.add(img_path)
                     urls.append(img_path)
                     pbar.update(1)
-
-            try:
-                load_more_button = WebDriverWait(driver, 10).until(
-                    EC.element_to_be_clickable((By.XPATH, '//button[@id="yui_3_16_0_1_1721642285931_28620"]'))
-                )
-                load_more_button.click()
-                time.sleep(2)
-            except:
-                driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-                time.sleep(2)
-
-                new_soup = BeautifulSoup(driver.page_source, "html.parser")
-                new_img_tags = new_soup.find_all("img", loading_="lazy")
-                if len(new_img_tags) == len(img_tags):
-                    more_content_available = False
-                img_tags = new_img_tags
-
-        pbar.close()
-        driver.quit()
+                    if len(urls) >= self.max_images:
+                        break
+                if len(urls) < self.max_images:
+                    more_content_available = self.load_more(driver)
         return urls
 
     def scrape_urls(self, categories):
@@ -103,19 +201,22 @@ class UrlScraper:
         all_urls = {category: {} for category in categories}
 
         # Handle multi-threading for efficent installation
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            future_to_term = {executor.submit(self.get_url_images, term): (category, term)
-                              for category, terms in categories.items() for term in terms}
-
-            for future in tqdm(concurrent.futures.as_completed(future_to_term), total=len(future_to_term),
-                               desc="Overall Progress"):
-                category, term = future_to_term[future]
-                try:
-                    urls = future.result()
-                    all_urls[category][term] = urls
-                    print(f"\nNumber of images retrieved for {term}: {len(urls)}")
-                except Exception as exc:
-                    print(f"\n{term} generated an exception: {exc}")
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                future_to_term = {executor.submit(self.get_url_images, term): (category, term)
+                                  for category, terms in categories.items() for term in terms}
+
+                for future in tqdm(concurrent.futures.as_completed(future_to_term), total=len(future_to_term),
+                                   desc="Overall Progress"):
+                    category, term = future_to_term[future]
+                    try:
+                        urls = future.result()
+                        all_urls[category][term] = urls
+                        print(f"\nNumber of images retrieved for {term}: {len(urls)}")
+                    except Exception as exc:
+                        print(f"\n{term} generated an exception: {exc}")
+        finally:
+            self.driver_pool.close()
         return all_urls
 
     def save_to_file(self, data, filename):
@@ -131,4 +232,4 @@ class UrlScraper:
         """
         with open(filename, 'w') as file:
             json.dump(data, file, indent=4)
-        print(f"Data saved to {filename}")
\ No newline at end of file
+        print(f"Data saved to {filename}")
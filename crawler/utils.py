@@ -1,5 +1,9 @@
+import asyncio
+import hashlib
 import os
 import json
+import tempfile
+import threading
 import urllib.request
 from urllib.parse import urlparse
 import time
@@ -7,14 +11,72 @@ from tqdm import tqdm
 import concurrent.futures
 
 
+def content_path(directory, digest, url):
+    """
+    Where a download is stored: named after its content hash, so two URLs sharing a basename never share a file.
+    """
+    extension = os.path.splitext(urlparse(url).path)[1].lower() or '.jpg'
+    return os.path.join(directory, f'{digest[:16]}{extension}')
+
+
+def publish(temp_path, path):
+    """
+    Move a finished download from temp_path to path, never replacing a file that is already there.
+
+    Returns:
+    bool: True if path was created, False if a file with the same content was already stored there.
+    """
+    try:
+        # Unlike os.replace, link fails when the target exists, so concurrent writers cannot clobber each other
+        os.link(temp_path, path)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(temp_path)
+
+
+class HostRateLimiter:
+    """
+    Spaces out requests to the same host by at least min_interval seconds, independently per host.
+
+    Slots are reserved under a lock, so one limiter can be shared by threads as well as by coroutines.
+    """
+
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self._next_slot = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, host):
+        """Take the next slot of host and return how many seconds remain until it."""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.min_interval
+        return slot - now
+
+    async def wait(self, host):
+        delay = self.reserve(host)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def sleep(self, host):
+        delay = self.reserve(host)
+        if delay > 0:
+            time.sleep(delay)
+
+
 class ImageDownloader:
-    def __init__(self, json_file, download_dir='data/raw', max_workers=4, delay=1):
+    def __init__(self, json_file, download_dir='data/raw', max_workers=4, delay=1, dedup=None):
         current_file_directory = os.path.dirname(os.path.abspath(__file__))
         project_root = os.path.abspath(os.path.join(current_file_directory, '..'))
         self.json_file = json_file
         self.download_dir = os.path.join(project_root, download_dir)
         self.max_workers = max_workers
         self.delay = delay
+        # Optional data.dedup.DuplicateDetector; duplicates of an image already downloaded are deleted
+        self.dedup = dedup
         self.filename = set()
         self.setup_directory()
 
@@ -33,23 +95,6 @@ class ImageDownloader:
             data = json.load(file)
         return data
 
-    def is_valid_url(self, url):
-        """
-        Check if the URL is valid.
-
-        Parameters:
-        url (str): The URL to be checked.
-
-        Returns:
-        bool: True if the URL is valid, False otherwise.
-        """
-        try:
-            with urllib.request.urlopen(url) as response:
-                if response.status == 200 and 'image' in response.info().get_content_type():
-                    return True
-        except Exception:
-            return False
-
     def download_image(self, url, category, term, pbar):
         """
         Download the image from the given URL.
@@ -63,10 +108,6 @@ class ImageDownloader:
         Returns:
         str: A message indicating the status of the download.
         """
-        if not self.is_valid_url(url):
-            pbar.update(1)
-            return f"Invalid URL: {url}"
-
         category_dir = os.path.join(self.download_dir, category)
         if not os.path.exists(category_dir):
             os.makedirs(category_dir)
@@ -75,12 +116,35 @@ class ImageDownloader:
         if not os.path.exists(term_dir):
             os.makedirs(term_dir)
 
-        filename = os.path.join(term_dir, os.path.basename(urlparse(url).path))
-
-        self.filename.add(filename)  # Record the filename directory
-
+        # One request both validates and downloads the image, streaming it to a private temporary file
+        # that is then stored under its content hash, so URLs sharing a basename never overwrite each other
         try:
-            urllib.request.urlretrieve(url, filename)
+            with urllib.request.urlopen(url) as response:
+                if response.status != 200 or 'image' not in response.info().get_content_type():
+                    pbar.update(1)
+                    return f"Invalid URL: {url}"
+                fd, temp_path = tempfile.mkstemp(dir=term_dir, suffix='.part')
+                digest = hashlib.sha256()
+                try:
+                    with os.fdopen(fd, 'wb') as file:
+                        for chunk in iter(lambda: response.read(1 << 16), b''):
+                            file.write(chunk)
+                            digest.update(chunk)
+                except BaseException:
+                    os.remove(temp_path)
+                    raise
+            filename = content_path(term_dir, digest.hexdigest(), url)
+            if not publish(temp_path, filename):
+                pbar.update(1)
+                return f"Duplicate of {filename}: {url}"
+            if self.dedup is not None:
+                # Only this URL owns the file it just created, so removing it cannot lose another download
+                duplicate_of, _, _ = self.dedup.claim_file(filename)
+                if duplicate_of is not None:
+                    os.remove(filename)
+                    pbar.update(1)
+                    return f"Duplicate of {duplicate_of}: {url}"
+            self.filename.add(filename)  # Record the filename directory
             pbar.update(1)
             return f"Downloaded: {url}"
         except Exception as e:
@@ -0,0 +1,494 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import shutil
+
+import numpy as np
+
+from data.embedding_index import ANN_DIR, EmbeddingIndex, EMBEDDINGS_FILE
+from data.quantization import CODECS, QuantizedStore
+from similarity_models.scoring_engine import ScoringEngine, top_k_indices, normalize
+
+PARAMS_FILE = 'params.json'
+
+
+def backend_dir(version_dir, name):
+    """Backends are stored inside the index version they were built from, so they are swapped together."""
+    return os.path.join(version_dir, ANN_DIR, name)
+
+
+def _save_arrays(directory, arrays):
+    for key, value in arrays.items():
+        np.save(os.path.join(directory, f'{key}.npy'), value)
+
+
+def _load_arrays(directory, prefix=''):
+    # Memory mapped read-only, so server workers share one copy through the page cache
+    return {name[len(prefix):-4]: np.load(os.path.join(directory, name), mmap_mode='r')
+            for name in sorted(os.listdir(directory)) if name.startswith(prefix) and name.endswith('.npy')}
+
+
+class BruteForceBackend:
+    """Exact search over the full matrix, the reference the approximate backends are measured against."""
+    name = 'exact'
+
+    def __init__(self, metric='cosine'):
+        self.metric = metric
+        self.engine = None
+
+    def params(self):
+        return {'metric': self.metric}
+
+    def build(self, embeddings):
+        self.engine = ScoringEngine(embeddings)
+        return self
+
+    def search(self, queries, k=10):
+        return self.engine.top_k(np.atleast_2d(queries), k, self.metric)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'embeddings.npy'), self.engine.embeddings)
+
+    def load(self, directory):
+        self.engine = ScoringEngine(np.load(os.path.join(directory, 'embeddings.npy'), mmap_mode='r'))
+        return self
+
+
+class HNSWBackend:
+    """
+    Graph index from hnswlib, the library Chroma's HNSW collections are built on.
+    Unlike the other backends it is read into each process rather than memory mapped.
+    """
+    name = 'hnsw'
+
+    def __init__(self, M=16, ef_construction=200, ef_search=64, num_threads=-1):
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.num_threads = num_threads
+        self.index = None
+
+    def params(self):
+        return {'M': self.M, 'ef_construction': self.ef_construction, 'ef_search': self.ef_search}
+
+    def set_ef_search(self, ef_search):
+        self.ef_search = ef_search
+        if self.index is not None:
+            self.index.set_ef(ef_search)
+
+    def build(self, embeddings):
+        import hnswlib
+
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        self.index = hnswlib.Index(space='cosine', dim=embeddings.shape[1])
+        self.index.init_index(max_elements=len(embeddings), ef_construction=self.ef_construction, M=self.M)
+        self.index.add_items(embeddings, np.arange(len(embeddings)), num_threads=self.num_threads)
+        self.index.set_ef(self.ef_search)
+        return self
+
+    def search(self, queries, k=10):
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        k = min(k, self.index.get_current_count())
+        # ef below k makes hnswlib fail to return k neighbours
+        self.index.set_ef(max(self.ef_search, k))
+        labels, distances = self.index.knn_query(queries, k=k, num_threads=self.num_threads)
+        return labels.astype(np.int64), 1 - distances
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.index.save_index(os.path.join(directory, 'hnsw.bin'))
+        with open(os.path.join(directory, 'hnsw.json'), 'w') as file:
+            json.dump({'dim': self.index.dim, 'count': self.index.get_current_count()}, file)
+
+    def load(self, directory):
+        import hnswlib
+
+        with open(os.path.join(directory, 'hnsw.json'), 'r') as file:
+            meta = json.load(file)
+        self.index = hnswlib.Index(space='cosine', dim=meta['dim'])
+        self.index.load_index(os.path.join(directory, 'hnsw.bin'), max_elements=meta['count'])
+        self.index.set_ef(self.ef_search)
+        return self
+
+
+def _nearest_centroids(data, centroids, chunk_size=65536):
+    assign = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), chunk_size):
+        assign[start:start + chunk_size] = np.argmax(data[start:start + chunk_size] @ centroids.T, axis=1)
+    return assign
+
+
+def spherical_kmeans(data, n_clusters, n_iter=20, seed=0):
+    """
+    K-means on unit vectors, with centroids renormalized after every update.
+
+    Parameters:
+    data (np.ndarray): (n, dim) normalized vectors.
+    n_clusters (int): Number of centroids.
+    n_iter (int): Number of Lloyd iterations.
+    seed (int): Seed of the initial centroid sample.
+
+    Returns:
+    np.ndarray: (n_clusters, dim) normalized centroids.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = _nearest_centroids(data, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, data)
+        counts = np.bincount(assign, minlength=n_clusters)
+        # Empty clusters keep their previous centroid
+        sums[counts == 0] = centroids[counts == 0]
+        centroids = normalize(sums)
+    return centroids
+
+
+class IVFBackend:
+    """Inverted file index: vectors are bucketed by nearest k-means centroid and only nprobe buckets are scanned."""
+    name = 'ivf'
+
+    def __init__(self, n_lists=None, nprobe=8, n_iter=20, train_size=65536, seed=0):
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.n_iter = n_iter
+        self.train_size = train_size
+        self.seed = seed
+        self.centroids = None
+        self.normalized = None
+        self.list_offsets = None
+        self.list_ids = None
+
+    def params(self):
+        return {'n_lists': self.n_lists, 'nprobe': self.nprobe}
+
+    def build(self, embeddings):
+        self.normalized = normalize(np.ascontiguousarray(embeddings, dtype=np.float32))
+        if self.n_lists is None:
+            self.n_lists = max(1, int(np.sqrt(len(self.normalized))))
+        self.n_lists = min(self.n_lists, len(self.normalized))
+
+        rng = np.random.default_rng(self.seed)
+        sample = self.normalized
+        if len(sample) > self.train_size:
+            sample = sample[np.sort(rng.choice(len(sample), self.train_size, replace=False))]
+        self.centroids = spherical_kmeans(sample, self.n_lists, self.n_iter, self.seed)
+
+        # Lists are stored CSR style: ids sorted by list, plus the offset where each list starts
+        assign = _nearest_centroids(self.normalized, self.centroids)
+        self.list_ids = np.argsort(assign, kind='stable')
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=self.n_lists))])
+        return self
+
+    def search(self, queries, k=10):
+        queries = normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        nprobe = min(self.nprobe, self.n_lists)
+        probes = top_k_indices(queries @ self.centroids.T, nprobe)
+        k = min(k, len(self.normalized))
+        # Rows are padded with -1 when the probed lists hold fewer than k vectors
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for row, (query, lists) in enumerate(zip(queries, probes)):
+            candidates = np.concatenate([self.list_ids[self.list_offsets[i]:self.list_offsets[i + 1]] for i in lists])
+            candidate_scores = self.normalized[candidates] @ query
+            top = top_k_indices(candidate_scores[None, :], k)[0]
+            indices[row, :len(top)] = candidates[top]
+            scores[row, :len(top)] = candidate_scores[top]
+        return indices, scores
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        _save_arrays(directory, {'centroids': self.centroids, 'normalized': self.normalized,
+                                 'list_offsets': self.list_offsets, 'list_ids': self.list_ids})
+
+    def load(self, directory):
+        arrays = _load_arrays(directory)
+        self.centroids = np.asarray(arrays['centroids'])
+        self.normalized = arrays['normalized']
+        self.list_offsets = arrays['list_offsets']
+        self.list_ids = arrays['list_ids']
+        self.n_lists = len(self.centroids)
+        return self
+
+
+class ShardedBackend:
+    """
+    One shard per gallery class (or per k-means cluster when there are no labels), each with a stored centroid.
+
+    A query scores the centroids first and only searches its nprobe closest shards. Each shard's vectors are
+    stored contiguously, so a shard is one matrix product, and the shards run in parallel on a thread pool
+    (the products release the GIL). An optional class filter restricts the search to the named shards.
+    """
+    name = 'sharded'
+
+    def __init__(self, nprobe=8, workers=None, n_shards=None, by_class=False, n_iter=20, train_size=65536, seed=0):
+        self.nprobe = nprobe
+        self.workers = workers or os.cpu_count() or 1
+        self.n_shards = n_shards
+        # Whether shards are gallery classes, so a class filter can be answered by picking shards
+        self.by_class = by_class
+        self.n_iter = n_iter
+        self.train_size = train_size
+        self.seed = seed
+        self.centroids = None
+        self.normalized = None
+        self.shard_offsets = None
+        self.shard_ids = None
+        self.shard_names = None
+        self._executor = None
+        self._executor_pid = None
+
+    def params(self):
+        return {'nprobe': self.nprobe, 'n_shards': self.n_shards, 'by_class': self.by_class}
+
+    def build(self, embeddings, labels=None):
+        """
+        Parameters:
+        embeddings (np.ndarray): (n, dim) gallery embeddings.
+        labels (list): Optional class name per row; rows are clustered with spherical k-means when None.
+        """
+        normalized = normalize(np.ascontiguousarray(embeddings, dtype=np.float32))
+        if labels is not None:
+            self.shard_names, assign = np.unique(np.asarray(labels, dtype=str), return_inverse=True)
+            self.shard_names = self.shard_names.tolist()
+            self.n_shards = len(self.shard_names)
+            self.by_class = True
+        else:
+            if self.n_shards is None:
+                self.n_shards = max(1, int(np.sqrt(len(normalized))))
+            self.n_shards = min(self.n_shards, len(normalized))
+            rng = np.random.default_rng(self.seed)
+            sample = normalized
+            if len(sample) > self.train_size:
+                sample = sample[np.sort(rng.choice(len(sample), self.train_size, replace=False))]
+            assign = _nearest_centroids(normalized, spherical_kmeans(sample, self.n_shards, self.n_iter, self.seed))
+            self.shard_names = [f'cluster_{i}' for i in range(self.n_shards)]
+            self.by_class = False
+
+        # Rows are reordered so every shard is a contiguous slice; shard_ids maps them back to gallery rows
+        self.shard_ids = np.argsort(assign, kind='stable')
+        self.shard_offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=self.n_shards))])
+        self.normalized = normalized[self.shard_ids]
+        sums = np.zeros((self.n_shards, normalized.shape[1]), dtype=np.float32)
+        np.add.at(sums, assign, normalized)
+        self.centroids = normalize(sums)
+        return self
+
+    def _pool(self):
+        # Threads do not survive fork, so each server worker builds its own pool on first use
+        if self._executor_pid != os.getpid():
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def _search_shard(self, shard, queries, rows, k):
+        start, stop = self.shard_offsets[shard], self.shard_offsets[shard + 1]
+        scores = queries[rows] @ self.normalized[start:stop].T
+        top = top_k_indices(scores, k)
+        return rows, self.shard_ids[start:stop][top], np.take_along_axis(scores, top, axis=1)
+
+    def search(self, queries, k=10, classes=None):
+        """
+        Parameters:
+        queries (np.ndarray): (n_queries, dim) or (dim,) queries.
+        k (int): Number of results per query.
+        classes (list): Optional shard names to restrict the search to.
+
+        Returns:
+        tuple: (indices, scores), (n_queries, k) each, padded with -1 when fewer vectors were searched.
+        """
+        queries = normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        centroid_scores = queries @ self.centroids.T
+        n_allowed = self.n_shards
+        if classes is not None:
+            allowed = np.isin(self.shard_names, list(classes))
+            centroid_scores[:, ~allowed] = -np.inf
+            n_allowed = int(allowed.sum())
+        probes = top_k_indices(centroid_scores, min(self.nprobe, n_allowed))
+
+        # Queries are grouped by shard, so each probed shard is scanned once for all the queries probing it
+        shard_rows = {}
+        for row, shards in enumerate(probes):
+            for shard in shards:
+                shard_rows.setdefault(int(shard), []).append(row)
+        jobs = [(shard, queries, np.array(rows), k) for shard, rows in shard_rows.items()]
+        if len(jobs) > 1 and self.workers > 1:
+            results = list(self._pool().map(lambda job: self._search_shard(*job), jobs))
+        else:
+            results = [self._search_shard(*job) for job in jobs]
+
+        width = max(probes.shape[1], 1) * k
+        candidate_ids = np.full((len(queries), width), -1, dtype=np.int64)
+        candidate_scores = np.full((len(queries), width), -np.inf, dtype=np.float32)
+        filled = np.zeros(len(queries), dtype=np.int64)
+        for rows, ids, scores in results:
+            for row, row_ids, row_scores in zip(rows, ids, scores):
+                candidate_ids[row, filled[row]:filled[row] + len(row_ids)] = row_ids
+                candidate_scores[row, filled[row]:filled[row] + len(row_ids)] = row_scores
+                filled[row] += len(row_ids)
+        top = top_k_indices(candidate_scores, k)
+        indices = np.take_along_axis(candidate_ids, top, axis=1)
+        scores = np.take_along_axis(candidate_scores, top, axis=1)
+        indices[~np.isfinite(scores)] = -1
+        return indices, scores
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        _save_arrays(directory, {'centroids': self.centroids, 'normalized': self.normalized,
+                                 'shard_offsets': self.shard_offsets, 'shard_ids': self.shard_ids})
+        with open(os.path.join(directory, 'shards.json'), 'w') as file:
+            json.dump(self.shard_names, file)
+
+    def load(self, directory):
+        arrays = _load_arrays(directory)
+        self.centroids = np.asarray(arrays['centroids'])
+        self.normalized = arrays['normalized']
+        self.shard_offsets = np.asarray(arrays['shard_offsets'])
+        self.shard_ids = arrays['shard_ids']
+        with open(os.path.join(directory, 'shards.json'), 'r') as file:
+            self.shard_names = json.load(file)
+        self.n_shards = len(self.shard_names)
+        return self
+
+
+class QuantizedBackend:
+    """Brute force over compressed vectors (float32, float16, int8 or pq) with an exact rerank stage."""
+    name = 'quantized'
+
+    def __init__(self, storage='int8', rerank=100, n_subspaces=64, full_precision_path=None):
+        self.storage = storage
+        self.rerank = rerank
+        self.n_subspaces = n_subspaces
+        # Full-precision rows for the rerank stage, memory mapped so they are read from disk on demand;
+        # defaults to the embeddings of the index version the backend is stored in
+        self.full_precision_path = full_precision_path
+        codec = CODECS[storage](n_subspaces=n_subspaces) if storage == 'pq' else CODECS[storage]()
+        self.store = QuantizedStore(codec, rerank)
+
+    def params(self):
+        return {'storage': self.storage, 'rerank': self.rerank, 'n_subspaces': self.n_subspaces}
+
+    def build(self, embeddings):
+        self.store.build(embeddings)
+        self.store.full_precision = embeddings
+        return self
+
+    def search(self, queries, k=10):
+        self.store.rerank = self.rerank
+        return self.store.search(queries, k)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        arrays = {f'data_{key}': value for key, value in self.store.data.items()}
+        arrays.update({f'state_{key}': value for key, value in self.store.codec.state().items()})
+        _save_arrays(directory, arrays)
+
+    def load(self, directory):
+        self.store.data = _load_arrays(directory, 'data_')
+        state = _load_arrays(directory, 'state_')
+        self.store.codec.load_state({key: np.asarray(value) for key, value in state.items()})
+        full_precision_path = self.full_precision_path or os.path.join(
+            os.path.dirname(os.path.dirname(os.path.abspath(directory))), EMBEDDINGS_FILE)
+        if self.rerank and os.path.exists(full_precision_path):
+            self.store.full_precision = np.load(full_precision_path, mmap_mode='r')
+        return self
+
+
+BACKENDS = {backend.name: backend
+            for backend in (BruteForceBackend, HNSWBackend, IVFBackend, ShardedBackend, QuantizedBackend)}
+
+
+def create_backend(name, **params):
+    """
+    Instantiate an ANN backend by name.
+
+    Parameters:
+    name (str): One of BACKENDS ('exact', 'hnsw', 'ivf', 'sharded', 'quantized').
+    params: Backend parameters such as ef_search or nprobe.
+
+    Returns:
+    object: An unbuilt backend.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown ANN backend {name}, expected one of {sorted(BACKENDS)}")
+    return BACKENDS[name](**params)
+
+
+def save_backend(backend, directory):
+    # Written aside and renamed into place, so a server watching the version never loads a half-written backend
+    tmp_dir = f'{directory}.tmp{os.getpid()}'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    backend.save(tmp_dir)
+    with open(os.path.join(tmp_dir, PARAMS_FILE), 'w') as file:
+        json.dump(backend.params(), file)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.rename(tmp_dir, directory)
+
+
+def build_backend(name, embedding_index, **params):
+    """
+    Build a backend over an EmbeddingIndex; a sharded backend with by_class gets one shard per gallery class.
+    """
+    backend = create_backend(name, **params)
+    if name == 'sharded' and backend.by_class:
+        return backend.build(embedding_index.embeddings, labels=embedding_index.labels)
+    return backend.build(embedding_index.embeddings)
+
+
+def carry_over_backends(embedding_index, previous_version_dir, version_dir):
+    """
+    Build on a new index version every backend the previous version has, with the parameters it was saved with.
+
+    Returns:
+    list: Names of the backends built.
+    """
+    source = os.path.join(previous_version_dir, ANN_DIR)
+    names = sorted(name for name in os.listdir(source) if name in BACKENDS) if os.path.isdir(source) else []
+    for name in names:
+        with open(os.path.join(source, name, PARAMS_FILE), 'r') as file:
+            params = json.load(file)
+        save_backend(build_backend(name, embedding_index, **params), backend_dir(version_dir, name))
+    return names
+
+
+def load_backend(name, directory, **params):
+    """
+    Load a saved backend; params override the search-time parameters it was saved with.
+    """
+    with open(os.path.join(directory, PARAMS_FILE), 'r') as file:
+        saved = json.load(file)
+    saved.update(params)
+    return create_backend(name, **saved).load(directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build an ANN backend over the saved embedding index.')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='hnsw')
+    parser.add_argument('--M', type=int, default=16)
+    parser.add_argument('--ef-construction', type=int, default=200)
+    parser.add_argument('--n-lists', type=int, default=None)
+    parser.add_argument('--storage', choices=sorted(CODECS), default='int8')
+    parser.add_argument('--n-subspaces', type=int, default=64)
+    parser.add_argument('--shard-by', choices=['class', 'cluster'], default='class',
+                        help='Sharded backend: one shard per gallery class or per k-means cluster')
+    parser.add_argument('--n-shards', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.backend == 'hnsw':
+        params = {'M': args.M, 'ef_construction': args.ef_construction}
+    elif args.backend == 'ivf':
+        params = {'n_lists': args.n_lists}
+    elif args.backend == 'quantized':
+        params = {'storage': args.storage, 'n_subspaces': args.n_subspaces}
+    elif args.backend == 'sharded':
+        params = {'n_shards': args.n_shards, 'by_class': args.shard_by == 'class'}
+    else:
+        params = {}
+
+    embedding_index = EmbeddingIndex.load()
+    backend = build_backend(args.backend, embedding_index, **params)
+    directory = backend_dir(embedding_index.directory, args.backend)
+    save_backend(backend, directory)
+    print(f"Built {args.backend} backend over {len(embedding_index)} images into {directory}")
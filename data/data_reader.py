@@ -1,31 +1,77 @@
+import concurrent.futures
+import itertools
+import logging
 import os
+from collections import deque
 
-import chromadb
-import matplotlib.pyplot as plt
 import numpy as np
 from PIL import Image
-from chromadb.utils.embedding_functions import OpenCLIPEmbeddingFunction
-from tqdm import tqdm
+
+from data import metrics, model_registry
 
 MODULE_DIR = os.path.dirname(__file__)
 
+logger = logging.getLogger(__name__)
+
 
 class DataReader:
-    def __init__(self, root):
+    def __init__(self, root, num_threads=None, persist_directory=None):
         self.root = os.path.join(MODULE_DIR, root)
         self.class_names = sorted(os.listdir(os.path.join(self.root, 'train')))
-        self.embedding_function = OpenCLIPEmbeddingFunction()
-        self.chroma_client = chromadb.Client()
+        self.num_threads = num_threads
+        self.persist_directory = persist_directory
+        self._embedding_function = None
+        self._chroma_client = None
         self.hnsw_space = "hnsw:space"
 
+    @property
+    def embedding_function(self):
+        # The model is loaded once per process and only when something is embedded
+        if self._embedding_function is None:
+            self._embedding_function = model_registry.get_embedding_function(self.num_threads)
+        return self._embedding_function
+
+    @property
+    def chroma_client(self):
+        if self._chroma_client is None:
+            import chromadb
+
+            if self.persist_directory is not None:
+                self._chroma_client = chromadb.PersistentClient(path=self.persist_directory)
+            else:
+                self._chroma_client = chromadb.Client()
+        return self._chroma_client
+
     def read_image_from_path(self, path, size):
         if not os.path.isabs(path):
             path = os.path.join(self.root, path)
         try:
-            im = Image.open(path).convert('RGB').resize(size)
-            return np.array(im)
+            with metrics.span('decode', source='path'):
+                im = Image.open(path).convert('RGB').resize(size)
+                return np.array(im)
         except Exception as e:
-            print(f"Error loading image {path}: {e}")
+            metrics.increment('image_read_failures_total', source='path')
+            logger.warning("Error loading image %s: %s", path, e)
+            return None
+
+    def open_image(self, path):
+        """Full-size RGB image, left for the model's own preprocessing, or None when it cannot be read."""
+        try:
+            with metrics.span('decode', source='path'), Image.open(path) as image:
+                return image.convert('RGB')
+        except Exception as e:
+            metrics.increment('image_read_failures_total', source='path')
+            logger.warning("Error loading image %s: %s", path, e)
+            return None
+
+    def read_image_from_file(self, file, size):
+        try:
+            with metrics.span('decode', source='upload'):
+                im = Image.open(file).convert('RGB').resize(size)
+                return np.array(im)
+        except Exception as e:
+            metrics.increment('image_read_failures_total', source='upload')
+            logger.warning("Error loading image %s: %s", getattr(file, 'filename', file), e)
             return None
 
     def get_files_path(self, path):
@@ -43,41 +89,101 @@ class DataReader:
 
     def get_single_image_embedding(self, image):
         try:
-            embedding = self.embedding_function._encode_image(image=image)
-            return np.array(embedding)
-        except Exception as e:
-            print(f"Error creating embedding: {e}")
+            with metrics.span('embed', mode='single'):
+                embedding = self.embedding_function._encode_image(image=image)
+                return np.asarray(embedding, dtype=np.float32)
+        except Exception:
+            metrics.increment('embedding_failures_total', mode='single')
+            logger.exception("Error creating embedding")
             return None
 
-    def folder_to_images(self, folder, size):
-        current_folder_path = os.path.join(self.root, 'train', folder)
-        list_dir = [os.path.join(current_folder_path, name) for name in os.listdir(current_folder_path)]
-        images_np = np.zeros(shape=(len(list_dir), *size, 3))
-        images_path = []
-        for i, path in enumerate(list_dir):
-            image = self.read_image_from_path(path, size)
-            if image is not None:
-                images_np[i] = image
-                images_path.append(path)
-        return images_np, np.array(images_path)
-
-    def add_embedding(self, collection, files_path):
+    def get_batch_embeddings(self, images, batch_size=32):
+        ef = self.embedding_function
+        batches = []
+        try:
+            for start in range(0, len(images), batch_size):
+                with metrics.span('embed_preprocess'):
+                    pixels = ef._torch.stack([
+                        ef._preprocess(image if isinstance(image, Image.Image) else Image.fromarray(image))
+                        for image in images[start:start + batch_size]
+                    ]).to(ef._device)
+                with metrics.span('embed_forward'), ef._torch.no_grad():
+                    features = ef._model.encode_image(pixels)
+                    features /= features.norm(dim=-1, keepdim=True)
+                batches.append(features.cpu().numpy())
+            return np.concatenate(batches)
+        except Exception:
+            metrics.increment('embedding_failures_total', mode='batch')
+            logger.exception("Error creating batch embeddings")
+            return None
+
+    def iter_image_batches(self, files_path=None, size=(224, 224), batch_size=64, num_workers=4, prefetch=2):
+        """
+        Decode images in a thread pool and yield them in fixed-size uint8 batches.
+
+        At most (prefetch + 1) * batch_size images are decoded ahead of the consumer, so
+        peak memory depends on the batch size rather than on the number of files.
+
+        Parameters:
+        files_path (list): Paths of the images, every training image when None.
+        size (tuple): Size the images are resized to.
+        batch_size (int): Number of images per batch; only the last batch may be smaller.
+        num_workers (int): Number of decoding threads.
+        prefetch (int): Number of batches decoded ahead.
+
+        Yields:
+        tuple: (np.ndarray of paths, uint8 np.ndarray of shape (n, height, width, 3)).
+        Images that fail to load are skipped.
+        """
+        if files_path is None:
+            files_path = self.get_files_path(os.path.join(self.root, 'train'))
+        files = iter(files_path)
+        pending = deque()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+            def submit(count):
+                for path in itertools.islice(files, count):
+                    pending.append((path, executor.submit(self.read_image_from_path, path, size)))
+
+            submit(batch_size * (prefetch + 1))
+            while pending:
+                images_path, images_np = [], []
+                while pending and len(images_path) < batch_size:
+                    path, future = pending.popleft()
+                    submit(1)
+                    image = future.result()
+                    if image is not None:
+                        images_path.append(path)
+                        images_np.append(image)
+                if images_path:
+                    yield np.array(images_path), np.stack(images_np).astype(np.uint8, copy=False)
+
+    def add_embedding(self, collection, files_path, batch_size=32):
+        from tqdm import tqdm
+
         ids = []
         embeddings = []
-        for id_filepath, filepath in tqdm(enumerate(files_path)):
-            ids.append(f'id_{id_filepath}')
-            image = Image.open(filepath)
-            embedding = self.get_single_image_embedding(image=image)
-            if embedding is not None:
-                embeddings.append(embedding)
+        for start in tqdm(range(0, len(files_path), batch_size)):
+            # An unreadable file is skipped on its own instead of failing the rest of its batch
+            batch = [(start + i, self.open_image(path)) for i, path in enumerate(files_path[start:start + batch_size])]
+            batch = [(row, image) for row, image in batch if image is not None]
+            if not batch:
+                continue
+            batch_embeddings = self.get_batch_embeddings([image for _, image in batch], batch_size)
+            if batch_embeddings is not None:
+                ids.extend(f'id_{row}' for row, _ in batch)
+                embeddings.extend(batch_embeddings.tolist())
         collection.add(embeddings=embeddings, ids=ids)
 
-    def create_collection(self, name, space):
-        return self.chroma_client.get_or_create_collection(name=name, metadata={self.hnsw_space: space})
+    def create_collection(self, name, space, search_ef=None):
+        metadata = {self.hnsw_space: space}
+        if search_ef is not None:
+            metadata['hnsw:search_ef'] = search_ef
+        return self.chroma_client.get_or_create_collection(name=name, metadata=metadata)
 
     def search(self, image_path, collection, n_results=5):
-        query_image = Image.open(image_path)
-        query_embedding = self.get_single_image_embedding(query_image)
+        query_image = self.open_image(image_path)
+        query_embedding = self.get_single_image_embedding(query_image) if query_image is not None else None
         if query_embedding is not None:
             results = collection.query(
                 query_embeddings=[query_embedding],
@@ -89,6 +195,8 @@ class DataReader:
             return None
 
     def plot_results(self, query_path, ls_path_score, reverse):
+        import matplotlib.pyplot as plt
+
         fig = plt.figure(figsize=(15, 9))
         fig.add_subplot(2, 3, 1)
         plt.imshow(self.read_image_from_path(query_path, size=(448, 448)))
@@ -0,0 +1,124 @@
+import threading
+from collections import Counter
+
+from PIL import Image
+
+from data.embedding_index import file_sha256
+from data.image_hash import HashIndex, difference_hash
+
+
+def file_difference_hash(path):
+    with Image.open(path) as image:
+        # The hash only needs a tiny greyscale image, so let JPEG decode at a reduced scale
+        image.draft('L', (64, 64))
+        return difference_hash(image)
+
+
+def backfill_hashes(records):
+    """
+    Add the difference hash to manifest records written before perceptual dedup existed, in place,
+    so that they take part in near-duplicate checks. Records whose file cannot be read are left as they are.
+
+    Returns:
+    int: Number of records updated.
+    """
+    updated = 0
+    for record in records:
+        if record.get('phash') is not None:
+            continue
+        try:
+            record['phash'] = file_difference_hash(record['path'])
+        except OSError:
+            continue
+        updated += 1
+    return updated
+
+
+class DuplicateDetector:
+    """
+    Finds images already seen, first by exact content hash and then by perceptual hash.
+
+    Byte-identical files are caught by their sha256. Re-encoded, resized or lightly edited copies are
+    caught by a difference hash within max_distance bits, looked up through a HashIndex so the check
+    stays cheap on large galleries. Safe to share between threads.
+    """
+
+    def __init__(self, max_distance=4):
+        """
+        Parameters:
+        max_distance (int): Largest Hamming distance between the difference hashes of two duplicates;
+            None only matches exact content.
+        """
+        self.max_distance = max_distance
+        self._digests = {}
+        self._hashes = HashIndex(max_distance) if max_distance is not None else None
+        self._lock = threading.Lock()
+        self.stats = Counter()
+
+    def __len__(self):
+        return len(self._digests)
+
+    @classmethod
+    def from_records(cls, records, max_distance=4):
+        """
+        Seed a detector from manifest records carrying 'path', 'sha256' and optionally 'phash'.
+        Records without a 'phash' only match exact copies; see backfill_hashes.
+        """
+        detector = cls(max_distance)
+        for record in records:
+            detector.add(record['path'], record['sha256'], record.get('phash'))
+        return detector
+
+    def _find(self, digest, phash):
+        key = self._digests.get(digest)
+        if key is not None:
+            self.stats['exact'] += 1
+            return key
+        if phash is not None and self._hashes is not None:
+            match = self._hashes.query(phash)
+            if match is not None:
+                self.stats['perceptual'] += 1
+                return match[0]
+        return None
+
+    def _add(self, key, digest, phash):
+        self._digests.setdefault(digest, key)
+        if phash is not None and self._hashes is not None:
+            self._hashes.add(phash, key)
+
+    def find(self, digest, phash=None):
+        """
+        Key of an earlier image duplicating this one, or None.
+        """
+        with self._lock:
+            return self._find(digest, phash)
+
+    def add(self, key, digest, phash=None):
+        with self._lock:
+            self._add(key, digest, phash)
+
+    def claim(self, key, digest, phash=None):
+        """
+        Register an image unless it duplicates an earlier one, in a single step so that two threads
+        handling copies of the same image cannot both keep theirs.
+
+        Returns:
+        str: Key of the earlier duplicate, or None if the image was new and is now registered.
+        """
+        with self._lock:
+            duplicate_of = self._find(digest, phash)
+            if duplicate_of is None or duplicate_of == key:
+                self._add(key, digest, phash)
+                return None
+            return duplicate_of
+
+    def claim_file(self, path):
+        """
+        claim() for an image file on disk.
+
+        Returns:
+        tuple: (key of the earlier duplicate or None, sha256, difference hash or None).
+        """
+        digest = file_sha256(path)
+        phash = file_difference_hash(path) if self._hashes is not None else None
+        return self.claim(path, digest, phash), digest, phash
@@ -0,0 +1,606 @@
+import bisect
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+from data import metrics
+from data.data_reader import DataReader, MODULE_DIR
+from data.image_hash import difference_hash
+from similarity_models.scoring_engine import METRICS, ScoringEngine, normalize, top_k_indices
+
+INDEX_DIR = os.path.join(MODULE_DIR, 'index')
+VERSIONS_DIR = 'versions'
+CURRENT_FILE = 'CURRENT'
+EMBEDDINGS_FILE = 'embeddings.npy'
+PATHS_FILE = 'paths.bin'
+OFFSETS_FILE = 'offsets.npy'
+META_FILE = 'meta.json'
+MANIFEST_FILE = 'manifest.json'
+SORTED_FILE = 'sorted.npy'
+FILES_FILE = 'files.npy'
+ANN_DIR = 'ann'
+# Candidates fetched per requested result when near-duplicate results are collapsed
+COLLAPSE_OVERSAMPLE = 4
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_record(path, stat=None):
+    stat = stat if stat is not None else os.stat(path)
+    return {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': file_sha256(path)}
+
+
+# Per-row source file columns of the manifest, kept as a fixed-width table that can be memory mapped;
+# an all-zero sha256 means the hash is unknown
+FILE_DTYPE = np.dtype([('sha256', np.uint8, (32,)), ('size', np.int64), ('mtime', np.int64)])
+
+
+def file_table(records):
+    table = np.zeros(len(records), dtype=FILE_DTYPE)
+    for row, record in enumerate(records):
+        if 'sha256' in record:
+            table[row] = (np.frombuffer(bytes.fromhex(record['sha256']), dtype=np.uint8), record['size'],
+                          record['mtime'])
+    return table
+
+
+def read_current_version(index_dir=INDEX_DIR):
+    with open(os.path.join(index_dir, CURRENT_FILE), 'r') as file:
+        return file.read().strip()
+
+
+class PathTable:
+    """
+    Gallery paths as one utf-8 blob plus an offsets array, so both can be memory mapped.
+
+    The rows sorted by path are kept alongside, so a path is looked up by binary search without building a dict.
+    """
+
+    def __init__(self, blob, offsets, order=None):
+        self.blob = blob
+        self.offsets = offsets
+        self._order = order
+
+    @classmethod
+    def from_list(cls, paths):
+        encoded = [str(path).encode('utf-8') for path in paths]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(path) for path in encoded])
+        order = np.array(sorted(range(len(encoded)), key=encoded.__getitem__), dtype=np.int64)
+        return cls(np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets, order)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _bytes(self, i):
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]])
+
+    def __getitem__(self, i):
+        return self._bytes(i).decode('utf-8')
+
+    @property
+    def order(self):
+        # Versions saved before the sorted table existed sort on first lookup
+        if self._order is None:
+            self._order = np.array(sorted(range(len(self)), key=self._bytes), dtype=np.int64)
+        return self._order
+
+    def find(self, path):
+        """
+        Row of path, or -1 when it is not in the table.
+        """
+        target = str(path).encode('utf-8')
+        order = self.order
+        i = bisect.bisect_left(range(len(order)), target, key=lambda j: self._bytes(order[j]))
+        if i < len(order) and self._bytes(order[i]) == target:
+            return int(order[i])
+        return -1
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def tolist(self):
+        return list(self)
+
+    def save(self, directory):
+        with open(os.path.join(directory, PATHS_FILE), 'wb') as file:
+            file.write(self.blob.tobytes())
+        np.save(os.path.join(directory, OFFSETS_FILE), self.offsets)
+        np.save(os.path.join(directory, SORTED_FILE), self.order)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        offsets = np.load(os.path.join(directory, OFFSETS_FILE), mmap_mode='r' if mmap else None)
+        sorted_file = os.path.join(directory, SORTED_FILE)
+        order = np.load(sorted_file, mmap_mode='r' if mmap else None) if os.path.exists(sorted_file) else None
+        paths_file = os.path.join(directory, PATHS_FILE)
+        # np.memmap refuses empty files
+        if mmap and os.path.getsize(paths_file) > 0:
+            blob = np.memmap(paths_file, dtype=np.uint8, mode='r')
+        else:
+            blob = np.fromfile(paths_file, dtype=np.uint8)
+        return cls(blob, offsets, order)
+
+
+class EmbeddingIndex:
+    def __init__(self, embeddings, paths, manifest=None, normalized=False):
+        self._assign(embeddings, paths, manifest if manifest is not None else {}, normalized)
+        self.version = None
+        self.directory = None
+
+    def _assign(self, embeddings, paths, manifest, normalized=False):
+        self.embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        self.paths = paths if isinstance(paths, PathTable) else PathTable.from_list(paths)
+        self._manifest = manifest
+        # Unit-norm rows let cosine scoring run on the (possibly memory mapped) matrix without a private copy
+        self.engine = ScoringEngine(self.embeddings, normalized=normalized)
+        # Optional approximate backend for cosine queries, see data.ann_backends
+        self.backend = None
+        self._labels = None
+        self._class_names = None
+        self._files = None
+
+    @property
+    def manifest(self):
+        # Only index maintenance needs the manifest, so a loaded index reads it on first use
+        if callable(self._manifest):
+            self._manifest = self._manifest()
+        return self._manifest
+
+    def __len__(self):
+        return len(self.paths)
+
+    @property
+    def files(self):
+        # FILE_DTYPE row per gallery image; a loaded version maps it from disk instead of parsing the manifest
+        if self._files is None:
+            self._files = file_table([self.manifest.get(path, {}) for path in self.paths])
+        return self._files
+
+    def file_info(self, path):
+        """
+        sha256, size and mtime of an indexed image, without reading the manifest.
+
+        Returns:
+        tuple: (sha256 hex or None when unknown, size, mtime in ns), or None when path is not indexed.
+        """
+        row = self.paths.find(path)
+        if row < 0:
+            return None
+        entry = self.files[row]
+        digest = bytes(entry['sha256']).hex() if entry['sha256'].any() else None
+        return digest, int(entry['size']), int(entry['mtime'])
+
+    @property
+    def labels(self):
+        # Class of each row: the folder holding the image, as in DataReader.class_names
+        if self._labels is None:
+            self._labels = np.array([os.path.basename(os.path.dirname(path)) for path in self.paths], dtype=str)
+        return self._labels
+
+    @property
+    def class_names(self):
+        # Sorted gallery classes; a class-sharded backend already holds them
+        if self._class_names is None:
+            if getattr(self.backend, 'by_class', False):
+                self._class_names = list(self.backend.shard_names)
+            else:
+                self._class_names = np.unique(self.labels).tolist()
+        return self._class_names
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros((0, 0), dtype=np.float32), [])
+
+    @classmethod
+    def build(cls, data_reader, files_path, size=(224, 224), batch_size=32):
+        """
+        Embed every gallery image once.
+
+        Parameters:
+        data_reader (DataReader): Reader holding the embedding function.
+        files_path (list): Paths of the gallery images.
+        size (tuple): Size the images are resized to before embedding.
+        batch_size (int): Number of images per model call.
+
+        Returns:
+        EmbeddingIndex: The index over the images that could be embedded.
+        """
+        index = cls.empty()
+        index.sync(data_reader, files_path, size, batch_size)
+        return index
+
+    def sync(self, data_reader, files_path, size=(224, 224), batch_size=32, dedup=None):
+        """
+        Bring the index in line with the files on disk, re-embedding only new or changed files.
+
+        A file whose size and mtime match the manifest is left alone. Otherwise its content
+        hash is compared, so a touched but unchanged file is not re-embedded either.
+        With a dedup detector, new files duplicating an indexed or earlier file are left out
+        before they are embedded.
+
+        Parameters:
+        data_reader (DataReader): Reader holding the embedding function.
+        files_path (list): Current paths of the gallery images.
+        size (tuple): Size the images are resized to before embedding.
+        batch_size (int): Number of images per model call.
+        dedup (DuplicateDetector): Optional data.dedup.DuplicateDetector.
+
+        Returns:
+        dict: Number of 'added', 'updated', 'removed' and 'duplicates' entries, and of listed files that were
+        'missing' by the time they were read.
+        """
+        rows = {path: row for row, path in enumerate(self.paths)}
+        manifest = {}
+        to_embed = []
+        missing = 0
+        with metrics.span('index_scan'):
+            for path in files_path:
+                try:
+                    stat = os.stat(path)
+                    entry = self.manifest.get(path)
+                    if entry is not None and path in rows \
+                            and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+                        manifest[path] = entry
+                        continue
+                    record = file_record(path, stat)
+                except OSError:
+                    # Deleted since it was listed, as happens while the crawler or ingest is writing;
+                    # it is handled like a file that was never listed
+                    missing += 1
+                    continue
+                if entry is not None and path in rows and entry['sha256'] == record['sha256']:
+                    if 'phash' in entry:
+                        record['phash'] = entry['phash']
+                    manifest[path] = record
+                else:
+                    to_embed.append((path, record))
+
+        duplicates = 0
+        if dedup is not None:
+            if dedup.max_distance is not None:
+                from data.dedup import backfill_hashes
+
+                # Entries indexed before dedup existed get their hash now, and keep it in the saved manifest
+                backfill_hashes(manifest.values())
+            for entry in manifest.values():
+                dedup.add(entry['path'], entry['sha256'], entry.get('phash'))
+            # Exact copies are dropped before they are even decoded
+            unique = [(path, record) for path, record in to_embed if dedup.find(record['sha256']) is None]
+            duplicates = len(to_embed) - len(unique)
+            to_embed = unique
+
+        from tqdm import tqdm
+
+        vectors = {path: self.embeddings[row] for path, row in rows.items() if path in manifest}
+        added, updated, decoded = 0, 0, 0
+        records = dict(to_embed)
+        batches = data_reader.iter_image_batches([path for path, _ in to_embed], size, batch_size)
+        for images_path, images_np in tqdm(batches, total=-(-len(to_embed) // batch_size)):
+            decoded += len(images_path)
+            if dedup is not None:
+                keep = []
+                for i, (path, image) in enumerate(zip(images_path, images_np)):
+                    record = records[str(path)]
+                    record['phash'] = difference_hash(image)
+                    if dedup.claim(record['path'], record['sha256'], record['phash']) is None:
+                        keep.append(i)
+                duplicates += len(images_path) - len(keep)
+                if not keep:
+                    continue
+                images_path, images_np = images_path[keep], images_np[keep]
+            embeddings = data_reader.get_batch_embeddings(images_np, batch_size)
+            if embeddings is None:
+                metrics.increment('images_skipped_total', len(images_path), reason='embedding_failed')
+                continue
+            for path, embedding in zip(images_path, embeddings):
+                path = str(path)
+                vectors[path] = embedding
+                manifest[path] = records[path]
+                if path in rows:
+                    updated += 1
+                else:
+                    added += 1
+        removed = sum(1 for path in rows if path not in vectors)
+        metrics.increment('images_skipped_total', len(to_embed) - decoded, reason='unreadable')
+        metrics.increment('images_skipped_total', duplicates, reason='duplicate')
+        metrics.increment('images_skipped_total', missing, reason='missing')
+
+        paths = [path for path in files_path if path in vectors]
+        embeddings = np.stack([vectors[path] for path in paths]) if paths else np.zeros((0, 0))
+        self._assign(embeddings, paths, manifest)
+        return {'added': added, 'updated': updated, 'removed': removed, 'duplicates': duplicates, 'missing': missing}
+
+    def upsert(self, paths, embeddings, records):
+        """
+        Add entries that were embedded elsewhere, replacing the ones whose path is already indexed.
+
+        Parameters:
+        paths (list): Paths of the images.
+        embeddings (np.ndarray): (n, dim) embeddings, one row per path.
+        records (list): Manifest records of the files, see file_record.
+
+        Returns:
+        dict: Number of 'added' and 'updated' entries.
+        """
+        entries = {path: (embedding, record) for path, embedding, record in zip(paths, embeddings, records)}
+        if not entries:
+            return {'added': 0, 'updated': 0}
+        rows = {path: row for row, path in enumerate(self.paths)}
+        all_paths = self.paths.tolist()
+        manifest = dict(self.manifest)
+        # Copy, the current matrix may be a read-only memory map
+        merged = np.array(self.embeddings) if len(self) else None
+        appended = []
+        for path, (embedding, record) in entries.items():
+            if path in rows:
+                merged[rows[path]] = embedding
+            else:
+                all_paths.append(path)
+                appended.append(embedding)
+            manifest[path] = record
+        if appended:
+            merged = np.concatenate([merged, np.stack(appended)]) if merged is not None else np.stack(appended)
+        self._assign(merged, all_paths, manifest)
+        return {'added': len(appended), 'updated': len(entries) - len(appended)}
+
+    def save(self, index_dir=INDEX_DIR, keep=3, carry_backends=True):
+        """
+        Write the index as a new version and atomically make it the current one.
+
+        Every version lives in its own directory under index_dir/versions and the CURRENT file
+        names the live one, so processes reading an older version are never disturbed.
+
+        Parameters:
+        index_dir (str): Root directory of the index.
+        keep (int): Number of most recent versions kept on disk.
+        carry_backends (bool): Rebuild the ANN backends of the live version for the new one before it goes
+            live, so servers configured for a backend do not fall back to exact search after an update.
+
+        Returns:
+        str: Name of the new version.
+        """
+        version = f'v{time.time_ns()}'
+        version_dir = os.path.join(index_dir, VERSIONS_DIR, version)
+        os.makedirs(version_dir)
+        np.save(os.path.join(version_dir, EMBEDDINGS_FILE), self.embeddings)
+        self.paths.save(version_dir)
+        norms = np.linalg.norm(self.embeddings, axis=1)
+        with open(os.path.join(version_dir, META_FILE), 'w') as file:
+            json.dump({'count': len(self), 'normalized': bool(np.allclose(norms, 1, atol=1e-3))}, file)
+        with open(os.path.join(version_dir, MANIFEST_FILE), 'w') as file:
+            json.dump([self.manifest[path] for path in self.paths], file)
+        np.save(os.path.join(version_dir, FILES_FILE), self.files)
+        if carry_backends and os.path.exists(os.path.join(index_dir, CURRENT_FILE)):
+            from data.ann_backends import carry_over_backends
+
+            live_dir = os.path.join(index_dir, VERSIONS_DIR, read_current_version(index_dir))
+            carry_over_backends(self, live_dir, version_dir)
+
+        current_tmp = os.path.join(index_dir, CURRENT_FILE + '.tmp')
+        with open(current_tmp, 'w') as file:
+            file.write(version)
+        os.replace(current_tmp, os.path.join(index_dir, CURRENT_FILE))
+
+        # Processes that still map an old version keep their open mappings after the files are unlinked
+        for old in sorted(os.listdir(os.path.join(index_dir, VERSIONS_DIR)))[:-keep]:
+            shutil.rmtree(os.path.join(index_dir, VERSIONS_DIR, old), ignore_errors=True)
+        self.version = version
+        self.directory = version_dir
+        return version
+
+    @classmethod
+    def load(cls, index_dir=INDEX_DIR, mmap=True):
+        """
+        Load the current version of the index.
+
+        Parameters:
+        index_dir (str): Root directory of the index.
+        mmap (bool): Memory map the embeddings and paths read-only instead of reading them into memory.
+
+        Returns:
+        EmbeddingIndex: The loaded index.
+        """
+        version = read_current_version(index_dir)
+        return cls.load_version(os.path.join(index_dir, VERSIONS_DIR, version), mmap)
+
+    @classmethod
+    def load_version(cls, version_dir, mmap=True):
+        embeddings = np.load(os.path.join(version_dir, EMBEDDINGS_FILE), mmap_mode='r' if mmap else None)
+        paths = PathTable.load(version_dir, mmap)
+        with open(os.path.join(version_dir, META_FILE), 'r') as file:
+            meta = json.load(file)
+
+        def load_manifest():
+            with open(os.path.join(version_dir, MANIFEST_FILE), 'r') as file:
+                return {entry['path']: entry for entry in json.load(file)}
+
+        index = cls(embeddings, paths, normalized=meta['normalized'])
+        index._manifest = load_manifest
+        files_file = os.path.join(version_dir, FILES_FILE)
+        if os.path.exists(files_file):
+            index._files = np.load(files_file, mmap_mode='r' if mmap else None)
+        index.version = os.path.basename(version_dir)
+        index.directory = version_dir
+        return index
+
+    def _top_k(self, queries, k, metric, classes=None):
+        if self.backend is not None and metric == 'cosine':
+            if classes is None:
+                with metrics.span('ann_search', backend=self.backend.name):
+                    return self.backend.search(queries, k)
+            if getattr(self.backend, 'by_class', False):
+                with metrics.span('ann_search', backend=self.backend.name):
+                    return self.backend.search(queries, k, classes=classes)
+            # Other backends cannot filter, so filtered queries fall back to the exact scan
+        _, higher_is_better = METRICS[metric]
+        with metrics.span('score', metric=metric):
+            scores = np.atleast_2d(self.engine.scores(queries, metric))
+        if classes is not None:
+            allowed = np.isin(self.labels, list(classes))
+            scores[:, ~allowed] = -np.inf if higher_is_better else np.inf
+            k = min(k, int(allowed.sum()))
+        with metrics.span('select_top_k'):
+            top = top_k_indices(scores, k, higher_is_better)
+            return top, np.take_along_axis(scores, top, axis=1)
+
+    def _collapse(self, rows, scores, k, threshold):
+        # Greedy: a result is dropped when its embedding is within threshold cosine of a better one kept
+        valid = rows >= 0
+        rows, scores = rows[valid], scores[valid]
+        vectors = normalize(np.asarray(self.embeddings[rows], dtype=np.float32))
+        similarity = vectors @ vectors.T
+        kept = []
+        for i in range(len(rows)):
+            if not kept or similarity[i, kept].max() < threshold:
+                kept.append(i)
+                if len(kept) == k:
+                    break
+        return rows[kept], scores[kept]
+
+    def search(self, query_embedding, k=10, metric='cosine', collapse=None, classes=None):
+        """
+        Score the query against the whole gallery in one pass.
+
+        Parameters:
+        query_embedding (np.ndarray): Embedding of the query image.
+        k (int): Number of results to return.
+        metric (str): Scoring metric, one of similarity_models.scoring_engine.METRICS.
+        collapse (float): Optional cosine similarity above which a result counts as a near-duplicate
+            of a better one and is left out.
+        classes (list): Optional class names (gallery folders) the results are restricted to.
+
+        Returns:
+        list: (path, score) tuples, best first.
+        """
+        return self.search_batch(np.asarray(query_embedding)[None, :], k, metric, collapse, classes)[0]
+
+    def search_batch(self, query_embeddings, k=10, metric='cosine', collapse=None, classes=None):
+        """
+        Score many queries against the gallery with a single matrix product.
+
+        Cosine queries go through the approximate backend when one is attached.
+
+        Parameters:
+        query_embeddings (np.ndarray): (n_queries, dim) query embeddings.
+        k (int): Number of results per query.
+        metric (str): Scoring metric, one of similarity_models.scoring_engine.METRICS.
+        collapse (float): Optional near-duplicate threshold, see search.
+        classes (list): Optional class filter, see search.
+
+        Returns:
+        list: One list of (path, score) tuples per query, best first.
+        """
+        fetch = k * COLLAPSE_OVERSAMPLE if collapse is not None else k
+        top, scores = self._top_k(np.atleast_2d(query_embeddings), fetch, metric, classes)
+        if collapse is not None:
+            top, scores = zip(*(self._collapse(row_top, row_scores, k, collapse)
+                                for row_top, row_scores in zip(top, scores)))
+        return [[(str(self.paths[i]), float(score)) for i, score in zip(row_top, row_scores) if i >= 0]
+                for row_top, row_scores in zip(top, scores)]
+
+    def search_images(self, data_reader, images, k=10, metric='cosine', batch_size=64, collapse=None, classes=None):
+        """
+        Embed many query images in batches and search them all at once.
+
+        Parameters:
+        data_reader (DataReader): Reader holding the embedding function.
+        images (list): Query images as uint8 arrays of the gallery image size.
+        k (int): Number of results per query.
+        metric (str): Scoring metric, one of similarity_models.scoring_engine.METRICS.
+        batch_size (int): Number of images per model call.
+        collapse (float): Optional near-duplicate threshold, see search.
+        classes (list): Optional class filter, see search.
+
+        Returns:
+        list: One list of (path, score) tuples per query, best first, or None if embedding failed.
+        """
+        if len(images) == 0:
+            return []
+        query_embeddings = data_reader.get_batch_embeddings(images, batch_size)
+        if query_embeddings is None:
+            return None
+        return self.search_batch(query_embeddings, k, metric, collapse, classes)
+
+
+class IndexHandle:
+    """
+    Current index of a long-running process, such as a server worker.
+
+    get() checks the CURRENT file at most every check_interval seconds and loads the new version
+    when it changed, so a rebuilt index is picked up without restarting the process. The live version
+    is also reloaded when an ANN backend is added to it after it was published.
+    """
+
+    def __init__(self, index_dir=INDEX_DIR, loader=None, check_interval=1.0):
+        self.index_dir = index_dir
+        self.loader = loader or EmbeddingIndex.load_version
+        self.check_interval = check_interval
+        self.version = None
+        self.index = None
+        self._signature = None
+        self._next_check = 0
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        version = read_current_version(self.index_dir)
+        version_dir = os.path.join(self.index_dir, VERSIONS_DIR, version)
+        ann_dir = os.path.join(version_dir, ANN_DIR)
+        # Backends are renamed into place once complete, so a listed name is ready to load
+        backends = tuple(sorted(name for name in os.listdir(ann_dir) if '.tmp' not in name)) \
+            if os.path.isdir(ann_dir) else ()
+        if (version, backends) != self._signature:
+            self.index = self.loader(version_dir)
+            self.version = version
+            self._signature = (version, backends)
+        return self.index
+
+    def get(self):
+        now = time.monotonic()
+        if now >= self._next_check:
+            with self._lock:
+                if now >= self._next_check:
+                    self._next_check = now + self.check_interval
+                    self.refresh()
+        return self.index
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from data.dedup import DuplicateDetector
+
+    parser = argparse.ArgumentParser(description='Build or update the embedding index of the training images.')
+    parser.add_argument('--dedup-distance', type=int, default=None,
+                        help='Leave out new images that are exact copies of another image, or whose difference '
+                             'hash is within this many bits of one; without it no duplicates are left out')
+    args = parser.parse_args()
+
+    data_reader = DataReader(root='processed')
+
+    train_path = os.path.join(data_reader.root, 'train')
+    train_files_path = data_reader.get_files_path(path=train_path)
+
+    # Only new or changed images are embedded when an index already exists
+    if os.path.exists(os.path.join(INDEX_DIR, CURRENT_FILE)):
+        index = EmbeddingIndex.load()
+    else:
+        index = EmbeddingIndex.empty()
+    dedup = DuplicateDetector(args.dedup_distance) if args.dedup_distance is not None else None
+    counts = index.sync(data_reader, train_files_path, dedup=dedup)
+    version = index.save()
+    print(f"Indexed {len(index)} images into {INDEX_DIR} as {version} ({counts['added']} added, "
+          f"{counts['updated']} updated, {counts['removed']} removed, {counts['duplicates']} duplicates, "
+          f"{counts['missing']} missing)")
@@ -0,0 +1,183 @@
+import argparse
+import json
+import os
+import resource
+import time
+
+import numpy as np
+
+from data.data_reader import DataReader, MODULE_DIR
+from data.embedding_index import EmbeddingIndex, INDEX_DIR, CURRENT_FILE
+from similarity_models.scoring_engine import METRICS
+
+EVALUATION_DIR = os.path.join(MODULE_DIR, 'evaluation')
+
+
+def embed_files(data_reader, files_path, size=(224, 224), batch_size=64, num_workers=4):
+    """
+    Embed many images, decoding the next batches in a thread pool while the model runs.
+
+    Returns:
+    tuple: (list of paths, (n, dim) float32 embeddings) for the images that could be read and embedded.
+    """
+    paths = []
+    embeddings = []
+    for images_path, images_np in data_reader.iter_image_batches(files_path, size, batch_size, num_workers):
+        batch_embeddings = data_reader.get_batch_embeddings(images_np, batch_size)
+        if batch_embeddings is not None:
+            paths.extend(images_path)
+            embeddings.append(batch_embeddings)
+    if not embeddings:
+        return [], np.zeros((0, 0), dtype=np.float32)
+    return paths, np.concatenate(embeddings).astype(np.float32, copy=False)
+
+
+def folder_labels(paths):
+    # Class of an image: the folder holding it, as in DataReader.class_names
+    return np.array([os.path.basename(os.path.dirname(path)) for path in paths], dtype=str)
+
+
+def evaluate(engine, gallery_labels, query_embeddings, query_labels, ks=(1, 5, 10), metric='cosine', block_size=64):
+    """
+    Rank the whole gallery for every query, block_size queries per matrix product.
+
+    A gallery image is relevant to a query when both carry the same label. Memory stays bounded by the
+    (block_size, n_gallery) score and rank matrices of one block, whatever the number of queries.
+
+    Parameters:
+    engine (ScoringEngine): Engine over the gallery embeddings.
+    gallery_labels (np.ndarray): Integer class of each gallery row.
+    query_embeddings (np.ndarray): (n_queries, dim) query embeddings.
+    query_labels (np.ndarray): Integer class of each query.
+    ks (tuple): Cut-offs precision is reported at.
+    metric (str): Scoring metric, one of similarity_models.scoring_engine.METRICS.
+    block_size (int): Number of queries scored per matrix product.
+
+    Returns:
+    dict: Per-query arrays 'top' and 'top_scores' ((n_queries, max(ks)), best first), 'precision'
+    ((n_queries, len(ks))) and 'average_precision' (NaN for queries whose class is not in the gallery).
+    """
+    _, higher_is_better = METRICS[metric]
+    n_queries, n_gallery = len(query_embeddings), len(engine)
+    depth = min(max(ks), n_gallery)
+    relevant_counts = np.bincount(gallery_labels, minlength=int(query_labels.max(initial=-1)) + 1)[query_labels]
+    ranks = np.arange(1, n_gallery + 1, dtype=np.float32)
+
+    top = np.empty((n_queries, depth), dtype=np.int32)
+    top_scores = np.empty((n_queries, depth), dtype=np.float32)
+    precision = np.empty((n_queries, len(ks)), dtype=np.float32)
+    average_precision = np.full(n_queries, np.nan, dtype=np.float32)
+    for start in range(0, n_queries, block_size):
+        stop = min(start + block_size, n_queries)
+        scores = np.atleast_2d(engine.scores(query_embeddings[start:stop], metric))
+        order = np.argsort(-scores if higher_is_better else scores, axis=1, kind='stable')
+        hits = gallery_labels[order] == query_labels[start:stop, None]
+        found = np.cumsum(hits, axis=1, dtype=np.int32)
+
+        top[start:stop] = order[:, :depth]
+        top_scores[start:stop] = np.take_along_axis(scores, order[:, :depth], axis=1)
+        for column, k in enumerate(ks):
+            precision[start:stop, column] = found[:, min(k, n_gallery) - 1] / k if n_gallery else 0
+        # Mean of the precision at the rank of each relevant image
+        counts = relevant_counts[start:stop]
+        has_relevant = counts > 0
+        average_precision[start:stop][has_relevant] = (
+            np.where(hits, found / ranks, 0).sum(axis=1)[has_relevant] / counts[has_relevant])
+    return {'top': top, 'top_scores': top_scores, 'precision': precision, 'average_precision': average_precision}
+
+
+def summarize(results, query_labels, class_names, ks):
+    """
+    Mean precision@k and mean average precision, over all queries and for each class.
+    """
+    def means(rows):
+        summary = {f'precision@{k}': float(results['precision'][rows, column].mean()) for column, k in enumerate(ks)}
+        average_precision = results['average_precision'][rows]
+        summary['mAP'] = float(np.nanmean(average_precision)) if np.isfinite(average_precision).any() else None
+        summary['queries'] = int(np.count_nonzero(rows))
+        return summary
+
+    per_class = {class_names[label]: means(query_labels == label) for label in np.unique(query_labels)}
+    overall = means(np.ones(len(query_labels), dtype=bool))
+    # Macro average: every class weighs the same however many test images it has
+    class_maps = [summary['mAP'] for summary in per_class.values() if summary['mAP'] is not None]
+    overall['class_mean_mAP'] = float(np.mean(class_maps)) if class_maps else None
+    return overall, per_class
+
+
+def format_value(value, spec):
+    # mAP is undefined when no query has a relevant gallery image, the rate when nothing was timed
+    return 'n/a' if value is None else format(value, spec)
+
+
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Retrieval quality and throughput of the index over a whole '
+                                                 'split, with the folder names as labels.')
+    parser.add_argument('--split', default='test')
+    parser.add_argument('--index-dir', default=INDEX_DIR,
+                        help='Gallery index; the training split is embedded on the fly when none was built')
+    parser.add_argument('--metrics', nargs='+', default=['cosine'], choices=sorted(METRICS))
+    parser.add_argument('--k', type=int, nargs='+', default=[1, 5, 10])
+    parser.add_argument('--batch-size', type=int, default=64, help='Images per model call')
+    parser.add_argument('--num-workers', type=int, default=4, help='Decoding threads')
+    parser.add_argument('--block-size', type=int, default=64, help='Queries per matrix product')
+    parser.add_argument('--output-dir', default=EVALUATION_DIR)
+    args = parser.parse_args()
+
+    data_reader = DataReader(root='processed')
+    if os.path.exists(os.path.join(args.index_dir, CURRENT_FILE)):
+        index = EmbeddingIndex.load(args.index_dir)
+    else:
+        print(f"No index in {args.index_dir}, embedding the training split")
+        index = EmbeddingIndex.build(data_reader, data_reader.get_files_path(os.path.join(data_reader.root, 'train')))
+
+    start = time.perf_counter()
+    query_paths, query_embeddings = embed_files(
+        data_reader, data_reader.get_files_path(os.path.join(data_reader.root, args.split)),
+        batch_size=args.batch_size, num_workers=args.num_workers)
+    embed_seconds = time.perf_counter() - start
+
+    class_names, codes = np.unique(np.concatenate([index.labels, folder_labels(query_paths)]), return_inverse=True)
+    gallery_labels, query_labels = codes[:len(index)], codes[len(index):]
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    report = {
+        'index_version': index.version,
+        'split': args.split,
+        'gallery_size': len(index),
+        'queries': len(query_paths),
+        'embedding': {'seconds': embed_seconds,
+                      'images_per_second': len(query_paths) / embed_seconds if embed_seconds else None},
+        'metrics': {},
+    }
+    for metric in args.metrics:
+        start = time.perf_counter()
+        results = evaluate(index.engine, gallery_labels, query_embeddings, query_labels, args.k, metric,
+                           args.block_size)
+        seconds = time.perf_counter() - start
+        overall, per_class = summarize(results, query_labels, class_names, args.k)
+        report['metrics'][metric] = {
+            'seconds': seconds,
+            'queries_per_second': len(query_paths) / seconds if seconds else None,
+            **overall,
+            'classes': per_class,
+        }
+        # Rankings as compact arrays; 'top' holds rows of gallery_paths
+        np.savez_compressed(os.path.join(args.output_dir, f'{metric}.npz'),
+                            query_paths=np.array(query_paths, dtype=str), query_labels=query_labels.astype(np.int32),
+                            gallery_paths=np.array(index.paths.tolist(), dtype=str),
+                            gallery_labels=gallery_labels.astype(np.int32), class_names=class_names, **results)
+        queries_per_second = report['metrics'][metric]['queries_per_second']
+        print(f"{metric}: mAP {format_value(overall['mAP'], '.3f')}, " + ', '.join(
+            f"P@{k} {overall[f'precision@{k}']:.3f}" for k in args.k)
+            + f", {format_value(queries_per_second, '.0f')} queries/s")
+
+    report['peak_rss_bytes'] = peak_rss_bytes()
+    with open(os.path.join(args.output_dir, 'summary.json'), 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {args.output_dir}")
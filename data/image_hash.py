@@ -0,0 +1,92 @@
+import hashlib
+
+import numpy as np
+from PIL import Image
+
+
+def content_hash(data):
+    """sha256 hex digest of raw bytes, identical only for byte-identical files."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def difference_hash(image, hash_size=8):
+    """
+    Perceptual difference hash: the image is shrunk to (hash_size + 1) x hash_size greyscale and
+    every bit records whether a pixel is brighter than its right neighbour. Re-encoded, resized or
+    slightly edited copies of an image get hashes a few bits apart.
+
+    Parameters:
+    image (PIL.Image.Image or np.ndarray): The image.
+    hash_size (int): Side of the hash grid, giving hash_size ** 2 bits.
+
+    Returns:
+    int: The hash as an unsigned integer.
+    """
+    if not isinstance(image, Image.Image):
+        image = Image.fromarray(np.asarray(image))
+    pixels = np.asarray(image.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int(sum(1 << i for i, bit in enumerate(bits) if bit))
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class HashIndex:
+    """
+    Multi-index hashing for Hamming range queries over many perceptual hashes.
+
+    Each hash is split into max_distance + 1 bands. Two hashes at most max_distance bits apart agree
+    exactly on at least one band, so a query only compares the hashes sharing one of its bands
+    instead of scanning the whole gallery.
+    """
+
+    def __init__(self, max_distance=4, bits=64):
+        self.max_distance = max_distance
+        self.n_bands = max_distance + 1
+        self.band_bits = -(-bits // self.n_bands)
+        self._bands = [{} for _ in range(self.n_bands)]
+        self._keys = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _split(self, value):
+        mask = (1 << self.band_bits) - 1
+        return [(value >> (i * self.band_bits)) & mask for i in range(self.n_bands)]
+
+    def add(self, value, key):
+        # The first key stored under a hash is the one queries return
+        if value in self._keys:
+            return
+        self._keys[value] = key
+        for band, part in zip(self._bands, self._split(value)):
+            band.setdefault(part, []).append(value)
+
+    def remove(self, value):
+        if value not in self._keys:
+            return
+        del self._keys[value]
+        for band, part in zip(self._bands, self._split(value)):
+            values = band[part]
+            values.remove(value)
+            if not values:
+                del band[part]
+
+    def query(self, value):
+        """
+        Closest stored hash within max_distance bits.
+
+        Returns:
+        tuple: (key, distance), or None when no stored hash is close enough.
+        """
+        if value in self._keys:
+            return self._keys[value], 0
+        best = None
+        for band, part in zip(self._bands, self._split(value)):
+            for candidate in band.get(part, ()):
+                distance = hamming_distance(value, candidate)
+                if distance <= self.max_distance and (best is None or distance < best[1]):
+                    best = (self._keys[candidate], distance)
+        return best
@@ -0,0 +1,146 @@
+import concurrent.futures
+import os
+import queue
+import threading
+import time
+from collections import Counter
+
+
+class StageTimer:
+    """Count, total and max duration per named stage."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def record(self, stage, seconds):
+        with self._lock:
+            count, total, longest = self._stages.get(stage, (0, 0.0, 0.0))
+            self._stages[stage] = (count + 1, total + seconds, max(longest, seconds))
+
+    def snapshot(self):
+        with self._lock:
+            return {stage: {'count': count, 'total_seconds': total, 'max_seconds': longest,
+                            'mean_seconds': total / count if count else 0.0}
+                    for stage, (count, total, longest) in self._stages.items()}
+
+
+class InferenceScheduler:
+    """
+    Dynamic micro-batching between the web layer and the embedding model.
+
+    Callers submit single images and get futures back. A worker thread takes the first pending
+    image, keeps collecting until max_batch_size images are queued or max_wait_ms has passed,
+    runs one batched forward pass and resolves every future with its own row.
+    """
+
+    def __init__(self, embed_batch, max_batch_size=32, max_wait_ms=5, max_queue=256):
+        """
+        Parameters:
+        embed_batch (callable): f(images) returning one embedding per image, e.g. DataReader.get_batch_embeddings.
+        max_batch_size (int): Largest batch sent to the model.
+        max_wait_ms (float): Longest time the first image of a batch waits for company.
+        max_queue (int): Pending images beyond which submit raises queue.Full.
+        """
+        self.embed_batch = embed_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue = max_queue
+        self.timer = StageTimer()
+        self.batch_sizes = Counter()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_started(self):
+        # Threads do not survive fork, so a scheduler created before a server forks its workers
+        # starts its own worker thread in each process on first use
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue(maxsize=self.max_queue)
+                    self._stopped = threading.Event()
+                    self._thread = threading.Thread(target=self._run, name='inference-scheduler', daemon=True)
+                    self._thread.start()
+                    self._pid = os.getpid()
+
+    def submit(self, image):
+        """
+        Queue one image for embedding.
+
+        Returns:
+        concurrent.futures.Future: Resolves to the embedding, or None if the batch failed.
+
+        Raises:
+        queue.Full: When max_queue images are already waiting.
+        """
+        self._ensure_started()
+        future = concurrent.futures.Future()
+        self._queue.put_nowait((image, future, time.perf_counter()))
+        return future
+
+    def embed(self, image, timeout=None):
+        return self.submit(image).result(timeout)
+
+    def stop(self):
+        """
+        Stop the worker thread after its current batch. Images still queued are not embedded: their futures
+        fail with RuntimeError, so callers waiting on them return instead of hanging.
+        """
+        if self._pid == os.getpid():
+            self._stopped.set()
+            self._thread.join()
+            self._pid = None
+            while True:
+                try:
+                    _, future, _ = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                future.set_exception(RuntimeError('Inference scheduler stopped'))
+
+    def _collect(self):
+        try:
+            batch = [self._queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stopped.is_set():
+            batch = self._collect()
+            if not batch:
+                continue
+            start = time.perf_counter()
+            for _, _, enqueued in batch:
+                self.timer.record('queue_wait', start - enqueued)
+            self.batch_sizes[len(batch)] += 1
+
+            try:
+                embeddings = self.embed_batch([image for image, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            finally:
+                self.timer.record('inference', time.perf_counter() - start)
+
+            done = time.perf_counter()
+            for i, (_, future, enqueued) in enumerate(batch):
+                future.set_result(embeddings[i] if embeddings is not None else None)
+                self.timer.record('total', done - enqueued)
+
+    def metrics(self):
+        return {
+            'queue_depth': self._queue.qsize() if self._pid == os.getpid() else 0,
+            'batches': sum(self.batch_sizes.values()),
+            'batch_size_histogram': dict(sorted(self.batch_sizes.items())),
+            'stages': self.timer.snapshot(),
+        }
@@ -0,0 +1,386 @@
+import argparse
+import http.client
+import io
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from collections import Counter
+from urllib.parse import urljoin, urlparse
+
+import numpy as np
+from PIL import Image
+
+from crawler.utils import HostRateLimiter
+from data import metrics
+from data.data_reader import DataReader
+from data.embedding_index import EmbeddingIndex, INDEX_DIR, CURRENT_FILE, file_record
+from data.dedup import DuplicateDetector, backfill_hashes
+from data.image_hash import content_hash, difference_hash
+from data.inference_scheduler import StageTimer
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+REDIRECTS = (301, 302, 303, 307, 308)
+
+
+class Stage:
+    """
+    One step of the pipeline: a pool of worker threads moving items from a bounded inbox to the next stage.
+
+    fn returns the item handed downstream, or None to drop it. With batch_size set, fn receives a list of
+    up to batch_size items, collected for at most max_wait seconds, and returns one output per item.
+    """
+
+    def __init__(self, name, fn, workers, inbox, outbox, timer, batch_size=None, max_wait=0.05):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.inbox = inbox
+        self.outbox = outbox
+        self.timer = timer
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.counts = Counter()
+        self.results = []
+        self._lock = threading.Lock()
+        self._alive = workers
+        self._threads = [threading.Thread(target=self._run, name=f'ingest-{name}-{i}', daemon=True)
+                         for i in range(workers)]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def _take(self):
+        item = self.inbox.get()
+        if item is _DONE:
+            # Put the marker back for the sibling workers
+            self.inbox.put(_DONE)
+            return None
+        if self.batch_size is None:
+            return [item]
+        batch = [item]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                item = self.inbox.get(timeout=max(remaining, 0)) if remaining > 0 else self.inbox.get_nowait()
+            except queue.Empty:
+                break
+            if item is _DONE:
+                self.inbox.put(_DONE)
+                break
+            batch.append(item)
+        return batch
+
+    def _emit(self, output):
+        if output is None:
+            self._count('dropped')
+        elif self.outbox is None:
+            self.results.append(output)
+            self._count('out')
+        else:
+            self.outbox.put(output)
+            self._count('out')
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.counts[key] += n
+
+    def _run(self):
+        while True:
+            items = self._take()
+            if items is None:
+                break
+            self._count('in', len(items))
+            start = time.perf_counter()
+            try:
+                outputs = self.fn(items) if self.batch_size is not None else [self.fn(items[0])]
+            except Exception:
+                logger.exception("Ingest stage %s failed on %d item(s)", self.name, len(items))
+                metrics.increment('ingest_failures_total', len(items), stage=self.name)
+                self._count('failed', len(items))
+                continue
+            finally:
+                self.timer.record(self.name, time.perf_counter() - start)
+            for output in outputs:
+                self._emit(output)
+
+        with self._lock:
+            self._alive -= 1
+            last = self._alive == 0
+        if last and self.outbox is not None:
+            self.outbox.put(_DONE)
+
+
+class IngestPipeline:
+    """
+    Streaming download -> decode -> embed -> write ingestion of the URLs collected by UrlScraper.
+
+    Downloaded bytes stay in memory: they are decoded, validated and resized once, embedded in batches,
+    and only then written as the processed gallery image together with its index entry. Bounded queues
+    between the stages keep memory flat and let the slowest stage set the pace.
+    """
+
+    def __init__(self, data_reader, processed_dir=None, size=(224, 224), max_side=512, min_side=32,
+                 download_workers=16, decode_workers=4, embed_workers=1, write_workers=2,
+                 batch_size=32, max_wait=0.05, queue_size=128, timeout=30, min_interval=0.2, retries=3,
+                 backoff=0.5, max_redirects=5, dedup=None):
+        """
+        Parameters:
+        data_reader (DataReader): Reader holding the embedding function.
+        processed_dir (str): Gallery directory the images are written to, one folder per term;
+            data_reader.root/train by default.
+        size (tuple): Size the images are resized to before embedding.
+        max_side (int): Longest side of the stored processed image.
+        min_side (int): Images with a shorter side are rejected.
+        download_workers, decode_workers, embed_workers, write_workers (int): Threads per stage.
+        batch_size (int): Largest number of images per model call.
+        max_wait (float): Longest time the embed stage waits to fill a batch, in seconds.
+        queue_size (int): Capacity of each queue between stages.
+        timeout (float): Timeout of one download attempt, in seconds.
+        min_interval (float): Minimum seconds between two requests to the same host, across all download workers.
+        retries (int): Extra attempts after a connection error, timeout, 429 or 5xx.
+        backoff (float): Base of the exponential backoff between attempts, in seconds.
+        max_redirects (int): Redirects followed per download.
+        dedup (DuplicateDetector): Optional data.dedup.DuplicateDetector; images duplicating one already
+            in the gallery or earlier in the run are dropped before they are embedded.
+        """
+        self.data_reader = data_reader
+        self.processed_dir = processed_dir or os.path.join(data_reader.root, 'train')
+        self.size = tuple(size)
+        self.max_side = max_side
+        self.min_side = min_side
+        self.timeout = timeout
+        self.rate_limiter = HostRateLimiter(min_interval)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_redirects = max_redirects
+        # Keep-alive connections of each download thread, one per (scheme, host)
+        self._connections = threading.local()
+        self.dedup = dedup
+        self.timer = StageTimer()
+        self._claimed = set()
+        self._claimed_lock = threading.Lock()
+
+        queues = [queue.Queue(maxsize=queue_size) for _ in range(4)]
+        self.tasks = queues[0]
+        self.stages = [
+            Stage('download', self.download, download_workers, queues[0], queues[1], self.timer),
+            Stage('decode', self.decode, decode_workers, queues[1], queues[2], self.timer),
+            Stage('embed', self.embed, embed_workers, queues[2], queues[3], self.timer,
+                  batch_size=batch_size, max_wait=max_wait),
+            Stage('write', self.write, write_workers, queues[3], None, self.timer),
+        ]
+
+    def _connection(self, parts):
+        pool = self._connections.__dict__
+        key = (parts.scheme, parts.netloc)
+        if key not in pool:
+            cls = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+            pool[key] = cls(parts.netloc, timeout=self.timeout)
+        return key, pool[key]
+
+    def _get(self, url):
+        """
+        One GET over this thread's kept-alive connection to the host.
+
+        Returns:
+        tuple: (http.client.HTTPResponse, body), the body being None unless the response is a 200 image.
+        """
+        parts = urlparse(url)
+        key, connection = self._connection(parts)
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+        # A connection the server has meanwhile closed only fails once the request is sent
+        reused = connection.sock is not None
+        try:
+            connection.request('GET', target, headers={'Accept': 'image/*'})
+            response = connection.getresponse()
+            image = response.status == 200 and response.headers.get_content_type().startswith('image')
+            # Short bodies of redirects and errors are drained so the connection stays usable
+            drain = not image and response.length is not None and response.length <= 1 << 16
+            data = response.read() if image or drain else None
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            del self._connections.__dict__[key]
+            if reused:
+                return self._get(url)
+            raise
+        if data is None or response.will_close:
+            # An unread body cannot be skipped on a kept-alive connection, so the connection is dropped
+            connection.close()
+            del self._connections.__dict__[key]
+        return response, data if image else None
+
+    def download(self, task):
+        url, label = task
+        location, attempt, redirects = url, 0, 0
+        while True:
+            self.rate_limiter.sleep(urlparse(location).netloc)
+            try:
+                response, data = self._get(location)
+            except (OSError, http.client.HTTPException):
+                if attempt == self.retries:
+                    raise
+            else:
+                if response.status in REDIRECTS and response.headers.get('Location'):
+                    if redirects == self.max_redirects:
+                        return None
+                    redirects += 1
+                    location = urljoin(location, response.headers['Location'])
+                    continue
+                if response.status != 429 and response.status < 500:
+                    return {'url': url, 'label': label, 'data': data} if data is not None else None
+                if attempt == self.retries:
+                    raise http.client.HTTPException(f'{response.status} {response.reason}')
+            time.sleep(self.backoff * 2 ** attempt * (1 + random.random()))
+            attempt += 1
+
+    def target_path(self, label, digest):
+        # Named by content, so the same image found under two URLs is stored once per term
+        return os.path.join(self.processed_dir, label, f'{digest[:16]}.jpg')
+
+    def decode(self, item):
+        digest = content_hash(item['data'])
+        path = self.target_path(item['label'], digest)
+        with self._claimed_lock:
+            # Also catches copies of an image that are still in flight
+            if path in self._claimed or os.path.exists(path):
+                return None
+            self._claimed.add(path)
+        image = Image.open(io.BytesIO(item.pop('data')))
+        # JPEG can decode straight to a reduced scale, which is much cheaper than a full decode and resize
+        image.draft('RGB', (self.max_side, self.max_side))
+        image = image.convert('RGB')
+        if min(image.size) < self.min_side:
+            return None
+        if self.dedup is not None:
+            item['phash'] = difference_hash(image)
+            if self.dedup.claim(path, digest, item['phash']) is not None:
+                return None
+        image.thumbnail((self.max_side, self.max_side))
+        item.update(path=path, image=image, pixels=np.array(image.resize(self.size)))
+        return item
+
+    def embed(self, items):
+        embeddings = self.data_reader.get_batch_embeddings(np.stack([item['pixels'] for item in items]), len(items))
+        if embeddings is None:
+            return [None] * len(items)
+        for item, embedding in zip(items, embeddings):
+            item['embedding'] = embedding
+            del item['pixels']
+        return items
+
+    def write(self, item):
+        path = item['path']
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        item.pop('image').save(tmp_path, format='JPEG', quality=95)
+        os.replace(tmp_path, path)
+        record = file_record(path)
+        if 'phash' in item:
+            record['phash'] = item['phash']
+        return path, item['embedding'], record
+
+    def run(self, tasks):
+        """
+        Push (url, label) tasks through the pipeline.
+
+        Returns:
+        list: (path, embedding, manifest record) of every image written.
+        """
+        for stage in self.stages:
+            stage.start()
+        for task in tasks:
+            self.tasks.put(task)
+        self.tasks.put(_DONE)
+        for stage in self.stages:
+            stage.join()
+        return self.stages[-1].results
+
+    def report(self, wall_seconds):
+        """
+        Per-stage throughput.
+
+        'capacity_per_second' is how many items the stage's workers could process per second if they
+        never waited on their inbox; the stage with the lowest capacity (and highest utilization)
+        is the bottleneck.
+        """
+        busy = self.timer.snapshot()
+        report = {}
+        for stage in self.stages:
+            busy_seconds = busy.get(stage.name, {}).get('total_seconds', 0.0)
+            report[stage.name] = {
+                **dict(stage.counts),
+                'workers': stage.workers,
+                'busy_seconds': busy_seconds,
+                'items_per_second': stage.counts['in'] / wall_seconds if wall_seconds else 0.0,
+                'capacity_per_second': stage.counts['in'] * stage.workers / busy_seconds if busy_seconds else 0.0,
+                'utilization': busy_seconds / (stage.workers * wall_seconds) if wall_seconds else 0.0,
+            }
+        return report
+
+
+def read_tasks(json_file):
+    """(url, term) pairs of a JSON file written by UrlScraper.save_to_file, {category: {term: [urls]}}."""
+    with open(json_file, 'r') as file:
+        data = json.load(file)
+    return [(url, term) for terms in data.values() for term, urls in terms.items() for url in urls
+            if urlparse(url).scheme in ('http', 'https')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download, process and index new gallery images in one pass.')
+    parser.add_argument('json_file')
+    parser.add_argument('--download-workers', type=int, default=16)
+    parser.add_argument('--decode-workers', type=int, default=4)
+    parser.add_argument('--write-workers', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--queue-size', type=int, default=128)
+    parser.add_argument('--min-interval', type=float, default=0.2,
+                        help='Minimum seconds between two requests to the same host')
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--dedup-distance', type=int, default=None,
+                        help='Drop images whose difference hash is within this many bits of a gallery image')
+    args = parser.parse_args()
+
+    if os.path.exists(os.path.join(INDEX_DIR, CURRENT_FILE)):
+        index = EmbeddingIndex.load()
+    else:
+        index = EmbeddingIndex.empty()
+    dedup = None
+    hashed = 0
+    if args.dedup_distance is not None:
+        # Gallery images indexed before dedup existed have no difference hash yet
+        hashed = backfill_hashes(index.manifest.values())
+        dedup = DuplicateDetector.from_records(index.manifest.values(), args.dedup_distance)
+
+    data_reader = DataReader(root='processed')
+    pipeline = IngestPipeline(data_reader, download_workers=args.download_workers,
+                              decode_workers=args.decode_workers, write_workers=args.write_workers,
+                              batch_size=args.batch_size, queue_size=args.queue_size,
+                              min_interval=args.min_interval, retries=args.retries, dedup=dedup)
+    start = time.perf_counter()
+    written = pipeline.run(read_tasks(args.json_file))
+    wall_seconds = time.perf_counter() - start
+
+    if written:
+        paths, embeddings, records = zip(*written)
+        counts = index.upsert(paths, np.stack(embeddings), records)
+        version = index.save()
+        print(f"Indexed {len(index)} images as {version} ({counts['added']} added, {counts['updated']} updated)")
+    elif hashed:
+        version = index.save()
+        print(f"Stored the difference hash of {hashed} indexed images as {version}")
+    print(json.dumps(pipeline.report(wall_seconds), indent=2))
@@ -0,0 +1,143 @@
+import contextlib
+import threading
+import time
+
+# Process-wide timing spans and counters, rendered in the Prometheus text format by render().
+# Everything is prefixed with PREFIX; label values are short fixed strings such as stage names.
+PREFIX = 'image_retrieval_'
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_callbacks = {}
+_help = {
+    'stage_seconds': 'Time spent in each stage of the query and index paths',
+    'request_seconds': 'Time spent handling each HTTP endpoint',
+    'requests_total': 'HTTP requests by endpoint and status code',
+    'rejected_requests_total': 'Requests turned away because the server was overloaded',
+    'image_read_failures_total': 'Images that could not be opened or decoded',
+    'embedding_failures_total': 'Model calls that raised',
+    'images_skipped_total': 'Images left out of an index build',
+}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def increment(name, amount=1, **labels):
+    """Add amount to the counter name{labels}."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name, seconds, **labels):
+    """Record one duration in the histogram name{labels}."""
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram[0][i] += 1
+                break
+        histogram[1] += seconds
+        histogram[2] += 1
+
+
+@contextlib.contextmanager
+def span(stage, **labels):
+    """Time the enclosed block as stage_seconds{stage=...}, also when it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('stage_seconds', time.perf_counter() - start, stage=stage, **labels)
+
+
+def register_callback(name, function, kind='gauge', help_text=None):
+    """
+    Report a value owned by another component, read from function() on every render.
+
+    Parameters:
+    name (str): Metric name without PREFIX.
+    function (callable): Returns a number, or a dict mapping ((label, value), ...) tuples to numbers.
+    kind (str): Prometheus type, 'gauge' or 'counter'.
+    help_text (str): Optional HELP line.
+    """
+    with _lock:
+        _callbacks[name] = (function, kind)
+        if help_text:
+            _help[name] = help_text
+
+
+def snapshot():
+    """Plain copy of the counters and histograms, keyed by (name, labels)."""
+    with _lock:
+        return {'counters': dict(_counters),
+                'histograms': {key: (list(buckets), total, count) for key, (buckets, total, count) in
+                               _histograms.items()}}
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _header(lines, name, kind):
+    if name in _help:
+        lines.append(f'# HELP {PREFIX}{name} {_help[name]}')
+    lines.append(f'# TYPE {PREFIX}{name} {kind}')
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    data = snapshot()
+    lines = []
+
+    counters = {}
+    for (name, labels), value in data['counters'].items():
+        counters.setdefault(name, []).append((labels, value))
+    for name in sorted(counters):
+        _header(lines, name, 'counter')
+        for labels, value in sorted(counters[name]):
+            lines.append(f'{PREFIX}{name}{_format_labels(labels)} {value}')
+
+    histograms = {}
+    for (name, labels), value in data['histograms'].items():
+        histograms.setdefault(name, []).append((labels, value))
+    for name in sorted(histograms):
+        _header(lines, name, 'histogram')
+        for labels, (buckets, total, count) in sorted(histograms[name]):
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS, buckets):
+                cumulative += bucket
+                lines.append(f'{PREFIX}{name}_bucket{_format_labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{PREFIX}{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {count}')
+            lines.append(f'{PREFIX}{name}_sum{_format_labels(labels)} {total}')
+            lines.append(f'{PREFIX}{name}_count{_format_labels(labels)} {count}')
+
+    with _lock:
+        callbacks = dict(_callbacks)
+    for name in sorted(callbacks):
+        function, kind = callbacks[name]
+        try:
+            value = function()
+        except Exception:
+            # A failing reporter must not take the whole endpoint down
+            continue
+        if value is None:
+            continue
+        _header(lines, name, kind)
+        if isinstance(value, dict):
+            for labels, number in sorted(value.items()):
+                lines.append(f'{PREFIX}{name}{_format_labels(labels)} {float(number)}')
+        else:
+            lines.append(f'{PREFIX}{name} {float(value)}')
+    return '\n'.join(lines) + '\n'
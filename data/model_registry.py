@@ -0,0 +1,50 @@
+import threading
+import time
+
+import numpy as np
+
+# One OpenCLIP model per process, shared by every DataReader
+_lock = threading.Lock()
+_embedding_function = None
+_status = {'loaded': False, 'ready': False, 'load_seconds': None, 'warmup_seconds': None}
+
+
+def get_embedding_function(num_threads=None):
+    """
+    Return the process-wide OpenCLIP embedding function, loading the weights on first use.
+
+    Parameters:
+    num_threads (int): Torch intra-op thread count to apply, left unchanged when None.
+
+    Returns:
+    OpenCLIPEmbeddingFunction: The shared embedding function.
+    """
+    global _embedding_function
+    if _embedding_function is None:
+        with _lock:
+            if _embedding_function is None:
+                # Imported here so tools that never embed do not pay for torch and open_clip
+                from chromadb.utils.embedding_functions import OpenCLIPEmbeddingFunction
+
+                start = time.perf_counter()
+                _embedding_function = OpenCLIPEmbeddingFunction()
+                _status['load_seconds'] = time.perf_counter() - start
+                _status['loaded'] = True
+    if num_threads is not None:
+        _embedding_function._torch.set_num_threads(num_threads)
+    return _embedding_function
+
+
+def warm_up(size=(224, 224)):
+    """
+    Run one inference so lazy initialisation happens before the first real query, then mark the model ready.
+    """
+    embedding_function = get_embedding_function()
+    start = time.perf_counter()
+    embedding_function._encode_image(image=np.zeros((*size[::-1], 3), dtype=np.uint8))
+    _status['warmup_seconds'] = time.perf_counter() - start
+    _status['ready'] = True
+
+
+def status():
+    return dict(_status)
@@ -0,0 +1,147 @@
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+
+import numpy as np
+
+from data.data_reader import DataReader
+from data.embedding_index import EmbeddingIndex, INDEX_DIR, file_record
+
+SHARD_DIR = INDEX_DIR + '.shards'
+PLAN_FILE = 'plan.json'
+
+_worker_reader = None
+
+
+def _init_worker(root, num_threads):
+    global _worker_reader
+    _worker_reader = DataReader(root=root, num_threads=num_threads)
+
+
+def _shard_files(shard_dir, shard_id):
+    name = os.path.join(shard_dir, f'shard_{shard_id:05d}')
+    return name + '.npy', name + '.json'
+
+
+def _embed_shard(shard_id, files_path, shard_dir, size, batch_size):
+    embeddings = []
+    records = []
+    for images_path, images_np in _worker_reader.iter_image_batches(files_path, size, batch_size, num_workers=1):
+        batch_embeddings = _worker_reader.get_batch_embeddings(images_np, batch_size)
+        if batch_embeddings is None:
+            continue
+        embeddings.append(batch_embeddings)
+        records.extend(file_record(str(path)) for path in images_path)
+
+    embeddings_file, records_file = _shard_files(shard_dir, shard_id)
+    embeddings = np.concatenate(embeddings) if embeddings else np.zeros((0, 0), dtype=np.float32)
+    with open(embeddings_file + '.tmp', 'wb') as file:
+        np.save(file, embeddings)
+    os.replace(embeddings_file + '.tmp', embeddings_file)
+    # The records file is written last and marks the shard as complete
+    with open(records_file + '.tmp', 'w') as file:
+        json.dump(records, file)
+    os.replace(records_file + '.tmp', records_file)
+    return shard_id
+
+
+def _prepare_shard_dir(shard_dir, files_path, shard_size, size):
+    plan = {
+        'shard_size': shard_size,
+        'size': list(size),
+        'files': hashlib.sha256('\n'.join(files_path).encode()).hexdigest(),
+    }
+    plan_path = os.path.join(shard_dir, PLAN_FILE)
+    if os.path.exists(plan_path):
+        with open(plan_path, 'r') as file:
+            if json.load(file) == plan:
+                return
+        # Shards from a different file list or shard size cannot be reused
+        shutil.rmtree(shard_dir)
+    os.makedirs(shard_dir, exist_ok=True)
+    with open(plan_path, 'w') as file:
+        json.dump(plan, file)
+
+
+def build_index_parallel(root, files_path, num_workers=None, threads_per_worker=1, shard_size=1024,
+                         size=(224, 224), batch_size=32, shard_dir=SHARD_DIR):
+    """
+    Embed the gallery with a pool of processes, each holding its own OpenCLIP model.
+
+    The file list is cut into fixed shards of shard_size files, independent of the number of
+    workers, and the shards are merged in order, so the index is the same for any worker count.
+    Completed shards are kept in shard_dir, and a build interrupted by a crash resumes from them.
+
+    Parameters:
+    root (str): Data root passed to each worker's DataReader.
+    files_path (list): Paths of the gallery images.
+    num_workers (int): Number of processes, defaults to cpu_count // threads_per_worker.
+    threads_per_worker (int): Torch intra-op threads per process.
+    shard_size (int): Number of files per shard.
+    size (tuple): Size the images are resized to before embedding.
+    batch_size (int): Number of images per model call.
+    shard_dir (str): Directory holding the completed shards.
+
+    Returns:
+    EmbeddingIndex: The merged index.
+    """
+    if num_workers is None:
+        num_workers = max(1, (os.cpu_count() or 1) // threads_per_worker)
+    files_path = list(files_path)
+    shards = [files_path[start:start + shard_size] for start in range(0, len(files_path), shard_size)]
+
+    _prepare_shard_dir(shard_dir, files_path, shard_size, size)
+    todo = [shard_id for shard_id in range(len(shards))
+            if not os.path.exists(_shard_files(shard_dir, shard_id)[1])]
+    print(f"{len(shards) - len(todo)} of {len(shards)} shards already done")
+
+    if todo:
+        from tqdm import tqdm
+
+        # Spawned workers do not inherit torch thread pools or locks from the parent
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers,
+                                                    mp_context=multiprocessing.get_context('spawn'),
+                                                    initializer=_init_worker,
+                                                    initargs=(root, threads_per_worker)) as executor:
+            futures = [executor.submit(_embed_shard, shard_id, shards[shard_id], shard_dir, size, batch_size)
+                       for shard_id in todo]
+            for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
+                future.result()
+
+    embeddings = []
+    manifest = {}
+    paths = []
+    for shard_id in range(len(shards)):
+        embeddings_file, records_file = _shard_files(shard_dir, shard_id)
+        with open(records_file, 'r') as file:
+            records = json.load(file)
+        if records:
+            embeddings.append(np.load(embeddings_file))
+        for record in records:
+            paths.append(record['path'])
+            manifest[record['path']] = record
+    embeddings = np.concatenate(embeddings) if embeddings else np.zeros((0, 0), dtype=np.float32)
+    return EmbeddingIndex(embeddings, paths, manifest)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the embedding index with a process pool.')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--threads-per-worker', type=int, default=1)
+    parser.add_argument('--shard-size', type=int, default=1024)
+    parser.add_argument('--batch-size', type=int, default=32)
+    args = parser.parse_args()
+
+    data_reader = DataReader(root='processed')
+    train_files_path = data_reader.get_files_path(path=os.path.join(data_reader.root, 'train'))
+
+    index = build_index_parallel(data_reader.root, train_files_path, num_workers=args.workers,
+                                 threads_per_worker=args.threads_per_worker, shard_size=args.shard_size,
+                                 batch_size=args.batch_size)
+    index.save()
+    shutil.rmtree(SHARD_DIR)
+    print(f"Indexed {len(index)} images into {INDEX_DIR}")
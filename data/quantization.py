@@ -0,0 +1,193 @@
+import numpy as np
+
+from similarity_models.scoring_engine import normalize, top_k_indices
+
+
+def _chunked_scores(queries, codes, decode, chunk_size=65536):
+    scores = np.empty((len(queries), len(codes)), dtype=np.float32)
+    for start in range(0, len(codes), chunk_size):
+        scores[:, start:start + chunk_size] = queries @ decode(start, start + chunk_size).T
+    return scores
+
+
+class Float32Codec:
+    name = 'float32'
+
+    def fit(self, embeddings):
+        return self
+
+    def encode(self, embeddings):
+        return {'codes': np.ascontiguousarray(embeddings, dtype=np.float32)}
+
+    def decode(self, data, start=0, stop=None):
+        return data['codes'][start:stop]
+
+    def scores(self, queries, data):
+        return queries @ data['codes'].T
+
+    def state(self):
+        return {}
+
+    def load_state(self, state):
+        return self
+
+
+class Float16Codec(Float32Codec):
+    name = 'float16'
+
+    def encode(self, embeddings):
+        return {'codes': np.ascontiguousarray(embeddings, dtype=np.float16)}
+
+    def decode(self, data, start=0, stop=None):
+        return data['codes'][start:stop].astype(np.float32)
+
+    def scores(self, queries, data):
+        # float16 matmul has no BLAS path, so widen one chunk at a time
+        return _chunked_scores(queries, data['codes'], lambda start, stop: self.decode(data, start, stop))
+
+
+class Int8Codec(Float32Codec):
+    """Symmetric int8 with one float32 scale per vector."""
+    name = 'int8'
+
+    def encode(self, embeddings):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        scales = np.abs(embeddings).max(axis=1) / 127
+        scales[scales == 0] = 1
+        codes = np.clip(np.rint(embeddings / scales[:, None]), -127, 127).astype(np.int8)
+        return {'codes': codes, 'scales': scales.astype(np.float32)}
+
+    def decode(self, data, start=0, stop=None):
+        return data['codes'][start:stop].astype(np.float32) * data['scales'][start:stop, None]
+
+    def scores(self, queries, data):
+        codes = data['codes']
+        raw = _chunked_scores(queries, codes, lambda start, stop: codes[start:stop].astype(np.float32))
+        return raw * data['scales'][None, :]
+
+
+def kmeans(data, n_clusters, n_iter=20, seed=0):
+    rng = np.random.default_rng(seed)
+    n_clusters = min(n_clusters, len(data))
+    centroids = data[rng.choice(len(data), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        distances = (data ** 2).sum(1)[:, None] - 2 * data @ centroids.T + (centroids ** 2).sum(1)[None, :]
+        assign = np.argmin(distances, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, data)
+        counts = np.bincount(assign, minlength=n_clusters)
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+    return centroids
+
+
+class PQCodec:
+    """
+    Product quantization: each vector is split into n_subspaces pieces and every piece is
+    replaced by the id of its nearest of 256 sub-centroids, so a vector costs n_subspaces bytes.
+    Inner products are computed from a per-query lookup table (asymmetric distance).
+    """
+    name = 'pq'
+
+    def __init__(self, n_subspaces=64, n_centroids=256, n_iter=20, train_size=65536, seed=0):
+        self.n_subspaces = n_subspaces
+        self.n_centroids = n_centroids
+        self.n_iter = n_iter
+        self.train_size = train_size
+        self.seed = seed
+        self.codebooks = None
+
+    def _split(self, embeddings):
+        return np.split(np.asarray(embeddings, dtype=np.float32), self.n_subspaces, axis=1)
+
+    def fit(self, embeddings):
+        if embeddings.shape[1] % self.n_subspaces:
+            raise ValueError(f"Dimension {embeddings.shape[1]} is not divisible by {self.n_subspaces} subspaces")
+        rng = np.random.default_rng(self.seed)
+        sample = embeddings
+        if len(sample) > self.train_size:
+            sample = sample[np.sort(rng.choice(len(sample), self.train_size, replace=False))]
+        self.codebooks = np.stack([kmeans(part, self.n_centroids, self.n_iter, self.seed)
+                                   for part in self._split(sample)])
+        return self
+
+    def encode(self, embeddings):
+        codes = np.empty((len(embeddings), self.n_subspaces), dtype=np.uint8)
+        for i, part in enumerate(self._split(embeddings)):
+            codebook = self.codebooks[i]
+            distances = (codebook ** 2).sum(1)[None, :] - 2 * part @ codebook.T
+            codes[:, i] = np.argmin(distances, axis=1)
+        return {'codes': codes}
+
+    def decode(self, data, start=0, stop=None):
+        codes = data['codes'][start:stop]
+        return np.concatenate([self.codebooks[i][codes[:, i]] for i in range(self.n_subspaces)], axis=1)
+
+    def scores(self, queries, data):
+        # Codes offset into a flattened (n_subspaces * n_centroids) lookup table
+        flat_codes = data['codes'] + (np.arange(self.n_subspaces) * self.codebooks.shape[1])[None, :]
+        scores = np.empty((len(queries), len(flat_codes)), dtype=np.float32)
+        for row, query in enumerate(queries):
+            # Partial inner products of each query piece with every sub-centroid, then one gather-and-sum
+            table = np.einsum('sd,scd->sc', np.stack(self._split(query[None, :]))[:, 0], self.codebooks)
+            scores[row] = table.ravel()[flat_codes].sum(axis=1)
+        return scores
+
+    def state(self):
+        return {'codebooks': self.codebooks}
+
+    def load_state(self, state):
+        self.codebooks = state['codebooks']
+        self.n_subspaces, self.n_centroids = self.codebooks.shape[:2]
+        return self
+
+
+CODECS = {codec.name: codec for codec in (Float32Codec, Float16Codec, Int8Codec, PQCodec)}
+
+
+def bytes_per_vector(data):
+    """Storage cost of encoded vectors, including per-vector side information such as int8 scales."""
+    n_vectors = len(data['codes'])
+    return sum(array.nbytes for array in data.values()) / max(n_vectors, 1)
+
+
+class QuantizedStore:
+    """
+    Compressed copy of the normalized gallery for cosine search, with an optional exact rerank:
+    the best rerank candidates by compressed score are rescored against full-precision vectors,
+    which can be a read-only memory map so they stay on disk.
+    """
+
+    def __init__(self, codec, rerank=0):
+        self.codec = codec
+        self.rerank = rerank
+        self.data = None
+        self.full_precision = None
+
+    def build(self, embeddings):
+        normalized = normalize(np.asarray(embeddings, dtype=np.float32))
+        self.codec.fit(normalized)
+        self.data = self.codec.encode(normalized)
+        return self
+
+    def __len__(self):
+        return len(self.data['codes'])
+
+    def search(self, queries, k=10):
+        queries = normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        scores = self.codec.scores(queries, self.data)
+        if not self.rerank or self.full_precision is None:
+            top = top_k_indices(scores, k)
+            return top, np.take_along_axis(scores, top, axis=1)
+
+        candidates = top_k_indices(scores, max(k, self.rerank))
+        indices = np.empty((len(queries), min(k, candidates.shape[1])), dtype=np.int64)
+        exact_scores = np.empty(indices.shape, dtype=np.float32)
+        for row, (query, rows) in enumerate(zip(queries, candidates)):
+            # Sorted row ids keep the reads from a memory map sequential
+            rows = np.sort(rows)
+            rescored = normalize(np.asarray(self.full_precision[rows], dtype=np.float32)) @ query
+            best = top_k_indices(rescored[None, :], k)[0]
+            indices[row] = rows[best]
+            exact_scores[row] = rescored[best]
+        return indices, exact_scores
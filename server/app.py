@@ -1,27 +1,81 @@
-from flask import Flask, request, jsonify, render_template, send_file, abort
+import concurrent.futures
+import io
+import queue
+import time
+from flask import Flask, Response, g, request, jsonify, render_template, abort
 from flask_cors import CORS
 import os
 from werkzeug.utils import secure_filename
-from data.data_reader import DataReader
-from similarity_models.cosine_similarity import get_cosine_similarity_score
+from data import metrics, model_registry
+from data.image_hash import content_hash, difference_hash
+from data.profiler import SamplingProfiler
+from server.state import (IMAGE_SIZE, SEARCH_COLLAPSE, RequestError, batch_response, batch_slots,
+                          data_reader, image_digest, index_handle, inference_scheduler, parse_batch_request,
+                          parse_classes, project_root, result_cache, thumbnail_cache, thumbnail_response)
+from similarity_models.scoring_engine import METRICS
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "http://localhost:5174"}})
 
-current_file_path = os.path.dirname(os.path.abspath(__file__))
-project_root = os.path.abspath(os.path.join(current_file_path, '..'))
 UPLOAD_FOLDER = os.path.join(project_root, 'data', 'storage')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
+# Load the model weights at import. Under gunicorn with preload_app (server/gunicorn.conf.py) this happens
+# once in the master, before fork, and the workers share the pages. The torch thread count is left alone here;
+# each worker sets its own after fork and then warms up.
+if os.environ.get('PRELOAD_MODEL', '1') == '1':
+    model_registry.get_embedding_function()
+decode_executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count())
+
+# With PROFILE_REQUESTS=1, a request sent with ?profile=1 or an `X-Profile: 1` header is run under a sampling
+# profiler and its folded stacks are written to PROFILE_DIR, named in the X-Profile response header
+PROFILE_REQUESTS = os.environ.get('PROFILE_REQUESTS', '0') == '1'
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(project_root, 'data', 'profiles'))
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.005))
+
+
+@app.before_request
+def start_request():
+    g.request_start = time.perf_counter()
+    g.profiler = None
+    if PROFILE_REQUESTS and (request.args.get('profile') == '1' or request.headers.get('X-Profile') == '1'):
+        g.profiler = SamplingProfiler(interval=PROFILE_INTERVAL).start()
+
+
+@app.after_request
+def finish_request(response):
+    endpoint = request.endpoint or 'unknown'
+    metrics.observe('request_seconds', time.perf_counter() - g.request_start, endpoint=endpoint)
+    metrics.increment('requests_total', endpoint=endpoint, status=str(response.status_code))
+    if g.get('profiler') is not None:
+        g.profiler.stop()
+        path = g.profiler.save(os.path.join(PROFILE_DIR, f'{endpoint}_{time.time_ns()}.folded'))
+        response.headers['X-Profile'] = os.path.basename(path)
+    return response
+
 
 @app.route('/')
 def home():
     return render_template('index.html')
 
 
+@app.route('/health', methods=['GET'])
+def health():
+    status = model_registry.status()
+    index = index_handle.get()
+    status.update({'index_version': index.version, 'index_size': len(index), 'cache': result_cache.snapshot(),
+                   'thumbnails': thumbnail_cache.snapshot(), 'scheduler': inference_scheduler.metrics()})
+    return jsonify(status), 200 if status['ready'] else 503
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/upload', methods=['POST'])
 def upload_image():
     if 'file' not in request.files:
@@ -31,33 +85,102 @@ def upload_image():
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
 
+    metric = request.form.get('metric', 'cosine')
+    if metric not in METRICS:
+        return jsonify({'error': f'Unknown metric {metric}'}), 400
+    try:
+        classes = parse_classes(request.form)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
     if file:
-        filename = secure_filename(file.filename)
+        with metrics.span('upload_read'):
+            data = file.read()
+        index = index_handle.get()
+        digest = content_hash(data)
+        cache_key = (digest, metric, 10, classes)
+        top_10_results = result_cache.get(cache_key, index.version)
+        if top_10_results is not None:
+            return jsonify(top_10_results), 200
+
+        # Named after the content, so concurrent uploads sharing a filename never write to the same file
+        filename = digest[:16] + os.path.splitext(secure_filename(file.filename))[1]
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(file_path)
+        with metrics.span('upload_save'), open(file_path, 'wb') as saved_file:
+            saved_file.write(data)
+
+        # Decoded from the bytes the cache key was computed on, not read back from disk
+        query = data_reader.read_image_from_file(io.BytesIO(data), IMAGE_SIZE)
+        if query is None:
+            return jsonify({'error': 'Could not read the uploaded image'}), 400
+
+        # Near-duplicates of a recent upload reuse its embedding and skip the model
+        with metrics.span('phash'):
+            phash = difference_hash(query)
+        query_embedding = result_cache.get_embedding(phash, index.version)
+        if query_embedding is None:
+            try:
+                # Queue wait plus the batched forward pass
+                with metrics.span('embed', mode='scheduled'):
+                    query_embedding = inference_scheduler.embed(query)
+            except queue.Full:
+                metrics.increment('rejected_requests_total', reason='queue_full')
+                return jsonify({'error': 'Server is overloaded, retry later'}), 503
+            if query_embedding is None:
+                return jsonify({'error': 'Could not embed the uploaded image'}), 500
+            result_cache.put_embedding(phash, index.version, query_embedding)
+
+        results = index.search(query_embedding, k=10, metric=metric, collapse=SEARCH_COLLAPSE, classes=classes)
+        top_10_results = [{'image_path': path, 'score': score} for path, score in results]
+        result_cache.put(cache_key, index.version, top_10_results)
 
-        root_img_path = 'processed'
-        size = (224, 224)
-        data_reader = DataReader(root=root_img_path)
+        return jsonify(top_10_results), 200
 
-        _, ls_path_score = get_cosine_similarity_score(data_reader, file_path, size)
 
-        top_10_results = [{'image_path': path, 'score': score}
-                          for path, score in sorted(ls_path_score, key=lambda x: x[1], reverse=True)[:10]]
+@app.route('/search/batch', methods=['POST'])
+def search_batch():
+    files = [file for file in request.files.getlist('files') if file.filename != '']
+    try:
+        metric, k, classes = parse_batch_request(files, request.form)
+    except RequestError as e:
+        return jsonify({'error': str(e)}), e.status
 
-        return jsonify(top_10_results), 200
+    if not batch_slots.acquire(blocking=False):
+        metrics.increment('rejected_requests_total', reason='batch_slots')
+        return jsonify({'error': 'Server is overloaded, retry later'}), 503
+    try:
+        # Uploads are decoded from memory in parallel and never written to UPLOAD_FOLDER
+        images = list(decode_executor.map(lambda file: data_reader.read_image_from_file(file.stream, IMAGE_SIZE),
+                                          files))
+        decoded = [image for image in images if image is not None]
+        results = index_handle.get().search_images(data_reader, decoded, k=k, metric=metric,
+                                                      collapse=SEARCH_COLLAPSE, classes=classes)
+    finally:
+        batch_slots.release()
+    if results is None:
+        return jsonify({'error': 'Could not embed the uploaded images'}), 500
+    return jsonify(batch_response(files, images, results)), 200
 
 
 @app.route('/images/<path:url>', methods=['GET'])
 def serve_image(url):
-    url = "/" + url
+    # Only images of the live index are served, by the absolute path returned in search results
+    image = image_digest(url)
+    if image is None:
+        abort(404, description="Not an indexed image.")
+    path, digest = image
+
+    etag = thumbnail_cache.key(digest)
+    if request.if_none_match.contains(etag):
+        return thumbnail_response(Response(status=304), etag)
     try:
-        return send_file(url)
-    except FileNotFoundError:
-        abort(404, description="File not found.")
-    except Exception as e:
+        with metrics.span('thumbnail'):
+            _, data = thumbnail_cache.get(path, digest)
+    except OSError as e:
         abort(500, description=f"An error occurred: {str(e)}")
+    return thumbnail_response(Response(data, mimetype='image/jpeg'), etag)
 
 
 if __name__ == '__main__':
+    model_registry.warm_up(IMAGE_SIZE)
     app.run(port=7000, debug=True)
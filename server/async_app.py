@@ -0,0 +1,193 @@
+import asyncio
+import concurrent.futures
+import io
+import os
+import queue
+import time
+
+from quart import Quart, Response, abort, g, request, jsonify
+from quart_cors import cors
+
+from data import metrics, model_registry
+from data.image_hash import content_hash, difference_hash
+from server.state import (IMAGE_SIZE, SEARCH_COLLAPSE, RequestError, batch_response, batch_slots, data_reader,
+                          image_digest, index_handle, inference_scheduler, parse_batch_request, parse_classes,
+                          result_cache, thumbnail_cache, thumbnail_response)
+from similarity_models.scoring_engine import METRICS
+
+# Async serving mode: `hypercorn server.async_app:app --bind 0.0.0.0:7000`.
+# Serves /upload, /search/batch and /images/<path> like the Flask app, from the same state (server.state).
+# Uploads stay in memory, CPU work runs on a bounded executor and concurrent queries share model calls
+# through the same InferenceScheduler as the Flask app.
+MAX_INFLIGHT = int(os.environ.get('ASYNC_MAX_INFLIGHT', 512))
+EXECUTOR_WORKERS = int(os.environ.get('ASYNC_EXECUTOR_WORKERS', os.cpu_count() or 1))
+
+app = Quart(__name__)
+app = cors(app, allow_origin="http://localhost:5174")
+
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS)
+
+
+inflight = None
+
+
+def overloaded():
+    response = jsonify({'error': 'Server is overloaded, retry later'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+
+@app.before_serving
+async def startup():
+    global inflight
+    # Requests past this limit are turned away instead of piling up in the executor queue
+    inflight = asyncio.Semaphore(MAX_INFLIGHT)
+    await asyncio.get_running_loop().run_in_executor(executor, model_registry.warm_up, IMAGE_SIZE)
+
+
+@app.after_serving
+async def shutdown():
+    inference_scheduler.stop()
+    executor.shutdown(wait=False)
+
+
+@app.before_request
+async def start_request():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+async def finish_request(response):
+    endpoint = request.endpoint or 'unknown'
+    metrics.observe('request_seconds', time.perf_counter() - g.request_start, endpoint=endpoint)
+    metrics.increment('requests_total', endpoint=endpoint, status=str(response.status_code))
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+async def prometheus_metrics():
+    # server.state registers the index, cache and scheduler reporters
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/health', methods=['GET'])
+async def health():
+    status = model_registry.status()
+    index = index_handle.get()
+    status.update({'index_version': index.version, 'index_size': len(index), 'cache': result_cache.snapshot(),
+                   'thumbnails': thumbnail_cache.snapshot(), 'scheduler': inference_scheduler.metrics()})
+    return jsonify(status), 200 if status['ready'] else 503
+
+
+@app.route('/upload', methods=['POST'])
+async def upload_image():
+    files = await request.files
+    if 'file' not in files:
+        return jsonify({'error': 'No file part in the request'}), 400
+
+    file = files['file']
+    if file.filename == '':
+        return jsonify({'error': 'No selected file'}), 400
+
+    form = await request.form
+    metric = form.get('metric', 'cosine')
+    if metric not in METRICS:
+        return jsonify({'error': f'Unknown metric {metric}'}), 400
+    try:
+        classes = parse_classes(form)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    data = file.read()
+    index = index_handle.get()
+    cache_key = (content_hash(data), metric, 10, classes)
+    top_10_results = result_cache.get(cache_key, index.version)
+    if top_10_results is not None:
+        return jsonify(top_10_results), 200
+
+    if inflight.locked():
+        metrics.increment('rejected_requests_total', reason='inflight')
+        return overloaded()
+    async with inflight:
+        return await search_upload(data, index, metric, classes, cache_key)
+
+
+async def search_upload(data, index, metric, classes, cache_key):
+    loop = asyncio.get_running_loop()
+    query = await loop.run_in_executor(executor, data_reader.read_image_from_file, io.BytesIO(data), IMAGE_SIZE)
+    if query is None:
+        return jsonify({'error': 'Could not read the uploaded image'}), 400
+
+    phash = difference_hash(query)
+    query_embedding = result_cache.get_embedding(phash, index.version)
+    if query_embedding is None:
+        try:
+            with metrics.span('embed', mode='scheduled'):
+                query_embedding = await asyncio.wrap_future(inference_scheduler.submit(query))
+        except queue.Full:
+            metrics.increment('rejected_requests_total', reason='queue_full')
+            return overloaded()
+        if query_embedding is None:
+            return jsonify({'error': 'Could not embed the uploaded image'}), 500
+        result_cache.put_embedding(phash, index.version, query_embedding)
+
+    results = await loop.run_in_executor(
+        executor,
+        lambda: index.search(query_embedding, k=10, metric=metric, collapse=SEARCH_COLLAPSE, classes=classes))
+    top_10_results = [{'image_path': path, 'score': score} for path, score in results]
+    result_cache.put(cache_key, index.version, top_10_results)
+    return jsonify(top_10_results), 200
+
+
+@app.route('/search/batch', methods=['POST'])
+async def search_batch():
+    files = [file for file in (await request.files).getlist('files') if file.filename != '']
+    try:
+        metric, k, classes = parse_batch_request(files, await request.form)
+    except RequestError as e:
+        return jsonify({'error': str(e)}), e.status
+
+    # Same per-process bound as the Flask app; a batch occupies one executor thread from decode to search
+    if not batch_slots.acquire(blocking=False):
+        metrics.increment('rejected_requests_total', reason='batch_slots')
+        return overloaded()
+    try:
+        images, results = await asyncio.get_running_loop().run_in_executor(
+            executor, search_files, files, metric, k, classes)
+    finally:
+        batch_slots.release()
+    if results is None:
+        return jsonify({'error': 'Could not embed the uploaded images'}), 500
+    return jsonify(batch_response(files, images, results)), 200
+
+
+def search_files(files, metric, k, classes):
+    images = [data_reader.read_image_from_file(file.stream, IMAGE_SIZE) for file in files]
+    decoded = [image for image in images if image is not None]
+    results = index_handle.get().search_images(data_reader, decoded, k=k, metric=metric, collapse=SEARCH_COLLAPSE,
+                                               classes=classes)
+    return images, results
+
+
+@app.route('/images/<path:url>', methods=['GET'])
+async def serve_image(url):
+    # Same lookup and thumbnail cache as the Flask app; hashing and resizing run on the executor
+    loop = asyncio.get_running_loop()
+    image = await loop.run_in_executor(executor, image_digest, url)
+    if image is None:
+        abort(404)
+    path, digest = image
+
+    etag = thumbnail_cache.key(digest)
+    if request.if_none_match.contains(etag):
+        return thumbnail_response(Response(b'', status=304), etag)
+    try:
+        with metrics.span('thumbnail'):
+            _, data = await loop.run_in_executor(executor, thumbnail_cache.get, path, digest)
+    except OSError:
+        abort(500)
+    return thumbnail_response(Response(data, mimetype='image/jpeg'), etag)
+
+
+if __name__ == '__main__':
+    app.run(port=7000)
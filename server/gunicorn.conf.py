@@ -0,0 +1,21 @@
+import os
+
+# gunicorn -c server/gunicorn.conf.py server.app:app
+bind = os.environ.get('BIND', '0.0.0.0:7000')
+workers = int(os.environ.get('WORKERS', 4))
+# Threaded workers, so concurrent uploads in one worker reach the InferenceScheduler together and share a
+# forward pass; a sync worker handles one request at a time and every upload would wait out its batch window
+worker_class = 'gthread'
+threads = int(os.environ.get('THREADS', 8))
+# Import the app, and with it the model weights and index mapping, once in the master before forking
+preload_app = True
+
+
+def post_fork(server, worker):
+    from data import model_registry
+    from server.state import IMAGE_SIZE
+
+    # Torch threads are only configured here, after fork: every worker gets its share of the cores
+    model_registry.get_embedding_function(max(1, (os.cpu_count() or 1) // server.cfg.workers))
+    # Inference runs in the worker so torch thread pools are not created before fork
+    model_registry.warm_up(IMAGE_SIZE)
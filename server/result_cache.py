@@ -0,0 +1,109 @@
+import threading
+import time
+from collections import OrderedDict
+
+from data.image_hash import HashIndex
+
+
+class ResultCache:
+    """
+    LRU cache with a TTL for query results, keyed on the content hash of the uploaded bytes.
+
+    A second, optional tier keeps query embeddings by perceptual hash, so a near-duplicate upload
+    skips the model and only pays for scoring. Both tiers are dropped when the index version changes.
+    """
+
+    def __init__(self, max_entries=1024, ttl=300, phash_max_distance=None, max_embeddings=4096):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.phash_max_distance = phash_max_distance
+        self.max_embeddings = max_embeddings
+        self.version = None
+        self._results = OrderedDict()
+        self._embeddings = OrderedDict()
+        # Hashes of the embedding tier, for near-duplicate lookups without a scan
+        self._hashes = HashIndex(phash_max_distance) if phash_max_distance is not None else None
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'embedding_hits': 0, 'embedding_misses': 0, 'invalidations': 0}
+
+    def _check_version(self, version):
+        if version != self.version:
+            if self.version is not None:
+                self.stats['invalidations'] += 1
+            self._results.clear()
+            self._embeddings.clear()
+            if self._hashes is not None:
+                self._hashes = HashIndex(self.phash_max_distance)
+            self.version = version
+
+    @staticmethod
+    def _lookup(entries, key):
+        entry = entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del entries[key]
+            return None
+        entries.move_to_end(key)
+        return value
+
+    @staticmethod
+    def _store(entries, key, value, ttl, max_entries):
+        entries[key] = (time.monotonic() + ttl, value)
+        entries.move_to_end(key)
+        evicted = []
+        while len(entries) > max_entries:
+            evicted.append(entries.popitem(last=False)[0])
+        return evicted
+
+    def get(self, key, version):
+        """
+        Cached results for key, or None.
+
+        Parameters:
+        key (tuple): Content hash of the upload plus every query parameter that changes the result.
+        version (str): Version of the index the results must come from.
+        """
+        with self._lock:
+            self._check_version(version)
+            value = self._lookup(self._results, key)
+            self.stats['hits' if value is not None else 'misses'] += 1
+            return value
+
+    def put(self, key, version, results):
+        with self._lock:
+            self._check_version(version)
+            self._store(self._results, key, results, self.ttl, self.max_entries)
+
+    def get_embedding(self, phash, version):
+        """
+        Embedding of a cached query whose perceptual hash is within phash_max_distance bits, or None.
+        """
+        if self.phash_max_distance is None:
+            return None
+        with self._lock:
+            self._check_version(version)
+            embedding = self._lookup(self._embeddings, phash)
+            if embedding is None:
+                match = self._hashes.query(phash)
+                if match is not None:
+                    embedding = self._lookup(self._embeddings, match[0])
+                    if embedding is None:
+                        # The closest entry has expired
+                        self._hashes.remove(match[0])
+            self.stats['embedding_hits' if embedding is not None else 'embedding_misses'] += 1
+            return embedding
+
+    def put_embedding(self, phash, version, embedding):
+        if self.phash_max_distance is None:
+            return
+        with self._lock:
+            self._check_version(version)
+            for evicted in self._store(self._embeddings, phash, embedding, self.ttl, self.max_embeddings):
+                self._hashes.remove(evicted)
+            self._hashes.add(phash, phash)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, entries=len(self._results), embeddings=len(self._embeddings))
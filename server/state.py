@@ -0,0 +1,194 @@
+import os
+import threading
+
+from data import metrics, model_registry
+from data.ann_backends import backend_dir, load_backend
+from data.data_reader import DataReader
+from data.embedding_index import EmbeddingIndex, IndexHandle, file_sha256
+from data.inference_scheduler import InferenceScheduler
+from server.result_cache import ResultCache
+from server.thumbnail_cache import ThumbnailCache
+from similarity_models.scoring_engine import METRICS
+
+# Search state of a server process, shared by the Flask app (server.app) and the async app (server.async_app)
+# without either importing the other
+project_root = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+IMAGE_SIZE = (224, 224)
+
+# Cosine search backend: exact (default), hnsw, ivf or quantized, built with `python -m data.ann_backends`
+SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'exact')
+SEARCH_PARAMS = {
+    'hnsw': {'ef_search': int(os.environ.get('SEARCH_EF', 64))},
+    'ivf': {'nprobe': int(os.environ.get('SEARCH_NPROBE', 8))},
+    'sharded': {'nprobe': int(os.environ.get('SEARCH_NPROBE', 8)),
+                'workers': int(os.environ.get('SEARCH_WORKERS', os.cpu_count() or 1))},
+    'quantized': {'rerank': int(os.environ.get('SEARCH_RERANK', 100))},
+}
+# Cosine similarity above which a result is hidden as a near-duplicate of a better one; unset keeps every result
+SEARCH_COLLAPSE = float(os.environ['SEARCH_COLLAPSE']) if os.environ.get('SEARCH_COLLAPSE') else None
+
+
+def load_index(version_dir):
+    index = EmbeddingIndex.load_version(version_dir)
+    if SEARCH_BACKEND != 'exact':
+        directory = backend_dir(version_dir, SEARCH_BACKEND)
+        if os.path.exists(directory):
+            index.backend = load_backend(SEARCH_BACKEND, directory, **SEARCH_PARAMS.get(SEARCH_BACKEND, {}))
+        else:
+            print(f"No {SEARCH_BACKEND} backend in {version_dir}, falling back to exact search")
+    return index
+
+
+# Built offline with `python -m data.embedding_index`. The index is memory mapped, so every worker shares
+# one copy through the page cache, and a newly saved version is picked up without a restart.
+data_reader = DataReader(root='processed')
+index_handle = IndexHandle(loader=load_index)
+
+# Repeat uploads are answered from memory. Near-duplicate uploads can also reuse a cached embedding with
+# PHASH_MAX_DISTANCE >= 0; it is off by default since distinct images can have hashes a few bits apart
+phash_max_distance = int(os.environ.get('PHASH_MAX_DISTANCE', -1))
+result_cache = ResultCache(max_entries=int(os.environ.get('RESULT_CACHE_SIZE', 1024)),
+                           ttl=float(os.environ.get('RESULT_CACHE_TTL', 300)),
+                           phash_max_distance=phash_max_distance if phash_max_distance >= 0 else None)
+
+# /search/batch embeds in the request thread instead of going through the scheduler, so both its size and
+# the number of batch requests running at once are bounded; requests beyond BATCH_CONCURRENCY get 503
+MAX_BATCH_FILES = int(os.environ.get('MAX_BATCH_FILES', 64))
+MAX_K = int(os.environ.get('MAX_K', 100))
+batch_slots = threading.BoundedSemaphore(int(os.environ.get('BATCH_CONCURRENCY', 2)))
+
+# Result images are served as thumbnails, resized once into a bounded on-disk cache shared by the workers
+THUMBNAIL_MAX_AGE = int(os.environ.get('THUMBNAIL_MAX_AGE', 3600))
+thumbnail_cache = ThumbnailCache(os.environ.get('THUMBNAIL_DIR', os.path.join(project_root, 'data', 'thumbnails')),
+                                 max_bytes=int(os.environ.get('THUMBNAIL_CACHE_BYTES', 256 << 20)),
+                                 size=int(os.environ.get('THUMBNAIL_SIZE', 256)))
+
+# Single-image queries from concurrent requests are grouped into batched forward passes
+inference_scheduler = InferenceScheduler(data_reader.get_batch_embeddings,
+                                         max_batch_size=int(os.environ.get('SCHEDULER_MAX_BATCH', 32)),
+                                         max_wait_ms=float(os.environ.get('SCHEDULER_MAX_WAIT_MS', 5)),
+                                         max_queue=int(os.environ.get('SCHEDULER_MAX_QUEUE', 256)))
+
+
+def register_metrics():
+    metrics.register_callback('model_ready', lambda: float(model_registry.status()['ready']))
+    metrics.register_callback('index_size', lambda: len(index_handle.get()))
+    metrics.register_callback('index_info', lambda: {(('version', index_handle.get().version),): 1})
+    metrics.register_callback('scheduler_queue_depth', lambda: inference_scheduler.metrics()['queue_depth'])
+    metrics.register_callback('scheduler_batches_total', lambda: inference_scheduler.metrics()['batches'], 'counter')
+    metrics.register_callback('scheduler_stage_seconds_total', lambda: {
+        (('stage', stage),): values['total_seconds'] for stage, values in inference_scheduler.timer.snapshot().items()
+    }, 'counter', 'Queue wait, inference and total time of scheduled embeddings')
+    metrics.register_callback('result_cache_events_total', lambda: {
+        (('event', event),): count for event, count in result_cache.snapshot().items()
+        if event not in ('entries', 'embeddings')
+    }, 'counter', 'Result cache hits, misses and invalidations')
+    metrics.register_callback('thumbnail_cache_events_total', lambda: {
+        (('event', event),): count for event, count in thumbnail_cache.snapshot().items()
+        if event not in ('entries', 'bytes')
+    }, 'counter', 'Thumbnail cache hits, misses and evictions')
+    metrics.register_callback('thumbnail_cache_bytes', lambda: thumbnail_cache.snapshot()['bytes'])
+
+
+register_metrics()
+
+
+def parse_classes(form):
+    """
+    Class filter of a search request, from a comma-separated `classes` form field.
+
+    Returns:
+    tuple: Sorted class names, or None when the field is absent.
+
+    Raises:
+    ValueError: When a name is not one of the classes of the live index.
+    """
+    classes = {name.strip() for name in form.get('classes', '').split(',') if name.strip()}
+    if not classes:
+        return None
+    # Checked against the live index, so classes added by a later ingest are accepted without a restart
+    unknown = classes - set(index_handle.get().class_names)
+    if unknown:
+        raise ValueError(f"Unknown classes {', '.join(sorted(unknown))}")
+    return tuple(sorted(classes))
+
+
+class RequestError(ValueError):
+    """Invalid request, answered with status and the message as error."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_batch_request(files, form):
+    """
+    Parameters of a /search/batch request.
+
+    Returns:
+    tuple: (metric, k, classes).
+
+    Raises:
+    RequestError: 400 for bad parameters, 413 for more than MAX_BATCH_FILES files.
+    """
+    if not files:
+        raise RequestError('No files in the request')
+    if len(files) > MAX_BATCH_FILES:
+        raise RequestError(f'At most {MAX_BATCH_FILES} files per request', 413)
+    metric = form.get('metric', 'cosine')
+    if metric not in METRICS:
+        raise RequestError(f'Unknown metric {metric}')
+    k = form.get('k', 10, type=int)
+    if k is None or not 1 <= k <= MAX_K:
+        raise RequestError(f'k must be between 1 and {MAX_K}')
+    try:
+        classes = parse_classes(form)
+    except ValueError as e:
+        raise RequestError(str(e))
+    return metric, k, classes
+
+
+def batch_response(files, images, results):
+    response = []
+    results = iter(results)
+    for file, image in zip(files, images):
+        if image is None:
+            response.append({'filename': file.filename, 'error': 'Could not read the image'})
+        else:
+            response.append({'filename': file.filename,
+                             'results': [{'image_path': path, 'score': score} for path, score in next(results)]})
+    return response
+
+
+def image_digest(url):
+    """
+    sha256 of a result image of the live index, looked up in the version's memory-mapped path and file
+    tables, so workers never parse the manifest.
+
+    Parameters:
+    url (str): Path of the image as returned in search results, with or without the leading slash.
+
+    Returns:
+    tuple: (absolute path, sha256), or None when the path is not indexed or the file is gone.
+    """
+    path = "/" + url.lstrip("/")
+    info = index_handle.get().file_info(path)
+    if info is None:
+        return None
+    digest, size, mtime = info
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    # The indexed hash holds unless the file changed on disk since it was indexed
+    if digest is None or (stat.st_size, stat.st_mtime_ns) != (size, mtime):
+        digest = file_sha256(path)
+    return path, digest
+
+
+def thumbnail_response(response, etag):
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = THUMBNAIL_MAX_AGE
+    return response
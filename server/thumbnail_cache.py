@@ -0,0 +1,144 @@
+import hashlib
+import io
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+
+class ThumbnailCache:
+    """
+    Resized copies of gallery images on disk, named after the content hash of the source and the thumbnail settings.
+
+    The directory is bounded to max_bytes by deleting the least recently served thumbnails first. Recency is kept
+    in memory and mirrored in the file mtimes, so a restarted process starts from the same order. Processes sharing
+    the directory each enforce the bound on their own view; a thumbnail deleted by another one is generated again.
+    """
+
+    def __init__(self, directory, max_bytes=256 << 20, size=256, quality=85):
+        """
+        Parameters:
+        directory (str): Where the thumbnails are stored.
+        max_bytes (int): Size of the directory beyond which thumbnails are evicted.
+        size (int): Longest side of a thumbnail in pixels.
+        quality (int): JPEG quality of the thumbnails.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = size
+        self.quality = quality
+        # key -> bytes on disk, least recently served first
+        self._entries = OrderedDict()
+        self._total = 0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith('.jpg'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime_ns, name[:-len('.jpg')], stat.st_size))
+        for _, key, size in sorted(files):
+            self._entries[key] = size
+            self._total += size
+        self._remove(self._evict())
+
+    def key(self, digest):
+        """
+        Key, and ETag, of the thumbnail of an image whose content has this sha256.
+        """
+        return hashlib.sha256(f'{digest}:{self.size}:{self.quality}'.encode()).hexdigest()[:32]
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f'{key}.jpg')
+
+    def _render(self, source_path):
+        with Image.open(source_path) as image:
+            # JPEG sources are decoded straight at a reduced scale
+            image.draft('RGB', (self.size, self.size))
+            image = image.convert('RGB')
+            image.thumbnail((self.size, self.size))
+            buffer = io.BytesIO()
+            image.save(buffer, format='JPEG', quality=self.quality)
+            return buffer.getvalue()
+
+    def _evict(self):
+        # Called with the lock held; the newest entry is always kept, even when it alone exceeds the bound
+        victims = []
+        while self._total > self.max_bytes and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self._total -= size
+            self.stats['evictions'] += 1
+            victims.append(key)
+        return victims
+
+    def _remove(self, keys):
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def _touch(self, key, size, event):
+        with self._lock:
+            self.stats[event] += 1
+            if key not in self._entries:
+                self._total += size
+                self._entries[key] = size
+            self._entries.move_to_end(key)
+            return self._evict()
+
+    def get(self, source_path, digest):
+        """
+        Thumbnail of an image, generated and stored on first request.
+
+        Parameters:
+        source_path (str): Path of the full-size image.
+        digest (str): sha256 of its content.
+
+        Returns:
+        tuple: (key, JPEG bytes).
+        """
+        key = self.key(digest)
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            data = None
+
+        if data is not None:
+            event = 'hits'
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        else:
+            event = 'misses'
+            data = self._render(source_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Written aside and renamed, so a concurrent reader never sees a partial file
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as file:
+                    file.write(data)
+                os.replace(temp_path, path)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+        self._remove(self._touch(key, len(data), event))
+        return key, data
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries), bytes=self._total)
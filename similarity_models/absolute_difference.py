@@ -1,5 +1,6 @@
 import numpy as np
 from data.data_reader import DataReader
+from similarity_models.scoring_engine import get_score
 
 
 def absolute_difference(query, data):
@@ -8,23 +9,7 @@ def absolute_difference(query, data):
 
 
 def get_l1_score(data_reader, query_path, size):
-    query_image = data_reader.read_image_from_path(query_path, size)
-    query_embedding = data_reader.get_single_image_embedding(query_image)
-
-    ls_path_score = []
-    for folder in data_reader.class_names:
-        images_np, images_path = data_reader.folder_to_images(folder, size)
-
-        embeddings = np.array([
-            data_reader.get_single_image_embedding(images_np[idx_img].astype(np.uint8))
-            for idx_img in range(images_np.shape[0])
-        ])
-
-        rates = absolute_difference(query_embedding, embeddings)
-
-        ls_path_score.extend(list(zip(images_path, rates)))
-
-    return query_image, ls_path_score
+    return get_score(data_reader, query_path, size, metric='l1')
 
 
 if __name__ == '__main__':
@@ -1,5 +1,6 @@
 import numpy as np
 from data.data_reader import DataReader
+from similarity_models.scoring_engine import get_score
 
 
 def cosine_similarity(query, data):
@@ -12,24 +13,7 @@ def cosine_similarity(query, data):
 
 
 def get_cosine_similarity_score(data_reader, query_path, size):
-    query = data_reader.read_image_from_path(query_path, size)
-    query_embedding = data_reader.get_single_image_embedding(query)
-    ls_path_score = []
-
-    for folder in data_reader.class_names:
-        images_np, images_path = data_reader.folder_to_images(folder, size)
-
-
-        embeddings = [
-            data_reader.get_single_image_embedding(images_np[idx_img].astype(np.uint8))
-            for idx_img in range(images_np.shape[0])
-        ]
-
-        embeddings = np.stack(embeddings)
-        rates = cosine_similarity(query_embedding, embeddings)
-        ls_path_score.extend(list(zip(images_path, rates)))
-
-    return query, ls_path_score
+    return get_score(data_reader, query_path, size, metric='cosine')
 
 
 if __name__ == '__main__':
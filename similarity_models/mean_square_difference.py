@@ -1,5 +1,6 @@
 import numpy as np
 from data.data_reader import DataReader
+from similarity_models.scoring_engine import get_score
 
 
 def mean_square_difference(query, data):
@@ -8,19 +9,7 @@ def mean_square_difference(query, data):
 
 
 def get_l2_score(data_reader, query_path, size):
-    query = data_reader.read_image_from_path(query_path, size)
-    query_embedding = data_reader.get_single_image_embedding(query)
-    ls_path_score = []
-    for folder in data_reader.class_names:
-        images_np, images_path = data_reader.folder_to_images(folder, size)
-        embedding_list = []
-        for idx_img in range(images_np.shape[0]):
-            embedding = data_reader.get_single_image_embedding(images_np[idx_img].astype(np.uint8))
-            embedding_list.append(embedding)
-        rates = mean_square_difference(query_embedding, np.stack(embedding_list))
-        ls_path_score.extend(list(zip(images_path, rates)))
-
-    return query, ls_path_score
+    return get_score(data_reader, query_path, size, metric='l2')
 
 
 if __name__ == '__main__':
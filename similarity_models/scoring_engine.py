@@ -0,0 +1,200 @@
+import os
+
+import numpy as np
+
+EPS = np.finfo(np.float32).eps
+
+
+def normalize(data):
+    return data / (np.linalg.norm(data, axis=-1, keepdims=True) + EPS)
+
+
+def _center(data):
+    return data - np.mean(data, axis=-1, keepdims=True)
+
+
+def cosine_scores(engine, queries):
+    return normalize(queries) @ engine.cached('normalized', normalize).T
+
+
+def _squared_norms(embeddings):
+    return np.einsum('ij,ij->i', embeddings, embeddings, dtype=np.float64)
+
+
+def _centered_norms(embeddings):
+    # |d - mean(d)|^2 = |d|^2 - dim * mean(d)^2, without materializing the centred matrix
+    means = embeddings.mean(axis=1, dtype=np.float64)
+    return np.sqrt(np.maximum(_squared_norms(embeddings) - embeddings.shape[1] * means ** 2, 0))
+
+
+def pearson_scores(engine, queries):
+    # (q - mean(q)).(d - mean(d)) = (q - mean(q)).d - mean(d) * sum(q - mean(q)), so the (possibly memory
+    # mapped) gallery is only multiplied, never copied; the per-row means and centred norms are cached
+    means = engine.cached('row_means', lambda e: e.mean(axis=1, dtype=np.float64))
+    centered_norms = engine.cached('centered_norms', _centered_norms)
+    centered = _center(queries)
+    products = centered @ engine.embeddings.T - centered.sum(axis=1)[:, None] * means[None, :]
+    query_norms = np.linalg.norm(centered, axis=1)[:, None]
+    return products / (query_norms + EPS) / (centered_norms[None, :] + EPS)
+
+
+def l2_scores(engine, queries):
+    # mean((d - q)^2) expanded as (|d|^2 - 2 d.q + |q|^2) / dim, so the bulk of the work is one matmul
+    squared_norms = engine.cached('squared_norms', _squared_norms)
+    query_norms = np.einsum('ij,ij->i', queries, queries)[:, None]
+    distances = squared_norms[None, :] - 2 * (queries @ engine.embeddings.T) + query_norms
+    return np.maximum(distances, 0) / engine.embeddings.shape[1]
+
+
+def l1_scores(engine, queries, max_elements=1 << 24):
+    # No matrix-product form exists for L1, so bound the broadcast temporary instead
+    chunk_size = max(1, max_elements // (len(queries) * engine.embeddings.shape[1]))
+    scores = np.empty((len(queries), len(engine)), dtype=np.float32)
+    for start in range(0, len(engine), chunk_size):
+        chunk = engine.embeddings[start:start + chunk_size]
+        scores[:, start:start + chunk_size] = np.abs(chunk[None, :, :] - queries[:, None, :]).sum(axis=-1)
+    return scores
+
+
+# name -> (score function, higher is better)
+METRICS = {
+    'cosine': (cosine_scores, True),
+    'pearson': (pearson_scores, True),
+    'l2': (l2_scores, False),
+    'l1': (l1_scores, False),
+}
+
+
+def register_metric(name, score_function, higher_is_better):
+    """
+    Make a metric available to every ScoringEngine.
+
+    Parameters:
+    name (str): Name the metric is selected by.
+    score_function (callable): f(engine, queries) returning a (n_queries, n_gallery) score matrix.
+    higher_is_better (bool): Whether larger scores mean more similar.
+    """
+    METRICS[name] = (score_function, higher_is_better)
+
+
+def top_k_indices(scores, k, higher_is_better=True):
+    """
+    Indices of the k best scores in each row, best first, using a partial selection.
+
+    Parameters:
+    scores (np.ndarray): (n_queries, n_gallery) score matrix.
+    k (int): Number of results per query.
+    higher_is_better (bool): Whether larger scores are better.
+
+    Returns:
+    np.ndarray: (n_queries, k) indices into the gallery.
+    """
+    keys = -scores if higher_is_better else scores
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return np.zeros((scores.shape[0], 0), dtype=np.int64)
+    top = np.argpartition(keys, k - 1, axis=1)[:, :k]
+    order = np.argsort(np.take_along_axis(keys, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+class ScoringEngine:
+    def __init__(self, embeddings, normalized=False):
+        self.embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        self._cache = {}
+        if normalized:
+            # Rows are already unit length, so cosine needs no normalized copy
+            self._cache['normalized'] = self.embeddings
+
+    def __len__(self):
+        return self.embeddings.shape[0]
+
+    def cached(self, name, compute):
+        """
+        Array derived from the embedding matrix, computed on first use and kept for later queries.
+
+        Apart from the normalized matrix cosine needs for an index saved without unit-norm rows, these are
+        per-row statistics, so a memory-mapped gallery is shared by every process rather than copied.
+        """
+        if name not in self._cache:
+            self._cache[name] = np.ascontiguousarray(compute(self.embeddings), dtype=np.float32)
+        return self._cache[name]
+
+    def scores(self, queries, metric='cosine'):
+        """
+        Score one or many queries against every gallery row.
+
+        Parameters:
+        queries (np.ndarray): A (dim,) query or an (n_queries, dim) matrix.
+        metric (str): One of METRICS.
+
+        Returns:
+        np.ndarray: (n_gallery,) scores for a single query, (n_queries, n_gallery) otherwise.
+        """
+        score_function, _ = METRICS[metric]
+        queries = np.asarray(queries, dtype=np.float32)
+        if len(self) == 0:
+            return np.zeros(queries.shape[:-1] + (0,), dtype=np.float32)
+        scores = score_function(self, np.atleast_2d(queries))
+        return scores[0] if queries.ndim == 1 else scores
+
+    def top_k(self, queries, k=10, metric='cosine'):
+        """
+        Best k gallery rows for one or many queries.
+
+        Parameters:
+        queries (np.ndarray): A (dim,) query or an (n_queries, dim) matrix.
+        k (int): Number of results per query.
+        metric (str): One of METRICS.
+
+        Returns:
+        tuple: (indices, scores), each (k,) for a single query or (n_queries, k), best first.
+        """
+        _, higher_is_better = METRICS[metric]
+        queries = np.asarray(queries, dtype=np.float32)
+        scores = np.atleast_2d(self.scores(queries, metric))
+        top = top_k_indices(scores, k, higher_is_better)
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        if queries.ndim == 1:
+            return top[0], top_scores[0]
+        return top, top_scores
+
+
+def get_score(data_reader, query_path, size, metric, index_dir=None):
+    """
+    Embed the query and score every gallery image with one metric.
+
+    The gallery comes from the saved index in index_dir (data/index by default) when there is one, and is
+    embedded on the fly otherwise.
+
+    Returns:
+    tuple: (query image, list of (path, score) tuples in gallery order); the list is empty when the query
+    cannot be read or embedded, or the gallery is empty.
+    """
+    # Imported here, data.embedding_index itself builds on this module
+    from data.embedding_index import CURRENT_FILE, INDEX_DIR, EmbeddingIndex
+
+    query = data_reader.read_image_from_path(query_path, size)
+    if query is None:
+        return None, []
+    query_embedding = data_reader.get_single_image_embedding(query)
+    if query_embedding is None:
+        return query, []
+
+    index_dir = index_dir or INDEX_DIR
+    if os.path.exists(os.path.join(index_dir, CURRENT_FILE)):
+        index = EmbeddingIndex.load(index_dir)
+        return query, list(zip(index.paths, index.engine.scores(query_embedding, metric)))
+
+    paths = []
+    embeddings = []
+    for images_path, images_np in data_reader.iter_image_batches(size=size):
+        batch_embeddings = data_reader.get_batch_embeddings(images_np)
+        if batch_embeddings is not None:
+            paths.extend(images_path)
+            embeddings.append(batch_embeddings)
+    if not embeddings:
+        return query, []
+
+    rates = ScoringEngine(np.concatenate(embeddings)).scores(query_embedding, metric)
+    return query, list(zip(paths, rates))
@@ -0,0 +1,138 @@
+import functools
+import http.server
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from crawler.async_downloader import AsyncImageDownloader
+from crawler.utils import ImageDownloader
+from data.dedup import DuplicateDetector
+
+
+def write_image(path, seed):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pixels = np.random.default_rng(seed).integers(0, 256, (64, 64, 3), dtype=np.uint8)
+    Image.fromarray(pixels).save(path, quality=90)
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def site(tmp_path):
+    """A local static stand-in for an image host, serving tmp_path/site."""
+    root = tmp_path / 'site'
+    write_image(str(root / '0.jpg'), 0)
+    write_image(str(root / '1.jpg'), 1)
+    os.makedirs(root / 'b')
+    # Same basename as /0.jpg, same bytes as /1.jpg
+    shutil.copy(root / '1.jpg', root / 'b' / '0.jpg')
+    # A re-encoded copy of /0.jpg under another name
+    Image.open(root / '0.jpg').save(root / 'b' / 'small.jpg', quality=60)
+    (root / 'page.html').write_text('<html></html>')
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=str(root)))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}', root
+    server.shutdown()
+    server.server_close()
+
+
+def run_downloader(tmp_path, urls, **kwargs):
+    json_file = tmp_path / 'urls.json'
+    json_file.write_text(json.dumps({'animal': {'cat': urls}}))
+    downloader = AsyncImageDownloader(str(json_file), download_dir=str(tmp_path / 'raw'), min_interval=0, **kwargs)
+    counts = downloader.run()
+    with open(downloader.manifest_path) as file:
+        records = {record['url']: record for record in map(json.loads, file)}
+    return downloader, counts, records
+
+
+def test_downloads_images_and_reports_invalid_urls(site, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    base, root = site
+    urls = [f'{base}/0.jpg', f'{base}/1.jpg', f'{base}/page.html', f'{base}/missing.jpg']
+    _, counts, records = run_downloader(tmp_path, urls, max_connections=4)
+
+    assert (counts['downloaded'], counts['invalid'], counts['failed']) == (2, 2, 0)
+    assert sorted(records) == urls[:2]
+    for name, url in (('0.jpg', urls[0]), ('1.jpg', urls[1])):
+        with open(records[url]['path'], 'rb') as file:
+            assert file.read() == (root / name).read_bytes()
+        assert records[url]['size'] == (root / name).stat().st_size
+
+
+def test_urls_sharing_a_basename_get_their_own_files(site, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    base, root = site
+    urls = [f'{base}/0.jpg', f'{base}/1.jpg', f'{base}/b/0.jpg', f'{base}/page.html', f'{base}/missing.jpg']
+    _, counts, records = run_downloader(tmp_path, urls, max_connections=8)
+
+    assert counts == {'downloaded': 2, 'skipped': 0, 'duplicate': 1, 'invalid': 2, 'failed': 0}
+    first, second, copy = (records[url] for url in urls[:3])
+    assert first['path'] != second['path'] == copy['path']
+    with open(first['path'], 'rb') as file:
+        assert file.read() == (root / '0.jpg').read_bytes()
+    with open(second['path'], 'rb') as file:
+        assert file.read() == (root / '1.jpg').read_bytes()
+    # Whichever of the two identical downloads finished last points at the stored file instead of replacing it
+    assert sum('duplicate_of' in record for record in (second, copy)) == 1
+    assert not [name for name in os.listdir(os.path.dirname(first['path'])) if name.endswith('.part')]
+
+
+def test_rerun_only_fetches_missing_urls(site, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    base, _ = site
+    run_downloader(tmp_path, [f'{base}/0.jpg'])
+    _, counts, records = run_downloader(tmp_path, [f'{base}/0.jpg', f'{base}/1.jpg'])
+
+    assert counts['skipped'] == 1 and counts['downloaded'] == 1
+    assert all(os.path.exists(record['path']) for record in records.values())
+
+
+def test_dedup_only_removes_files_it_created(site, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    base, _ = site
+    urls = [f'{base}/0.jpg', f'{base}/1.jpg', f'{base}/b/0.jpg', f'{base}/b/small.jpg']
+    _, counts, records = run_downloader(tmp_path, urls, max_connections=8, dedup=DuplicateDetector())
+
+    assert counts['downloaded'] == 2 and counts['duplicate'] == 2
+    kept = [record for record in records.values() if 'duplicate_of' not in record]
+    assert len({record['path'] for record in kept}) == 2
+    for record in records.values():
+        assert os.path.exists(record.get('duplicate_of', record['path']))
+
+
+def test_rerun_checks_files_from_runs_without_dedup(site, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    base, _ = site
+    run_downloader(tmp_path, [f'{base}/0.jpg'])
+    _, counts, records = run_downloader(tmp_path, [f'{base}/0.jpg', f'{base}/b/small.jpg'], dedup=DuplicateDetector())
+
+    assert counts['duplicate'] == 1
+    assert records[f'{base}/b/small.jpg']['duplicate_of'] == records[f'{base}/0.jpg']['path']
+
+
+def test_thread_downloader_keeps_same_named_images_apart(site, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    base, root = site
+    json_file = tmp_path / 'urls.json'
+    json_file.write_text(json.dumps({'animal': {'cat': [f'{base}/0.jpg', f'{base}/b/0.jpg', f'{base}/1.jpg']}}))
+    downloader = ImageDownloader(str(json_file), download_dir=str(tmp_path / 'raw'), delay=0)
+    downloader.download_images()
+
+    stored = sorted(downloader.filename)
+    assert len(stored) == 2
+    contents = set()
+    for path in stored:
+        with open(path, 'rb') as file:
+            contents.add(file.read())
+    assert contents == {(root / '0.jpg').read_bytes(), (root / '1.jpg').read_bytes()}
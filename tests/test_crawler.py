@@ -0,0 +1,92 @@
+import pytest
+
+pytest.importorskip('selenium')
+
+from selenium.common.exceptions import WebDriverException
+
+from crawler.crawler import UrlScraper
+
+# A static stand-in for a search page: two images up front, two lazy ones behind placeholders, and a
+# "Load more" button appending two lazy images per click until there are eight
+PAGE = """<html><body>
+<div id="gallery">
+  <img src="img/0_m.jpg">
+  <img src="img/1.jpg">
+  <img class="lazy" src="data:image/gif;base64,R0lGODlhAQABAAAAACw=" data-src="img/2.jpg">
+  <img class="lazy" src="spacer.gif" data-src="img/3.jpg">
+</div>
+<button id="more" onclick="more()">Load more</button>
+<script>
+let next = 4;
+function reveal() {
+  document.querySelectorAll('img.lazy').forEach(image => {
+    image.setAttribute('src', image.dataset.src);
+    image.classList.remove('lazy');
+  });
+}
+setTimeout(reveal, 300);
+function more() {
+  for (let i = 0; i < 2; i++, next++) {
+    const image = document.createElement('img');
+    image.className = 'lazy';
+    image.setAttribute('src', 'spacer.gif');
+    image.dataset.src = 'img/' + next + '.jpg';
+    document.getElementById('gallery').appendChild(image);
+  }
+  if (next >= 8) document.getElementById('more').remove();
+  setTimeout(reveal, 200);
+}
+</script>
+</body></html>"""
+
+
+@pytest.fixture
+def scraper(tmp_path):
+    for term in ('cat', 'dog'):
+        (tmp_path / f'{term}.html').write_text(PAGE)
+    scraper = UrlScraper(f'file://{tmp_path}/{{search_term}}.html', max_workers=1, load_timeout=1,
+                         poll_frequency=0.05)
+    try:
+        with scraper.driver_pool.driver():
+            pass
+    except Exception as e:
+        pytest.skip(f'No headless Chrome: {e}')
+    yield scraper, tmp_path
+    scraper.driver_pool.close()
+
+
+def test_lazy_images_are_read_once_their_src_is_set(scraper):
+    scraper, root = scraper
+    urls = scraper.get_url_images('cat')
+
+    assert urls == [f'file://{root}/img/0_b.jpg'] + [f'file://{root}/img/{i}.jpg' for i in range(1, 8)]
+
+
+def test_max_images_stops_the_crawl(scraper):
+    scraper, _ = scraper
+    scraper.max_images = 3
+
+    assert len(scraper.get_url_images('cat')) == 3
+
+
+def test_terms_share_a_pooled_driver(scraper):
+    scraper, _ = scraper
+    with scraper.driver_pool.driver() as driver:
+        first = driver
+
+    # Both pages sit in the same directory, so their images resolve to the same URLs
+    assert scraper.get_url_images('cat') == scraper.get_url_images('dog')
+    with scraper.driver_pool.driver() as driver:
+        assert driver is first
+    assert scraper.driver_pool._created == 1
+
+
+def test_failed_driver_is_replaced(scraper):
+    scraper, _ = scraper
+    with pytest.raises(WebDriverException):
+        with scraper.driver_pool.driver() as driver:
+            failed = driver
+            raise WebDriverException('browser crashed')
+    assert scraper.driver_pool._created == 0
+    with scraper.driver_pool.driver() as driver:
+        assert driver is not failed
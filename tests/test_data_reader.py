@@ -0,0 +1,31 @@
+import numpy as np
+from PIL import Image
+
+from data.data_reader import DataReader
+
+
+class Collection:
+    def add(self, embeddings, ids):
+        self.embeddings, self.ids = embeddings, ids
+
+
+def test_add_embedding_skips_only_unreadable_files(tmp_path, monkeypatch):
+    (tmp_path / 'train').mkdir()
+    files_path = []
+    for i in range(5):
+        path = tmp_path / f'{i}.jpg'
+        if i == 2:
+            path.write_bytes(b'not an image')
+        else:
+            Image.new('RGB', (8, 8), (i, i, i)).save(path)
+        files_path.append(str(path))
+    data_reader = DataReader(root=str(tmp_path))
+    # One row per image, holding its gray level
+    monkeypatch.setattr(data_reader, 'get_batch_embeddings',
+                        lambda images, batch_size=32: np.array([[image.getpixel((0, 0))[0]] for image in images]))
+
+    collection = Collection()
+    data_reader.add_embedding(collection, files_path, batch_size=4)
+
+    assert collection.ids == ['id_0', 'id_1', 'id_3', 'id_4']
+    assert collection.embeddings == [[0], [1], [3], [4]]
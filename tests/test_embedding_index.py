@@ -0,0 +1,38 @@
+import numpy as np
+
+from data.embedding_index import EmbeddingIndex
+
+
+class RowReader:
+    """Embeds the file at row i of files_path as row i of vectors, without decoding anything."""
+
+    def __init__(self, files_path, vectors):
+        self.rows = {path: row for row, path in enumerate(files_path)}
+        self.vectors = vectors
+
+    def iter_image_batches(self, files_path, size=(224, 224), batch_size=64, num_workers=4, prefetch=2):
+        for start in range(0, len(files_path), batch_size):
+            paths = np.array(files_path[start:start + batch_size])
+            yield paths, np.array([self.rows[path] for path in paths])
+
+    def get_batch_embeddings(self, images, batch_size=32):
+        return self.vectors[images]
+
+
+def test_sync_skips_files_removed_after_listing(tmp_path):
+    files_path = []
+    for i in range(4):
+        path = tmp_path / 'cat' / f'{i}.jpg'
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(bytes([i]) * 16)
+        files_path.append(str(path))
+    reader = RowReader(files_path, np.eye(4, dtype=np.float32))
+    index = EmbeddingIndex.empty()
+    index.sync(reader, files_path)
+
+    # Removed between the listing and the scan
+    (tmp_path / 'cat' / '1.jpg').unlink()
+    counts = index.sync(reader, files_path + [str(tmp_path / 'cat' / 'gone.jpg')])
+
+    assert counts == {'added': 0, 'updated': 0, 'removed': 1, 'duplicates': 0, 'missing': 2}
+    assert index.paths.tolist() == [files_path[0], files_path[2], files_path[3]]
@@ -0,0 +1,36 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from data.inference_scheduler import InferenceScheduler
+
+
+def test_stop_fails_queued_futures():
+    started, release = threading.Event(), threading.Event()
+
+    def embed_batch(images):
+        started.set()
+        release.wait()
+        return np.ones((len(images), 4), dtype=np.float32)
+
+    scheduler = InferenceScheduler(embed_batch, max_batch_size=1, max_wait_ms=0)
+    running = scheduler.submit(0)
+    started.wait()
+    queued = [scheduler.submit(i) for i in range(1, 4)]
+
+    stopper = threading.Thread(target=scheduler.stop)
+    stopper.start()
+    # Let the batch in progress finish only once stop has been requested
+    while not scheduler._stopped.is_set():
+        time.sleep(0.001)
+    release.set()
+    stopper.join(timeout=5)
+
+    assert not stopper.is_alive()
+    # The batch in progress completes, the images behind it are failed rather than left pending
+    assert running.result(timeout=1).shape == (4,)
+    for future in queued:
+        with pytest.raises(RuntimeError):
+            future.result(timeout=1)
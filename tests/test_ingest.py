@@ -0,0 +1,146 @@
+import functools
+import http.client
+import http.server
+import io
+import os
+import shutil
+import threading
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from data.ingest import IngestPipeline
+
+
+def jpeg_bytes(seed):
+    buffer = io.BytesIO()
+    Image.fromarray(np.random.default_rng(seed).integers(0, 256, (64, 64, 3), dtype=np.uint8)).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+class FlakyHandler(http.server.BaseHTTPRequestHandler):
+    """Serves /0.jpg, redirects /old.jpg to it, fails /busy.jpg with 503 twice and /down.jpg always."""
+    protocol_version = 'HTTP/1.1'
+    image = jpeg_bytes(0)
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.path == '/old.jpg':
+            self.reply(301, b'', location='/0.jpg')
+        elif self.path == '/down.jpg' or self.path == '/busy.jpg' and self.server.requests.count(self.path) <= 2:
+            self.reply(503, b'busy', content_type='text/plain')
+        elif self.path in ('/0.jpg', '/busy.jpg'):
+            self.reply(200, self.image)
+        else:
+            self.reply(200, b'<html></html>', content_type='text/html')
+
+    def reply(self, status, body, content_type='image/jpeg', location=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if location is not None:
+            self.send_header('Location', location)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class CountingServer(http.server.ThreadingHTTPServer):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.requests = []
+        self.connections = 0
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        super().process_request(request, client_address)
+
+
+@pytest.fixture
+def host():
+    server = CountingServer(('127.0.0.1', 0), FlakyHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}', server
+    server.shutdown()
+    server.server_close()
+
+
+def pipeline(tmp_path, **kwargs):
+    return IngestPipeline(None, processed_dir=str(tmp_path), min_interval=0, backoff=0.01, **kwargs)
+
+
+def test_download_reuses_one_connection_per_host(host, tmp_path):
+    base, server = host
+    ingest = pipeline(tmp_path)
+    for _ in range(3):
+        assert ingest.download((f'{base}/0.jpg', 'cat'))['data'] == FlakyHandler.image
+    assert ingest.download((f'{base}/old.jpg', 'cat'))['url'] == f'{base}/old.jpg'
+    assert server.connections == 1
+
+
+def test_download_retries_transient_failures(host, tmp_path):
+    base, server = host
+    ingest = pipeline(tmp_path, retries=2)
+    assert ingest.download((f'{base}/busy.jpg', 'cat'))['data'] == FlakyHandler.image
+    with pytest.raises(http.client.HTTPException):
+        ingest.download((f'{base}/down.jpg', 'cat'))
+    assert server.requests.count('/down.jpg') == 3
+    # Not an image: dropped without retrying
+    assert ingest.download((f'{base}/page.html', 'cat')) is None
+    assert server.requests.count('/page.html') == 1
+
+
+def test_rate_limit_spaces_requests_to_a_host(tmp_path):
+    ingest = IngestPipeline(None, processed_dir=str(tmp_path), min_interval=0.05)
+    waits = [ingest.rate_limiter.reserve('example.com') for _ in range(3)]
+    assert waits[0] == pytest.approx(0, abs=0.01)
+    assert waits[2] == pytest.approx(0.1, abs=0.01)
+    assert ingest.rate_limiter.reserve('example.org') == pytest.approx(0, abs=0.01)
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def gallery_site(tmp_path):
+    """A static image host: two images, a copy of one under another name, a thumbnail too small to keep and a page."""
+    root = tmp_path / 'site'
+    root.mkdir()
+    for i in range(2):
+        Image.fromarray(np.random.default_rng(i).integers(0, 256, (64, 64, 3), dtype=np.uint8)).save(root / f'{i}.jpg')
+    shutil.copy(root / '0.jpg', root / 'copy.jpg')
+    Image.new('RGB', (16, 16)).save(root / 'tiny.jpg')
+    (root / 'page.html').write_text('<html></html>')
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=str(root)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+class OnesReader:
+    def get_batch_embeddings(self, images, batch_size=32):
+        return np.ones((len(images), 4), dtype=np.float32)
+
+
+def test_pipeline_writes_each_new_image_once(gallery_site, tmp_path):
+    names = ['0.jpg', '1.jpg', 'copy.jpg', 'tiny.jpg', 'page.html', 'missing.jpg']
+    pipeline = IngestPipeline(OnesReader(), processed_dir=str(tmp_path / 'processed'), download_workers=4,
+                              batch_size=4)
+    written = pipeline.run([(f'{gallery_site}/{name}', 'cat') for name in names])
+
+    assert len(written) == 2
+    for path, embedding, record in written:
+        assert os.path.dirname(path) == str(tmp_path / 'processed' / 'cat')
+        assert record['path'] == path and os.path.getsize(path) == record['size']
+        assert embedding.shape == (4,)
+    report = pipeline.report(1.0)
+    # The page and the missing URL stop at download, the copy and the thumbnail at decode
+    assert report['download']['out'] == 4 and report['decode']['out'] == 2 and report['write']['out'] == 2
@@ -0,0 +1,54 @@
+import numpy as np
+
+from data.embedding_index import EmbeddingIndex
+from similarity_models.correlation_coefficient import correlation_coefficient
+from similarity_models.mean_square_difference import mean_square_difference
+from similarity_models.scoring_engine import get_score
+
+
+def test_pearson_and_l2_never_copy_a_mapped_gallery(tmp_path):
+    rng = np.random.default_rng(0)
+    # Offset and scaled rows, so neither centring nor normalization is a no-op
+    gallery = (rng.normal(size=(200, 32)) * 3 + 1).astype(np.float32)
+    queries = rng.normal(size=(4, 32)).astype(np.float32)
+    paths = [f'/gallery/cat/{i}.jpg' for i in range(len(gallery))]
+    EmbeddingIndex(gallery, paths, {path: {'path': path} for path in paths}).save(str(tmp_path))
+
+    index = EmbeddingIndex.load(str(tmp_path), mmap=True)
+    engine = index.engine
+    # Still the read-only mapping, not a private copy
+    assert not engine.embeddings.flags.writeable
+    for query in queries:
+        np.testing.assert_allclose(engine.scores(query, 'pearson'), correlation_coefficient(query, gallery),
+                                   rtol=1e-4, atol=1e-5)
+        np.testing.assert_allclose(engine.scores(query, 'l2'), mean_square_difference(query, gallery),
+                                   rtol=1e-4, atol=1e-4)
+    assert index.search_batch(queries, 5, 'pearson')
+    assert engine._cache and all(value.shape == (len(gallery),) for value in engine._cache.values())
+
+
+class QueryReader:
+    """Reads every query as one fixed embedding; the gallery must come from the saved index."""
+
+    def __init__(self, embedding):
+        self.embedding = embedding
+
+    def read_image_from_path(self, path, size):
+        return None if path == 'unreadable.jpg' else np.zeros((*size, 3), dtype=np.uint8)
+
+    def get_single_image_embedding(self, image):
+        return self.embedding
+
+    def iter_image_batches(self, *args, **kwargs):
+        raise AssertionError('the gallery was re-embedded')
+
+
+def test_get_score_uses_the_saved_index(tmp_path):
+    gallery = np.eye(3, dtype=np.float32)
+    paths = [f'/gallery/cat/{i}.jpg' for i in range(3)]
+    EmbeddingIndex(gallery, paths, {path: {'path': path} for path in paths}).save(str(tmp_path))
+    reader = QueryReader(gallery[1])
+
+    _, scores = get_score(reader, 'query.jpg', (8, 8), 'cosine', index_dir=str(tmp_path))
+    assert max(scores, key=lambda item: item[1])[0] == paths[1]
+    assert get_score(reader, 'unreadable.jpg', (8, 8), 'cosine', index_dir=str(tmp_path)) == (None, [])